@@ -27,7 +27,7 @@
 This package contains protocols for creating and using IIITD Raghava software
 """
 
-import multiprocessing
+import os, queue, time
 
 from scipion.install.funcs import InstallHelper
 
@@ -48,6 +48,12 @@ class Plugin(pwchemPlugin):
 		cls._defineVar(IIITD_DIC['activation'], cls.getEnvActivationCommand(IIITD_DIC))
 		cls._defineVar(IIITD_DIC['browser'], 'Chrome')
 		cls._defineVar(IIITD_DIC['browserPath'], '/usr/bin/google-chrome')
+		cls._defineVar(IIITD_DIC['cacheDir'], DEFAULT_CACHE_DIR)
+		# Submit the web requests to the local broker running on the cache directory (see immuno.utils.broker)
+		cls._defineVar(IIITD_DIC['broker'], 'False')
+		# Run Chrome without its sandbox, only needed in containers where it cannot start (e.g. as root)
+		cls._defineVar(IIITD_DIC['noSandbox'], 'False')
+		cls._defineEmVar(VAXIGNML_DIC['home'], f"{VAXIGNML_DIC['name']}-{VAXIGNML_DIC['version']}")
 
 	@classmethod
 	def defineBinaries(cls, env, default=True):
@@ -77,75 +83,220 @@ class Plugin(pwchemPlugin):
 
 	# ---------------------------------- Protocol functions-----------------------
 	@classmethod
-	def selectEpitopes(cls, selDics, jobs=1, browserData={}):
+	def selectEpitopes(cls, selDics, jobs=1, browserData={}, onBatch=None, metricsFile=None, memoryBudget=None,
+										 keepPools=False):
 		'''Call the selectors specified in selecDic with the stored parameters using multiprocessing with n jobs.
 			- selecDics : list of dictionaries as {selectorKey: {"software": softwareName, parameterName: parameterValue, }, }
 			- jobs: number of jobs for multiprocessing
+			- onBatch: func, if not None, called as onBatch(selectorKey, softwareName, {seqId: epitopesDic}) with the
+			results of each protein as soon as they are parsed
+			- metricsFile: str, if not None, file where the selectors timing is registered
+			- memoryBudget: float, memory in MB for the workers and their browsers, limiting their number and the browsers
+			started while the memory measured exceeds it (see MemoryGovernor). No limit if None
+			- keepPools: bool, keep the worker pools for the next calls, the caller closing them with closeWorkerPools
 
 			Returns a Panda Dataframe with the selected epitopes with the following information columns:
 			[Source, ProteinId, Position, Epitope, Score]
 		'''
 		# Create a pool of worker processes
-		nJobs = len(selDics) if len(selDics) < jobs else jobs
-		pool = multiprocessing.Pool(processes=nJobs)
+		# Each worker runs a single browser at a time
+		maxTabs = getSoftMaxTabs([selDic['software'] for selDic in selDics.values()])
+		nJobs = getBudgetSlots(len(selDics) if len(selDics) < jobs else jobs, memoryBudget, maxTabs)
+		nSlots = nJobs if memoryBudget else None
+		pool = getWorkerPool('selection', nJobs, nSlots)
 
-		resultsDic = {}
+		manager = getWorkerContext().Manager() if onBatch else None
+		epiQueue = manager.Queue() if onBatch else None
+
+		governor = startMemoryGovernor(memoryBudget, nSlots, maxTabs)
+		try:
+			resultsDic = {}
+			for selKey, selDic in selDics.items():
+				softName = selDic['software']
+				del selDic['software']
+				resultsDic[(selKey, softName)] = pool.apply_async(runEpitopeSelection,
+																													args=(softName, selDic, browserData, epiQueue, (selKey, softName)),
+																													kwds={'metricsFile': metricsFile})
+
+			if onBatch:
+				consumePoolQueue(epiQueue, resultsDic, lambda key, batchDic: onBatch(*key, batchDic))
+			else:
+				reportPoolStatus(resultsDic)
+
+			epiDics = {}
+			for (selKey, softName), res in resultsDic.items():
+				epiDics[(selKey, softName)] = res.get()
+		finally:
+			cls._releaseResources(governor, manager, keepPools)
+		return epiDics
+
+	@classmethod
+	def _releaseResources(cls, governor, manager, keepPools):
+		'''Stops the memory governor and the manager of a call and, unless keepPools, closes the worker pools'''
+		if governor:
+			governor.stop()
+		if manager:
+			manager.shutdown()
+		if not keepPools:
+			closeWorkerPools()
+
+	@classmethod
+	def selectAndEvaluate(cls, selDics, evalDics, jobs=1, browserData={}, verbose=True, onBatch=None, metricsFile=None,
+												memoryBudget=None, keepPools=False):
+		'''Pipeline the epitope selection and evaluation: the epitopes of each protein flow through a bounded queue from
+		the selector workers to the evaluator workers as soon as they are parsed, so both stages overlap.
+			- selDics : dictionary as {selectorKey: {"software": softwareName, parameterName: parameterValue, }, }
+			- evalDics: dictionary as {evalKey: {"software": softwareName, parameterName: parameterValue}}
+			- jobs: number of jobs for multiprocessing, shared by selectors and evaluators
+			- onBatch: func, if not None, called with the elements of the output list as soon as their evaluations finish
+			- metricsFile: str, if not None, file where the selectors and evaluators timing is registered
+			- memoryBudget: float, memory in MB for the workers and their browsers, limiting their number (at least one
+			selector and one evaluator) and the evaluator browsers started while the memory measured exceeds it. No limit
+			if None
+			- keepPools: bool, keep the worker pools for the next calls, the caller closing them with closeWorkerPools
+
+			Returns a list with an element for each protein epitopes batch as:
+			(selectorKey, selectorSoftware, epitopesDic, {(evalKey, evalSoftware): [scores]})
+		'''
+		# Each worker runs a single browser at a time
+		maxTabs = getSoftMaxTabs([dic['software'] for dic in list(selDics.values()) + list(evalDics.values())])
+		jobs = getBudgetSlots(jobs, memoryBudget, maxTabs)
+		selJobs = max(1, min(len(selDics), jobs // 2))
+		evalJobs = max(1, jobs - selJobs)
+		# Only the evaluator browsers are governed: the selectors may wait for them on the bounded queue
+		nSlots = evalJobs if memoryBudget else None
+		selPool, evalPool = getWorkerPool('selection', selJobs), getWorkerPool('evaluation', evalJobs, nSlots)
+		# Bounded queue: selectors wait when the evaluators fall behind
+		manager = getWorkerContext().Manager()
+		epiQueue = manager.Queue(maxsize=2 * evalJobs)
+
+		governor = startMemoryGovernor(memoryBudget, nSlots, maxTabs)
+		try:
+			outBatches = cls._runSelectAndEvaluate(selDics, evalDics, browserData, selPool, evalPool, evalJobs, epiQueue,
+																						 verbose, onBatch, metricsFile)
+		finally:
+			cls._releaseResources(governor, manager, keepPools)
+		return outBatches
+
+	@classmethod
+	def _runSelectAndEvaluate(cls, selDics, evalDics, browserData, selPool, evalPool, evalJobs, epiQueue, verbose,
+														onBatch, metricsFile):
+		'''Runs the selection and evaluation pipeline of selectAndEvaluate on its pools'''
+
+		selResults = {}
 		for selKey, selDic in selDics.items():
-			softName = selDic['software']
-			del selDic['software']
-			resultsDic[(selKey, softName)] = pool.apply_async(runEpitopeSelection,
-																												args=(softName, selDic, browserData))
+			smallSelDic = selDic.copy()
+			softName = smallSelDic.pop('software')
+			selResults[(selKey, softName)] = selPool.apply_async(runEpitopeSelection,
+																													 args=(softName, smallSelDic, browserData, epiQueue, (selKey, softName)),
+																													 kwds={'metricsFile': metricsFile})
 
-		reportPoolStatus(resultsDic)
+		batches, published = [], []
+		while True:
+			if onBatch:
+				published = cls._publishEvaluatedBatches(batches, published, onBatch)
 
-		pool.close()
-		pool.join()
+			nRunning = sum([not res.ready() for *_, evalResults in batches for res in evalResults.values()])
+			if nRunning >= 2 * evalJobs:
+				time.sleep(1)
+				continue
 
-		epiDics = {}
-		for (selKey, softName), res in resultsDic.items():
-			epiDics[(selKey, softName)] = res.get()
+			selDone = all([res.ready() for res in selResults.values()])
+			try:
+				(selKey, softName), batchDic = epiQueue.get(timeout=1)
+			except queue.Empty:
+				if selDone:
+					break
+				continue
 
-		return epiDics
+			for protId, seqEpDic in batchDic.items():
+				sequences = {i: epSeq for i, epSeq in enumerate(seqEpDic.get('Sequence', []))}
+				evalResults = {}
+				if sequences:
+					for evalKey, evalDic in evalDics.items():
+						smallEvalDic = evalDic.copy()
+						evalSoft = smallEvalDic.pop('software')
+						evalResults[(evalKey, evalSoft)] = evalPool.apply_async(callEvaluator,
+																																		args=(evalSoft, sequences, browserData, smallEvalDic),
+																																		kwds={'metricsFile': metricsFile,
+																																					'entry': getRegistryEntry(evalSoft)})
+				batches.append((selKey, softName, seqEpDic, evalResults))
+				if verbose:
+					print(f'{selKey} epitopes of {protId} sent to evaluation ({len(sequences)} epitopes)')
+
+		for res in selResults.values():
+			# Raising possible selector errors
+			res.get()
+		for *_, evalResults in batches:
+			for res in evalResults.values():
+				res.wait()
+
+		if onBatch:
+			cls._publishEvaluatedBatches(batches, published, onBatch)
+
+		outBatches = []
+		for selKey, softName, seqEpDic, evalResults in batches:
+			scoreDic = {evalKeySoft: res.get()['Score'] for evalKeySoft, res in evalResults.items()}
+			outBatches.append((selKey, softName, seqEpDic, scoreDic))
+		return outBatches
+
+	@classmethod
+	def _publishEvaluatedBatches(cls, batches, published, onBatch):
+		'''Calls onBatch with the batches of selectAndEvaluate whose evaluations are finished and were not published yet.
+		Returns the updated list of published batch indexes'''
+		for bIdx, (selKey, softName, seqEpDic, evalResults) in enumerate(batches):
+			if bIdx not in published and all([res.ready() for res in evalResults.values()]):
+				scoreDic = {evalKeySoft: res.get()['Score'] for evalKeySoft, res in evalResults.items()}
+				onBatch(selKey, softName, seqEpDic, scoreDic)
+				published.append(bIdx)
+		return published
 
 	@classmethod
-	def performEvaluations(cls, sequences, evalDics, jobs=1, browserData={}, verbose=True):
+	def performEvaluations(cls, sequences, evalDics, jobs=1, browserData={}, verbose=True, sweep=False,
+												 chunkSize=None, onChunk=None, timeout=None, hedgePercentile=None, metricsFile=None,
+												 historyFile=None, memoryBudget=None, maxFailures=3, timeBudget=None, priorities=None,
+												 keepPools=False):
 		'''Generalize caller to the evaluation functions.
     - sequences: dict with sequences in the form: {seqId: sequence}
     - evalDics: dictionary as {evalKey: {parameterName: parameterValue}}
     - jobs: int, number of jobs for parallelization
+    - sweep: bool, run the evaluators of the same software as a parameter sweep in a single browser session
+    - chunkSize: int, maximum number of sequences evaluated on each (evaluator, chunk) work unit
+    - onChunk: func, called as onChunk(seqIds, {(evalKey, softwareName): [scores]}) when a chunk is fully evaluated
+    - timeout: float, deadline in seconds for each work unit, which get NaN scores if exceeded
+    - hedgePercentile: float, latency percentile over which a work unit request is hedged (see evaluateSequences)
+    - metricsFile: str, if not None, file where the work units timing and counters are registered
+    - historyFile: str, if not None, software latency history used to order and size the work units
+    - memoryBudget: float, memory in MB for the workers and their browsers, limiting their number
+    - maxFailures: int, consecutive failures tripping the circuit breaker of a software (see evaluateSequences)
+    - timeBudget: float, seconds available for a best effort evaluation, NaN scores for the sequences left out
+    - priorities: dict, {seqId: priority}, the sequences with higher priority being evaluated first with timeBudget
+    - keepPools: bool, keep the worker pools for the next calls (e.g. streaming batches), the caller closing them with
+    closeWorkerPools
     Returns a dictionary of the form: {(evalKey, softwareName): [scores]}
     '''
-		funcDic = {
-			'ToxinPred': callToxinPred, 'AlgPred2': callAlgPred2, 'ToxinPred2': callToxinPred2,
-			'IL4pred': callIL4pred, 'IL10pred': callIL10pred, 'IFNepitope': callIFNepitope,
-		}
-
-		# Create a pool of worker processes
-		nJobs = len(evalDics) if len(evalDics) < jobs else jobs
-		pool = multiprocessing.Pool(processes=nJobs)
-
-		resultsDic = {}
-		for evalKey, evalDic in evalDics.items():
-			softName = evalDic['software']
-			smallEvalDic = evalDic.copy()
-			del smallEvalDic['software']
-			if softName in funcDic:
-				resultsDic[(evalKey, softName)] = pool.apply_async(funcDic[softName],
-																													 args=(sequences, smallEvalDic, browserData))
+		try:
+			return evaluateSequences(sequences, evalDics, jobs, browserData, chunkSize=chunkSize, sweep=sweep,
+															 onChunk=onChunk, verbose=verbose, timeout=timeout, hedgePercentile=hedgePercentile,
+															 metricsFile=metricsFile, historyFile=historyFile, memoryBudget=memoryBudget,
+															 maxFailures=maxFailures, timeBudget=timeBudget, priorities=priorities)
+		finally:
+			cls._releaseResources(None, None, keepPools)
 
-		if verbose:
-			reportPoolStatus(resultsDic)
-
-		pool.close()
-		pool.join()
-
-		epiDics = {}
-		for (evalKey, softName), res in resultsDic.items():
-			epiDics[(evalKey, softName)] = res.get()['Score']
+	# ---------------------------------- Utils functions-----------------------
+	@classmethod
+	def getVaxignMLCommand(cls):
+		'''Returns the path to the Vaxign-ML docker launcher script'''
+		return os.path.join(cls.getVar(VAXIGNML_DIC['home']), 'VaxignML.sh')
 
-		return epiDics
+	@classmethod
+	def getLatencyHistoryFile(cls):
+		'''Returns the path to the file storing the latency history of the web servers'''
+		return os.path.join(cls.getVar(IIITD_DIC['cacheDir']), 'latencyHistory.json')
 
-	# ---------------------------------- Utils functions-----------------------
 	@classmethod
 	def getBrowserData(cls):
-		return {'name': cls.getVar(IIITD_DIC['browser']), 'path': cls.getVar(IIITD_DIC['browserPath'])}
\ No newline at end of file
+		return {'name': cls.getVar(IIITD_DIC['browser']), 'path': cls.getVar(IIITD_DIC['browserPath']),
+						'cacheDir': cls.getVar(IIITD_DIC['cacheDir']),
+						'broker': str(cls.getVar(IIITD_DIC['broker'])).lower() in ['true', '1', 'yes'],
+						'noSandbox': str(cls.getVar(IIITD_DIC['noSandbox'])).lower() in ['true', '1', 'yes']}
\ No newline at end of file
@@ -0,0 +1,180 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Batch command line interface to run the IIITD epitope selection and evaluation without a Scipion project:
+    immuno-batch select -i proteins.fasta -s selectors.json -o epitopes.tsv
+    immuno-batch evaluate -i epitopes.tsv -s evaluators.yaml -o scores.tsv
+The specification files (json or yaml) define the selectors or evaluators with the web server parameter names, as
+{name: {"software": softwareName, parameterName: parameterValue}}
+"""
+
+import os, sys, json, argparse
+
+from . import Plugin as iiitdPlugin
+from .constants import IIITD_DIC, DEFAULT_CACHE_DIR
+from .utils import parseInputProteins, writeScoreArrays
+
+def readSpecFile(specFile):
+  '''Reads the selectors or evaluators specification from a json or yaml file'''
+  with open(specFile) as f:
+    if specFile.endswith(('.yaml', '.yml')):
+      import yaml
+      return yaml.safe_load(f)
+    return json.load(f)
+
+def readInputSequences(inFile):
+  '''Reads the input sequences from a fasta file or a tsv file with columns "id" and "sequence" (and optionally
+  "position")
+  :return: ({seqId: sequence}, {seqId: position})
+  '''
+  if not inFile.endswith(('.tsv', '.txt')):
+    return parseInputProteins(inFile), {}
+
+  sequences, positions = {}, {}
+  with open(inFile) as f:
+    header = [col.strip().lower() for col in f.readline().split('\t')]
+    for line in f:
+      if line.strip():
+        row = dict(zip(header, [value.strip() for value in line.split('\t')]))
+        sequences[row['id']] = row['sequence']
+        if row.get('position'):
+          positions[row['id']] = int(row['position'])
+  return sequences, positions
+
+def getBrowserData(args):
+  return {'name': args.browser, 'path': args.browserPath, 'cacheDir': args.cacheDir, 'broker': args.broker,
+          'noSandbox': args.noSandbox}
+
+def writeTable(outFile, header, rows):
+  with open(outFile, 'w') as f:
+    f.write('\t'.join(header) + '\n')
+    for row in rows:
+      f.write('\t'.join([str(value) for value in row]) + '\n')
+
+def runSelection(args):
+  '''Runs the selectors on the input proteins and writes the selected epitopes as a tsv with the columns
+  id, selector, software, protein, position, sequence and score, which can be used as input of evaluate'''
+  selDics = readSpecFile(args.spec)
+  for selDic in selDics.values():
+    selDic['i'] = os.path.abspath(args.input)
+
+  epiDics = iiitdPlugin.selectEpitopes(selDics, args.jobs, getBrowserData(args), metricsFile=args.metrics,
+                                       memoryBudget=args.memoryBudget)
+
+  rows = []
+  for (selKey, softName), epiDic in epiDics.items():
+    for protId, seqEpDic in epiDic.items():
+      for epSeq, epPos, epScore in zip(seqEpDic['Sequence'], seqEpDic['Position'], seqEpDic['Score']):
+        rows.append([f'{selKey}_{protId}_{epPos}-{int(epPos) + len(epSeq)}', selKey, softName, protId, epPos, epSeq,
+                     epScore])
+  writeTable(args.output, ['id', 'selector', 'software', 'protein', 'position', 'sequence', 'score'], rows)
+  print(f'{len(rows)} epitopes written to {args.output}')
+
+def runEvaluation(args):
+  '''Evaluates the input sequences and writes the scores as a tsv table or, if the output ends with .npy, as a
+  memory-mappable score matrix with its index (see writeScoreArrays)'''
+  sequences, positions = readInputSequences(args.input)
+  evalDics = readSpecFile(args.spec)
+  historyFile = os.path.join(args.cacheDir, 'latencyHistory.json') if args.cacheDir and not args.noHistory else None
+
+  scoresDic = iiitdPlugin.performEvaluations(sequences, evalDics, args.jobs, getBrowserData(args),
+                                             chunkSize=args.chunkSize, timeout=args.timeout * 60,
+                                             hedgePercentile=args.hedgePercentile, metricsFile=args.metrics,
+                                             historyFile=historyFile, memoryBudget=args.memoryBudget,
+                                             maxFailures=args.maxFailures,
+                                             timeBudget=args.timeBudget * 60 if args.timeBudget else None)
+
+  seqIds = list(sequences.keys())
+  scoreColumns = {evalKey: scores for (evalKey, softName), scores in scoresDic.items()}
+  if args.output.endswith('.npy'):
+    seqPositions = [(positions.get(seqId, 0), positions.get(seqId, 0) + len(sequences[seqId])) for seqId in seqIds]
+    # Ids converted to their index in the input, being stored in the index file along with the original ids
+    writeScoreArrays(args.output, args.output.replace('.npy', '_index.npz'), list(range(len(seqIds))),
+                     seqPositions, scoreColumns)
+    writeTable(args.output.replace('.npy', '_ids.tsv'), ['index', 'id'], enumerate(seqIds))
+  else:
+    rows = [[seqId, sequences[seqId]] + [scores[i] for scores in scoreColumns.values()]
+            for i, seqId in enumerate(seqIds)]
+    writeTable(args.output, ['id', 'sequence'] + list(scoreColumns.keys()), rows)
+  print(f'{len(seqIds)} sequences evaluated, scores written to {args.output}')
+
+def getParser():
+  parser = argparse.ArgumentParser(prog='immuno-batch', description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  for command, helpStr in [('select', 'Select epitopes on the proteins of a fasta file'),
+                           ('evaluate', 'Evaluate the sequences of a fasta or tsv file')]:
+    sParser = subparsers.add_parser(command, help=helpStr)
+    sParser.add_argument('-i', '--input', required=True, help='Input fasta file (or tsv with id and sequence columns '
+                                                              'for evaluate)')
+    sParser.add_argument('-s', '--spec', required=True, help='Selectors or evaluators specification (json or yaml)')
+    sParser.add_argument('-o', '--output', required=True, help='Output tsv file (or .npy score matrix for evaluate)')
+    sParser.add_argument('-j', '--jobs', type=int, default=4, help='Number of parallel workers')
+    sParser.add_argument('--browser', default=os.environ.get(IIITD_DIC['browser'], 'Chrome'),
+                         help='Browser to use: Chrome or Firefox')
+    sParser.add_argument('--browser-path', dest='browserPath', default=os.environ.get(IIITD_DIC['browserPath']),
+                         help='Path to the browser executable')
+    sParser.add_argument('--no-sandbox', dest='noSandbox', action='store_true',
+                         default=os.environ.get(IIITD_DIC['noSandbox'], '').lower() in ['true', '1', 'yes'],
+                         help='Run Chrome without its sandbox, only for containers where it cannot start otherwise')
+    sParser.add_argument('--cache-dir', dest='cacheDir', default=os.environ.get(IIITD_DIC['cacheDir'],
+                                                                                 DEFAULT_CACHE_DIR),
+                         help='Directory for the browsers disk cache and the servers latency history')
+    sParser.add_argument('--broker', action='store_true',
+                         help='Submit the requests to the local broker running on the cache directory, started with '
+                              '"python -m immuno.utils.broker"')
+    sParser.add_argument('--memory-budget', dest='memoryBudget', type=float, default=0,
+                         help='Memory (MB) for the workers and their browsers. No limit if 0')
+    sParser.add_argument('--metrics', default=None, help='File where the run timing metrics are written (jsonl)')
+
+    if command == 'evaluate':
+      sParser.add_argument('--chunk-size', dest='chunkSize', type=int, default=100,
+                           help='Maximum number of sequences per evaluation job. 0 for a single chunk')
+      sParser.add_argument('--timeout', type=float, default=0,
+                           help='Deadline (minutes) for each evaluation job, NaN scores if exceeded. 0 for none')
+      sParser.add_argument('--hedge-percentile', dest='hedgePercentile', type=float, default=95,
+                           help='Latency percentile over which a duplicate request is submitted. 0 for none')
+      sParser.add_argument('--max-failures', dest='maxFailures', type=int, default=3,
+                           help='Consecutive failed jobs disabling an evaluator, whose servers are also probed '
+                                'before starting. 0 to stop on any error')
+      sParser.add_argument('--time-budget', dest='timeBudget', type=float, default=0,
+                           help='Minutes available for a best effort evaluation, in input order. The sequences not '
+                                'evaluated in time get NaN scores. 0 for no limit')
+      sParser.add_argument('--no-history', dest='noHistory', action='store_true',
+                           help='Do not use nor update the servers latency history')
+  return parser
+
+def main(argv=None):
+  args = getParser().parse_args(argv)
+  if args.command == 'select':
+    runSelection(args)
+  else:
+    runEvaluation(args)
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -25,13 +25,19 @@
 # *
 # **************************************************************************
 
+import os
+
 # Common constants
 DEFAULT_VERSION = '1.0'
 
 # Package dictionaries
 IIITD_DIC = {'name': 'IIITD',    'version': '3.0',
              'home': 'IIITD_HOME', 'activation': 'IIITD_ACTIVATION_CMD',
-             'browser': 'IIITD_BROWSER', 'browserPath': 'IIITD_BROWSER_PATH'}
+             'browser': 'IIITD_BROWSER', 'browserPath': 'IIITD_BROWSER_PATH', 'cacheDir': 'IIITD_CACHE_DIR',
+             'broker': 'IIITD_BROKER', 'noSandbox': 'IIITD_NO_SANDBOX'}
+
+# Default directory of the browsers disk cache, the latency history and the broker socket
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'scipion-immuno')
 
 VAXIGNML_DIC =     {'name': 'vaxign-ML', 'version': DEFAULT_VERSION, 'home': 'VAXIGNML_HOME'}
 
@@ -40,6 +46,9 @@ bepiPattern = 'immuno'
 READ_URL = 'https://github.com/scipion-chem/scipion-chem-IIITD'
 
 
+# Residues accepted by the web servers
+STANDARD_AAS = 'ACDEFGHIKLMNPQRSTVWY'
+
 SEL_PARAM_MAP = {'abcWindow': 'window', 'abcThres': 'Threshold', 'abcFilter': 'filter'}
 
 EVAL_PARAM_MAP = {
@@ -64,6 +73,9 @@ SELSUM = '''1) "ABCpred-1": {'software': 'ABCpred', 'abcWindow': '16', 'abcThres
 2) "LBtope-1": {'software': 'LBtope', 'lbModel': 'LBtope_Variable', 'lbThres': '60', 'lbLength': 15}
 '''
 
+WINSUM = '''1) "Windows-1": {'software': 'Windows', 'winLengths': '15', 'winStride': 1}
+'''
+
 EVALSUM = '''1) "ToxinPred-1": {'software': 'ToxinPred', 'toxinMethod': 'SVM', 'toxinSVMMethod': 'SVM(Swiss-Prot)', 'toxinQMMethod': 'Monopeptide(Swiss-Prot)', 'toxinEval': 10.0, 'toxinThval': 0.0}
 2) "AlgPred2-1": {'software': 'AlgPred2', 'algMethod': 'AAC based RF', 'algThres': 0.3}
 3) "IL4pred-1": {'software': 'IL4pred', 'il4Method': 'Hybrid', 'il4Thval': 0.2}
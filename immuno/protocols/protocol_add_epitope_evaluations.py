@@ -24,20 +24,30 @@
 # *
 # **************************************************************************
 
+import os, re, sys, math, time, json
+
 from pwem.protocols import EMProtocol
-from pyworkflow.protocol import params
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.object import Set
 
 from pwchem.objects import SetOfSequenceROIs
 
 from .. import Plugin as iiitdPlugin
 from ..constants import TOXIN2WARN
-from ..utils import mapEvalParamNames
-
-class ProtIIITDEvaluations(EMProtocol):
+from ..utils import mapEvalParamNames, buildEvaluationUnits, mergeUnitScores, getRankScore, \
+  MemoryMonitor, logMetric, closeWorkerPools, getEvaluatorNames, FEATURE_FUNCTIONS, toFloat, readMetrics, getCounters, \
+  pushTopK
+from ..utils.unitRunner import writeUnitFile
+from .protocol_rois_output import ROIsOutputMixin
+from .protocol_elements import ElementsFormMixin
+
+class ProtIIITDEvaluations(ROIsOutputMixin, ElementsFormMixin, EMProtocol):
   """Run evaluations on a set of epitopes (SetOfSequenceROIs)"""
   _label = 'IIITD epitope evaluations'
+  # Seconds between checks of a streaming input for new ROIs
+  _inputCheckTime = 30
 
-  _evaluatorOptions = ['ToxinPred', 'AlgPred2', 'IL4pred', 'IL10pred', 'IFNepitope', 'ToxinPred2']
+  _evaluatorOptions = ['ToxinPred', 'AlgPred2', 'IL4pred', 'IL10pred', 'IFNepitope', 'ToxinPred2', 'LocalModel']
 
   _toxinSVMMethods = ["SVM(Swiss-Prot)", "SVM(Swiss-Prot)+Motif", "SVM(TrEMBL)", "SVM(TrEMBL)+Motif"]
   _toxinQMMethods = ["Monopeptide(Swiss-Prot)", "Monopeptide(TrEMBL)", "Dipeptide(Swiss-Prot)", "Dipeptide(TrEMBL)"]
@@ -47,6 +57,7 @@ class ProtIIITDEvaluations(EMProtocol):
   _ifnMethods = ["Motif", "SVM", "Hybrid"]
   _ifnModels = ["IFN-gamma versus Non IFN-gamma", "IFN-gamma versus other cytokine", "IFN-gamma versus random"]
   _toxin2Methods = ["AAC based RF", "Hybrid (RF+BLAST+MERCI)"]
+  _modelFeatures = list(FEATURE_FUNCTIONS.keys())
 
 
   _softParams = {'ToxinPred': ['toxinMethod', 'toxinSVMMethod', 'toxinQMMethod', 'toxinEval', 'toxinThval'],
@@ -54,11 +65,20 @@ class ProtIIITDEvaluations(EMProtocol):
                  'IL4pred': ['il4Method', 'il4Thval'],
                  'IL10pred': ['il10Method', 'il10Thval'],
                  'IFNepitope': ['ifnMethod'],
-                 'ToxinPred2': ['toxin2Method', 'toxin2Eval']
+                 'ToxinPred2': ['toxin2Method', 'toxin2Eval'],
+                 'LocalModel': ['modelFile', 'modelFeatures']
                  }
 
   def __init__(self, **kwargs):
     EMProtocol.__init__(self, **kwargs)
+    self.stepsExecutionMode = STEPS_PARALLEL
+
+  @classmethod
+  def getEvaluatorOptions(cls):
+    '''Returns the evaluator choices: the built-in ones followed by the local evaluators registered by other plugins
+    (see registerLocalEvaluator), read when the form is defined so the plugins imported later are also listed'''
+    return cls._evaluatorOptions + [softName for softName in getEvaluatorNames('local')
+                                    if softName not in cls._evaluatorOptions]
 
   def _defineEvalParams(self, aGroup, allCond=True):
     '''Define the evaluation options and the parameters for each of them.
@@ -66,7 +86,7 @@ class ProtIIITDEvaluations(EMProtocol):
 
     WARNING: This function is used by a scipion-chem metaprotocol to use and define this parameters by its own,
     modify with care'''
-    aGroup.addParam('chooseIIITDEvaluator', params.EnumParam, choices=self._evaluatorOptions,
+    aGroup.addParam('chooseIIITDEvaluator', params.EnumParam, choices=self.getEvaluatorOptions(),
                     label='Choose evaluator: ', default=0, condition=f'{allCond}',
                     help=f'Epitope evaluation software to use.\n{TOXIN2WARN}')
 
@@ -119,6 +139,16 @@ class ProtIIITDEvaluations(EMProtocol):
                     condition=f'{allCond} and chooseIIITDEvaluator==5',
                     help=f'Threshold for the SVM predictions (-0.5, 2).\n{TOXIN2WARN}')
 
+    aGroup.addParam('modelFile', params.PathParam, label='Local model file: ',
+                    condition=f'{allCond} and chooseIIITDEvaluator==6',
+                    help='Pickled (or joblib) predictor, e.g. a scikit-learn model, run locally on the epitopes '
+                         'features. Its positive class probability is used as score if it has predict_proba, '
+                         'otherwise its decision_function or predict output.')
+    aGroup.addParam('modelFeatures', params.EnumParam, choices=self._modelFeatures, label='Local model features: ',
+                    default=0, condition=f'{allCond} and chooseIIITDEvaluator==6',
+                    help='Features of the epitopes the model was trained on: amino acid composition (aac, 20 '
+                         'values), dipeptide composition (dpc, 400 values) or both (aac+dpc)')
+
     return aGroup
 
   def _defineParams(self, form):
@@ -141,43 +171,355 @@ class ProtIIITDEvaluations(EMProtocol):
                     label='Evaluators summary: ',
                     help='Summary of the epitope evaluations that will be performed')
 
+    eGroup = form.addGroup('Execution')
+    eGroup.addParam('sweepEvals', params.BooleanParam, label='Sweep evaluators of the same software: ',
+                    default=False, expertLevel=params.LEVEL_ADVANCED,
+                    help='Run the evaluators defined with the same software as a parameter sweep: a single browser '
+                         'session per software, where the sequences are submitted once per parameter combination '
+                         'in parallel tabs. Each evaluator still produces its own score.')
+    eGroup.addParam('chunkSize', params.IntParam, label='Epitopes per evaluation chunk: ', default=100,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='The epitopes are evaluated in chunks of this size, each evaluator and chunk being a '
+                         'separate job. The output is updated in streaming as each chunk is evaluated by all the '
+                         'evaluators. If 0, all the epitopes are evaluated in a single chunk.\n'
+                         'This is the maximum size: using the latency history of the evaluators, the chunks may be '
+                         'reduced so all the threads finish together, and the slowest jobs are run first.')
+    eGroup.addParam('requestTimeout', params.FloatParam, label='Chunk evaluation deadline (min): ', default=0,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Maximum time for an evaluator to evaluate a chunk. The epitopes of chunks exceeding it get '
+                         'NaN scores for that evaluator. If 0, no deadline is applied.')
+    eGroup.addParam('hedgePercentile', params.FloatParam, label='Hedging latency percentile: ', default=95,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='If an evaluator takes longer on a chunk than this percentile (0-100) of its previous chunks '
+                         'latency, a duplicate request of the chunk is submitted. The first one to finish is used and '
+                         'the other is cancelled. If 0, no hedged requests are made.')
+    eGroup.addParam('maxFailures', params.IntParam, label='Failures to disable an evaluator: ', default=3,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='The web servers are probed before the evaluation and an evaluator is disabled (its '
+                         'remaining chunks get NaN scores) if its server does not answer or after this number of '
+                         'consecutive failed chunks, so the rest of evaluators keep all the threads. If 0, the '
+                         'servers are not probed and the evaluation is stopped by any error.')
+    eGroup.addParam('timeBudget', params.FloatParam, label='Time budget (min): ', default=0,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Best effort mode: time available for the evaluation. The ROIs with the best selector score '
+                         'are evaluated first, no more chunks are submitted once their estimated time exceeds the '
+                         'time left, and the running ones are stopped when it runs out. The ROIs not evaluated get '
+                         'NaN scores and a coverage report is written. If 0, there is no time limit.\n'
+                         'The output ROIs are published in streaming in that priority order, not in the input order.\n'
+                         'Not applied when distributing the evaluation jobs.')
+    eGroup.addParam('distributeUnits', params.BooleanParam, label='Distribute evaluation jobs: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Run each evaluator and chunk as an independent Scipion job, so they can be distributed '
+                         'among hosts using MPI or a queue system. The results are gathered at the end. '
+                         'In this mode, the input set must be complete (closed), the output is not updated in '
+                         'streaming and no hedged requests are made.')
+    eGroup.addParam('memoryBudget', params.FloatParam, label='Memory budget (GB): ', default=0,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Memory available for the evaluation workers and their browsers (around 300 MB each). The '
+                         'number of workers and live browsers is limited to fit in it and the rest of jobs wait in '
+                         'queue. If 0, no limit is applied. The peak memory used is registered in the run metrics.')
+
+    oGroup = form.addGroup('Top-k output')
+    oGroup.addParam('topK', params.IntParam, label='Number of best ROIs to keep: ', default=0,
+                    help='If higher than 0, only this number of ROIs, the best ranked by the combined score defined '
+                         'below, are saved in the output, which is created once all the ROIs are evaluated. '
+                         'If 0, all the ROIs are saved in the output, updated in streaming.')
+    oGroup.addParam('rankWeights', params.StringParam, label='Ranking weights: ', default='', condition='topK>0',
+                    help='Weights of the evaluator scores in the combined ranking score, as "evaluatorName: weight" '
+                         'separated by commas (e.g. "IL4pred-1: 1, IFNepitope-1: 0.5"). Use negative weights for '
+                         'scores where lower is better. The evaluators not included get weight 1.')
+    oGroup.addParam('rankVetoes', params.StringParam, label='Ranking vetoes: ', default='', condition='topK>0',
+                    help='Conditions discarding a ROI from the ranking, as "evaluatorName > value" (or <, >=, <=) '
+                         'separated by commas (e.g. "ToxinPred-1 > 0, AlgPred2-1 > 0.3" to discard the toxic or '
+                         'allergenic epitopes).')
+    oGroup.addParam('saveScoreMatrix', params.BooleanParam, label='Save full score matrix: ', default=False,
+                    condition='topK>0',
+                    help='Save the scores of all the evaluated ROIs in a tsv file in the protocol extra folder.')
+
     form.addParallelSection(threads=4, mpi=1)
 
 
   def _insertAllSteps(self):
-    self._insertFunctionStep(self.evaluationStep)
+    if self.distributeUnits.get():
+      nUnits = len(self.getEvaluationUnits())
+      cStep = self._insertFunctionStep(self.convertUnitsStep, nUnits)
+      uSteps = []
+      for unitIdx in range(nUnits):
+        uSteps.append(self._insertFunctionStep(self.unitStep, unitIdx, prerequisites=[cStep]))
+      self._insertFunctionStep(self.gatherUnitsStep, prerequisites=uSteps)
+    else:
+      self._insertFunctionStep(self.evaluationStep)
+
+  def convertUnitsStep(self, nUnits):
+    '''Writes the work units, built once here and read back by the unit and gather steps'''
+    units = self.getEvaluationUnits()
+    if len(units) != nUnits:
+      raise ValueError(f'The input ROIs changed since the {nUnits} evaluation jobs were created ({len(units)} units '
+                       f'now): run the protocol again')
+    with open(self.getUnitsFile(), 'w') as f:
+      json.dump(units, f)
+
+    sequences = self.getInputSequences(idKeys=True)
+    browserData, timeout = iiitdPlugin.getBrowserData(), self.requestTimeout.get() * 60
+    for unitIdx, unit in enumerate(units):
+      writeUnitFile(self.getUnitFile(unitIdx), unit, sequences, browserData, timeout,
+                    healthProbe=self.maxFailures.get() > 0)
+
+  def unitStep(self, unitIdx):
+    # Run as a job so that the MPI or queue executor can send it to any host
+    args = f'-m immuno.utils.unitRunner {self.getUnitFile(unitIdx)} {self.getUnitScoresFile(unitIdx)} ' \
+           f'{self.getMetricsFile()}'
+    self.runJob(sys.executable, args)
+
+  def gatherUnitsStep(self):
+    with open(self.getUnitsFile()) as f:
+      units = json.load(f)
+    unitScores = {}
+    for unitIdx in range(len(units)):
+      with open(self.getUnitScoresFile(unitIdx)) as f:
+        unitScores[unitIdx] = json.load(f)
+
+    # The scores are merged in chunk order
+    chunkKeys = {unit['chunk']: unit['seqKeys'] for unit in units}
+    roiIds = [roiId for chunk in sorted(chunkKeys) for roiId in chunkKeys[chunk]]
+    unitIds = set(roiIds)
+    self.inROIs = {roi.getObjId(): roi.clone() for roi in self.inputROIs.get() if roi.getObjId() in unitIds}
+    self.publishEvaluatedROIs(roiIds, mergeUnitScores(units, unitScores))
+    self.closeOutputROIs()
 
   def evaluationStep(self):
+    '''Evaluates the input ROIs as they arrive: while the input set is open in streaming, the new ROIs are evaluated
+    and appended to the output, until the input set is closed and all its ROIs have been evaluated'''
     nt = self.numberOfThreads.get()
     sDics = self.getWebEvaluatorDics()
-    sequences = self.getInputSequences()
-
-    epiDic = iiitdPlugin.performEvaluations(sequences, sDics, nt, iiitdPlugin.getBrowserData())
-
-    outROIs = SetOfSequenceROIs(filename=self._getPath('sequenceROIs.sqlite'))
-    for i, roi in enumerate(self.inputROIs.get()):
-      for (evalKey, softName), scores in epiDic.items():
+    memMonitor = MemoryMonitor()
+    memMonitor.start()
+    self.inROIs = {}
+    deadline = time.time() + self.timeBudget.get() * 60 if self.timeBudget.get() > 0 else None
+    # The top-k output is only written at the end, so all the ROIs are evaluated again if the protocol is continued,
+    # the output being written from scratch
+    evaluatedIds = self.getOutputROIIds() if not self.isTopKMode() else set()
+    if self.isTopKMode():
+      for outFile in [self.getOutputFile(), self.getScoreMatrixFile()]:
+        if os.path.exists(outFile):
+          os.remove(outFile)
+
+    try:
+      while True:
+        inputClosed, newROIs = self.getNewInputROIs(evaluatedIds)
+        if newROIs:
+          self.inROIs.update(newROIs)
+          evaluatedIds.update(newROIs.keys())
+          sequences = {roiId: roi.getROISequence() for roiId, roi in newROIs.items()}
+          priorities = {roiId: self.getROIPriority(roi) for roiId, roi in newROIs.items()} if deadline else None
+
+          # The output ROIs are published in streaming as each chunk is evaluated
+          iiitdPlugin.performEvaluations(sequences, sDics, nt, iiitdPlugin.getBrowserData(),
+                                         sweep=self.sweepEvals.get(), chunkSize=self.chunkSize.get(),
+                                         onChunk=self.publishEvaluatedROIs, timeout=self.requestTimeout.get() * 60,
+                                         hedgePercentile=self.hedgePercentile.get(), metricsFile=self.getMetricsFile(),
+                                         historyFile=iiitdPlugin.getLatencyHistoryFile(),
+                                         memoryBudget=self.memoryBudget.get() * 1024,
+                                         maxFailures=self.maxFailures.get(), priorities=priorities,
+                                         timeBudget=deadline - time.time() if deadline else None, keepPools=True)
+        elif inputClosed:
+          break
+        else:
+          time.sleep(self._inputCheckTime)
+    finally:
+      closeWorkerPools()
+    logMetric(self.getMetricsFile(), 'memory', peakMB=memMonitor.stop())
+    self.closeOutputROIs()
+
+  def closeOutputROIs(self):
+    if self.isTopKMode():
+      self.publishTopROIs()
+    if os.path.exists(self.getOutputFile()):
+      self._updateOutputSet('outputROIs', self.loadOutputROIs(), Set.STREAM_CLOSED)
+      self.exportScoreArrays()
+    self.writeCoverageReport()
+
+  def publishEvaluatedROIs(self, roiIds, scoresDic):
+    '''Appends a chunk of evaluated ROIs to the output and updates it in streaming. In top-k mode, the ROIs are ranked
+    instead and the output is written at the end (see publishTopROIs)
+    :param roiIds: list with the ids of the evaluated input ROIs
+    :param scoresDic: {(evalKey, softName): [scores]}, with the scores in the order of roiIds
+    '''
+    self.updateCoverage(scoresDic)
+    if self.isTopKMode():
+      if self.saveScoreMatrix.get():
+        self.writeScoreMatrix(roiIds, scoresDic)
+      self.rankEvaluatedROIs(roiIds, scoresDic)
+      return
+
+    outROIs = self.loadOutputROIs()
+    for i, roiId in enumerate(roiIds):
+      roi = self.inROIs[roiId]
+      for (evalKey, softName), scores in scoresDic.items():
         setattr(roi, evalKey, params.Float(scores[i]))
       outROIs.append(roi)
 
     if len(outROIs) > 0:
-      self._defineOutputs(outputROIs=outROIs)
+      self._updateOutputSet('outputROIs', outROIs, Set.STREAM_OPEN)
+
+
+  def updateCoverage(self, scoresDic):
+    '''Counts the evaluated (not NaN) scores of each evaluator as {evalKey: [nEvaluated, nROIs]}'''
+    if not hasattr(self, 'coverage'):
+      self.coverage = {}
+    for (evalKey, softName), scores in scoresDic.items():
+      evalCoverage = self.coverage.setdefault(evalKey, [0, 0])
+      evalCoverage[0] += len([score for score in scores if not math.isnan(toFloat(score))])
+      evalCoverage[1] += len(scores)
+
+  def writeCoverageReport(self):
+    '''Writes the fraction of ROIs evaluated by each evaluator and the ROIs left out by the time budget'''
+    skipped = getCounters(readMetrics(self.getMetricsFile())).get('skippedSequences', {})
+    lines = [f'Time budget: {self.timeBudget.get()} min' if self.timeBudget.get() > 0 else 'No time budget']
+    for evalKey, (nEvaluated, nROIs) in getattr(self, 'coverage', {}).items():
+      lines.append(f'{evalKey}: {nEvaluated} / {nROIs} ROIs evaluated ({round(100 * nEvaluated / max(1, nROIs), 1)}%)')
+    for softName, nSkipped in skipped.items():
+      lines.append(f'{softName}: {nSkipped} ROIs not evaluated within the time budget')
+    with open(self.getCoverageFile(), 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+
+  def rankEvaluatedROIs(self, roiIds, scoresDic):
+    '''Keeps the best topK ROIs in a bounded min-heap by their combined score. The ROIs out of the heap are released'''
+    if not hasattr(self, 'topHeap'):
+      self.topHeap, self.topScores = [], {}
+    weights, vetoes = self.parseRankWeights(), self.parseRankVetoes()
+
+    for i, roiId in enumerate(roiIds):
+      roiScores = {evalKey: scores[i] for (evalKey, softName), scores in scoresDic.items()}
+      rankScore = getRankScore(roiScores, weights, vetoes)
+      if rankScore is not None:
+        self.topScores[roiId] = roiScores
+        outId = pushTopK(self.topHeap, self.topK.get(), rankScore, roiId)
+        if outId is not None:
+          del self.topScores[outId]
+          self.inROIs.pop(outId, None)
+      if roiId not in self.topScores:
+        self.inROIs.pop(roiId, None)
+
+  def publishTopROIs(self):
+    '''Writes the ranked ROIs in the output, from best to worst, with their scores and combined ranking score'''
+    outROIs = self.loadOutputROIs()
+    for rankScore, negRoiId in sorted(getattr(self, 'topHeap', []), reverse=True):
+      roi = self.inROIs[-negRoiId]
+      for evalKey, score in self.topScores[-negRoiId].items():
+        setattr(roi, evalKey, params.Float(score))
+      roi._rankScore = params.Float(rankScore)
+      outROIs.append(roi)
 
+    if len(outROIs) > 0:
+      self._updateOutputSet('outputROIs', outROIs, Set.STREAM_OPEN)
+
+  def writeScoreMatrix(self, roiIds, scoresDic):
+    '''Appends the scores of a chunk of evaluated ROIs to the score matrix tsv file'''
+    matFile, evalKeys = self.getScoreMatrixFile(), [evalKey for evalKey, softName in scoresDic]
+    with open(matFile, 'a') as f:
+      if f.tell() == 0:
+        f.write('\t'.join(['ROI_id', 'ROI_sequence'] + evalKeys) + '\n')
+      for i, roiId in enumerate(roiIds):
+        scores = [str(scores[i]) for scores in scoresDic.values()]
+        f.write('\t'.join([str(roiId), self.inROIs[roiId].getROISequence()] + scores) + '\n')
 
   ##################### UTILS #####################
-  def getInputSequences(self):
+  def isTopKMode(self):
+    return self.topK.get() > 0
+
+  def getScoreMatrixFile(self):
+    return self._getExtraPath('scoreMatrix.tsv')
+
+  def parseRankWeights(self):
+    '''Returns the ranking weights as {evalKey: weight}'''
+    weights = {}
+    for wStr in self.rankWeights.get().split(','):
+      if wStr.strip():
+        evalKey, weight = wStr.rsplit(':', 1)
+        weights[evalKey.strip()] = float(weight)
+    return weights
+
+  def parseRankVetoes(self):
+    '''Returns the ranking vetoes as a list of (evalKey, operator, value)'''
+    vetoes = []
+    for vStr in self.rankVetoes.get().split(','):
+      if vStr.strip():
+        evalKey, operator, value = re.match(r'^\s*(.+?)\s*(>=|<=|>|<)\s*(\S+)\s*$', vStr).groups()
+        vetoes.append((evalKey, operator, float(value)))
+    return vetoes
+
+  def getCoverageFile(self):
+    return self._getExtraPath('coverageReport.txt')
+
+  def getROIPriority(self, roi):
+    '''Returns the selector score of a ROI (see the epitope selection protocol), so the best ROIs are evaluated first
+    in best effort mode. 0 if it has none'''
+    source = getattr(roi, '_source', None)
+    score = getattr(roi, source.get(), None) if source is not None and source.get() else None
+    value = toFloat(score.get()) if score is not None else float('nan')
+    return 0 if math.isnan(value) else value
+
+  def getNewInputROIs(self, knownIds):
+    '''Reads the current state of the input set of ROIs, which may be growing in streaming
+    :param knownIds: set with the ids of the ROIs already read
+    :return: (inputClosed, {roiId: roi}), whether the input stream was closed and its ROIs not in knownIds
+    '''
+    inROIs = self.inputROIs.get()
+    inSet = SetOfSequenceROIs(filename=inROIs.getFileName())
+    inSet.loadAllProperties()
+    # The state is read before the items, so that no item is missed if the stream is closed in between
+    inputClosed = not inSet.isStreamOpen()
+    newROIs = {roi.getObjId(): roi.clone() for roi in inSet.iterItems() if roi.getObjId() not in knownIds}
+    inSet.close()
+    return inputClosed, newROIs
+
+  def getOutputROIIds(self):
+    '''Returns the ids of the ROIs already in the output (e.g. when the protocol is continued)'''
+    if not os.path.exists(self.getOutputFile()):
+      return set()
+    outROIs = self.loadOutputROIs()
+    roiIds = {roi.getObjId() for roi in outROIs.iterItems()}
+    outROIs.close()
+    return roiIds
+
+  def getScoreKeys(self):
+    '''Returns the evaluator scores of the output ROIs exported in the score arrays, and the rank score in top-k mode'''
+    return list(self.getWebEvaluatorDics().keys()) + (['_rankScore'] if self.isTopKMode() else [])
+
+  def getParentSequencesPath(self):
+    '''ROIs stored in compact mode keep pointing to the parent sequences of the input'''
+    parentFile = getattr(self.inputROIs.get(), '_parentSequencesFile', None)
+    return parentFile.get() if parentFile is not None else None
+
+  def getInputSequences(self, idKeys=False):
     seqs = {}
     for roi in self.inputROIs.get():
-      seqs[roi.getROIId()] = roi.getROISequence()
+      seqKey = roi.getObjId() if idKeys else roi.getROIId()
+      seqs[seqKey] = roi.getROISequence()
     return seqs
 
+  def getEvaluationUnits(self):
+    '''Returns the (evaluator, chunk) work units to evaluate the input ROIs (see buildEvaluationUnits)'''
+    roiIds = [roi.getObjId() for roi in self.inputROIs.get()]
+    return buildEvaluationUnits(roiIds, self.getWebEvaluatorDics(), self.chunkSize.get(), self.sweepEvals.get())
+
+  def getUnitsFile(self):
+    return self._getExtraPath('evaluationUnits.json')
+
+  def getUnitFile(self, unitIdx):
+    return self._getExtraPath(f'evaluationUnit_{unitIdx}.json')
+
+  def getUnitScoresFile(self, unitIdx):
+    return self._getExtraPath(f'evaluationUnit_{unitIdx}_scores.json')
+
   def buildElementDic(self):
     sName, soft = self.evaluatorIIITDName.get(), self.getEnumText('chooseIIITDEvaluator')
     if not sName.strip():
       sName = self.getDefSName(soft)
 
     sDic = {sName: {'software': soft}}
-    for paramName in self._softParams[soft]:
+    for paramName in self._softParams.get(soft, []):
       sDic[sName].update({paramName: self.getParamValue(paramName)})
     return sDic
 
@@ -185,27 +527,7 @@ class ProtIIITDEvaluations(EMProtocol):
     ''' Parse the selector dictionaries included in the input list
     :return: dic, {selName: {software: softName, paramName: paramValue}} with the chosen Scipion parameters
     '''
-    sDic = {}
-    for line in self.inEvals.get().split('\n'):
-      if line.strip():
-        sd = f'{{{line.split(") ")[1]}}}'
-        sDic.update(eval(sd))
-    return sDic
-
-  def getDefSName(self, soft):
-    sDic, i = self.parseElementsDic(), 1
-    sName = f'{soft}-{i}'
-    while sName in sDic:
-      i += 1
-      sName = f'{soft}-{i}'
-    return sName
-
-  def getParamValue(self, paramName):
-    if isinstance(self.getParam(paramName), params.EnumParam):
-      value = self.getEnumText(paramName)
-    else:
-      value = getattr(self, paramName).get()
-    return value
+    return self.parseSummary(self.inEvals.get())
 
   def getWebEvaluatorDics(self):
     ''' Returns the selector dictionary with the parameter names expected by the web server
@@ -219,10 +541,30 @@ class ProtIIITDEvaluations(EMProtocol):
     vs = []
     if len(self.getWebEvaluatorDics()) < 1:
       vs.append('You need to add at least one evaluator to run the protocol')
+    for evalKey, evalDic in self.getWebEvaluatorDics().items():
+      if evalDic['software'] == 'LocalModel' and not os.path.exists(str(evalDic.get('modelFile'))):
+        vs.append(f'{evalKey}: local model file {evalDic.get("modelFile")} not found')
+
+    if self.distributeUnits.get() and self.inputROIs.get() is not None and self.inputROIs.get().isStreamOpen():
+      vs.append('The evaluation jobs cannot be distributed while the input ROIs are open in streaming: wait until the '
+                'input set is closed')
+
+    if self.isTopKMode():
+      try:
+        rankKeys = list(self.parseRankWeights()) + [evalKey for evalKey, _, _ in self.parseRankVetoes()]
+      except (ValueError, AttributeError):
+        vs.append('Ranking weights or vetoes could not be parsed, check their format in the help')
+      else:
+        for evalKey in rankKeys:
+          if evalKey not in self.getWebEvaluatorDics():
+            vs.append(f'Evaluator {evalKey} used in the ranking is not defined')
     return vs
 
   def _summary(self):
     sm = []
     if self.inEvals.get().strip():
       sm.append(self.inEvals.get())
+    if self.timeBudget.get() > 0 and os.path.exists(self.getCoverageFile()):
+      with open(self.getCoverageFile()) as f:
+        sm.append(f.read())
     return sm
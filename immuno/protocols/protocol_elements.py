@@ -0,0 +1,57 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from pyworkflow.protocol import params
+
+class ElementsFormMixin:
+  '''Form helpers shared by the protocols that define a list of selectors or evaluators with the AddIIITDElement
+  wizard. The protocols define parseElementsDic, returning the elements of their list'''
+
+  def parseSummary(self, summary):
+    ''' Parses a selectors or evaluators summary written by the AddIIITDElement wizard, with one element per line
+    :return: dic, {elementName: {software: softName, paramName: paramValue}} with the chosen Scipion parameters
+    '''
+    sDic = {}
+    for line in summary.split('\n'):
+      if line.strip():
+        sd = f'{{{line.split(") ", 1)[1]}}}'
+        sDic.update(eval(sd))
+    return sDic
+
+  def getParamValue(self, paramName):
+    if isinstance(self.getParam(paramName), params.EnumParam):
+      value = self.getEnumText(paramName)
+    else:
+      value = getattr(self, paramName).get()
+    return value
+
+  def getDefSName(self, soft):
+    sDic, i = self.parseElementsDic(), 1
+    sName = f'{soft}-{i}'
+    while sName in sDic:
+      i += 1
+      sName = f'{soft}-{i}'
+    return sName
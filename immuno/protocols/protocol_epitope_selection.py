@@ -28,22 +28,27 @@ import os
 
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol import params
+from pyworkflow.object import Set
 
-from pwchem.objects import Sequence, SequenceROI, SetOfSequenceROIs
+from pwchem.objects import Sequence, SequenceROI
 
 from immuno import Plugin as iiitdPlugin
 from ..constants import SEL_PARAM_MAP
+from ..utils import mapEvalParamNames, MemoryMonitor, logMetric
+from .protocol_rois_output import ROIsOutputMixin
+from .protocol_elements import ElementsFormMixin
 
-class ProtIIITDEpitopeSelection(EMProtocol):
+class ProtIIITDEpitopeSelection(ROIsOutputMixin, ElementsFormMixin, EMProtocol):
   """Run epitope selections on a set of protein sequences (SetOfSequences)"""
   _label = 'IIITD epitope selection'
 
-  _selectorOptions = ['ABCpred', 'LBtope']
+  _selectorOptions = ['ABCpred', 'LBtope', 'Windows']
   _lbModels = ['LBtope_Fixed', 'LBtope_Fixed_non_redundant',
                'LBtope_Variable', 'LBtope_Variable_non_redundant', 'LBtop_Confirm']
 
   _softParams = {'ABCpred': ['abcWindow', 'abcThres', 'abcFilter'],
-                 'LBtope': ['lbModel', 'lbThres', 'lbLength']}
+                 'LBtope': ['lbModel', 'lbThres', 'lbLength'],
+                 'Windows': ['winLengths', 'winStride']}
 
   def __init__(self, **kwargs):
     EMProtocol.__init__(self, **kwargs)
@@ -59,7 +64,8 @@ class ProtIIITDEpitopeSelection(EMProtocol):
     aGroup = form.addGroup('Define selector')
     aGroup.addParam('chooseSelector', params.EnumParam, choices=self._selectorOptions,
                     label='Choose selector: ', default=0,
-                    help='Epitope selection software to use.')
+                    help='Epitope selection software to use.\nWindows generates locally all the overlapping windows '
+                         'of the protein, to evaluate them exhaustively without a remote selection.')
     aGroup.addParam('selectorName', params.StringParam, label='Selector name: ',
                     default='', expertLevel=params.LEVEL_ADVANCED,
                     help='Set the name for the defined selector.')
@@ -84,6 +90,13 @@ class ProtIIITDEpitopeSelection(EMProtocol):
                     condition='chooseSelector==1 and lbModel>1',
                     help='Size of the predicted epitopes.')
 
+    aGroup.addParam('winLengths', params.StringParam, label='Window lengths: ', default='15',
+                    condition='chooseSelector==2',
+                    help='Lengths of the generated windows, separated by commas (e.g. "9, 15")')
+    aGroup.addParam('winStride', params.IntParam, label='Window stride: ', default=1,
+                    condition='chooseSelector==2',
+                    help='Number of residues between the beginning of consecutive windows')
+
     aGroup.addParam('addSel', params.LabelParam, label='Add defined selector: ',
                    help='Add defined selector to perform the epitope prediction')
 
@@ -92,6 +105,30 @@ class ProtIIITDEpitopeSelection(EMProtocol):
                    label='Selectors summary: ',
                    help='Summary of the epitope selections that will be performed')
 
+    form.addSection(label='Pipeline evaluations')
+    eGroup = form.addGroup('Evaluations')
+    eGroup.addParam('pipeEvaluations', params.BooleanParam, label='Evaluate selected epitopes: ', default=False,
+                    help='Evaluate the selected epitopes in this same protocol. The epitopes of each protein are sent '
+                         'to the evaluators as soon as they are selected, so selection and evaluation overlap.')
+    eGroup.addParam('inEvals', params.TextParam, width=70, default='', condition='pipeEvaluations',
+                    label='Evaluators summary: ',
+                    help='Summary of the epitope evaluations that will be performed, in the same format as the '
+                         'evaluators summary of the "IIITD epitope evaluations" protocol.')
+
+    form.addSection(label='Execution')
+    xGroup = form.addGroup('Execution')
+    xGroup.addParam('memoryBudget', params.FloatParam, label='Memory budget (GB): ', default=0,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Memory available for the selection and evaluation workers and their browsers (around 300 MB '
+                         'each). The number of workers is limited to fit in it and the rest of jobs wait in queue. '
+                         'If 0, no limit is applied. The peak memory used is registered in the run metrics.')
+    xGroup.addParam('compactROIs', params.BooleanParam, label='Compact ROIs storage: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Store the input protein once, in a fasta file next to the output set, instead of repeating '
+                         'it in every output ROI. The ROIs keep their epitope sequence and indices and a reference to '
+                         'the protein id, which can be resolved with getROIParentSequences. Recommended for long '
+                         'proteins or exhaustive windows selections.')
+
     form.addParallelSection(threads=4, mpi=1)
 
 
@@ -102,30 +139,83 @@ class ProtIIITDEpitopeSelection(EMProtocol):
     nt = self.numberOfThreads.get()
     sDics = self.getWebSelectorDics()
     sDics = self.addInputSequences(sDics)
+    browserData, memoryBudget = iiitdPlugin.getBrowserData(), self.memoryBudget.get() * 1024
+    memMonitor = MemoryMonitor()
+    memMonitor.start()
+    if self.compactROIs.get():
+      self.writeParentSequences()
+
+    # The output ROIs are published in streaming as the selectors (and evaluators) finish each protein
+    if self.pipeEvaluations.get():
+      iiitdPlugin.selectAndEvaluate(sDics, self.getWebEvaluatorDics(), nt, browserData, onBatch=self.publishEpitopes,
+                                    metricsFile=self.getMetricsFile(), memoryBudget=memoryBudget)
+    else:
+      iiitdPlugin.selectEpitopes(sDics, nt, browserData, onBatch=self.publishSelectorBatch,
+                                 metricsFile=self.getMetricsFile(), memoryBudget=memoryBudget)
+    logMetric(self.getMetricsFile(), 'memory', peakMB=memMonitor.stop())
+
+    if os.path.exists(self.getOutputFile()):
+      self._updateOutputSet('outputROIs', self.loadOutputROIs(), Set.STREAM_CLOSED)
+      self.exportScoreArrays()
+
+  def publishSelectorBatch(self, selKey, softName, batchDic):
+    for seqEpDic in batchDic.values():
+      self.publishEpitopes(selKey, softName, seqEpDic)
+
+  def publishEpitopes(self, selKey, softName, seqEpDic, evalScores={}):
+    '''Appends the epitopes selected on a protein to the output ROIs and updates it in streaming
+    :param seqEpDic: {'Sequence': [epitopes], 'Position': [positions], 'Score': [scores]}
+    :param evalScores: {(evalKey, softName): [scores]} with the pipeline evaluations scores of the epitopes
+    '''
+    if not seqEpDic:
+      return
+
+    inpSeq = self.getParentReference() if self.compactROIs.get() else self.inputSequence.get()
+    outROIs = self.loadOutputROIs()
+    for i, (epSeq, epIdx, epSc) in enumerate(zip(seqEpDic['Sequence'], seqEpDic['Position'], seqEpDic['Score'])):
+      idxs = [int(epIdx), int(epIdx) + len(epSeq)]
+      roiName = '{}_ROI_{}-{}'.format(selKey, *idxs)
+      roiSeq = Sequence(sequence=epSeq, name=roiName, id=roiName,
+                        description=f'{selKey} epitope')
+      seqROI = SequenceROI(sequence=inpSeq, seqROI=roiSeq, roiIdx=idxs[0], roiIdx2=idxs[1])
+      seqROI._epitopeType = params.String('B')
+      seqROI._source = params.String(softName)
+      setattr(seqROI, softName, params.Float(epSc))
+      for (evalKey, evalSoft), scores in evalScores.items():
+        setattr(seqROI, evalKey, params.Float(scores[i]))
+      outROIs.append(seqROI)
+
+    self._updateOutputSet('outputROIs', outROIs, Set.STREAM_OPEN)
+
+  ##################### UTILS #####################
+  def getScoreKeys(self):
+    '''Returns the selector and evaluator scores of the output ROIs exported in the score arrays'''
+    scoreKeys = list({selDic['software'] for selDic in self.parseElementsDic().values()})
+    if self.pipeEvaluations.get():
+      scoreKeys += list(self.getWebEvaluatorDics().keys())
+    return scoreKeys
+
+  def getParentSequencesFile(self):
+    return self._getPath('parentSequences.fa')
 
-    epiDics = iiitdPlugin.selectEpitopes(sDics, nt, iiitdPlugin.getBrowserData())
+  def getParentSequencesPath(self):
+    return self.getParentSequencesFile() if self.compactROIs.get() else None
 
+  def getParentId(self):
     inpSeq = self.inputSequence.get()
-    outROIs = SetOfSequenceROIs(filename=self._getPath(f'sequenceROIs.sqlite'))
-
-    for (selKey, softName), epiDic in epiDics.items():
-      seqEpDic = epiDic[f'seq1']
-      if seqEpDic:
-        for epSeq, epIdx, epSc in zip(seqEpDic['Sequence'], seqEpDic['Position'], seqEpDic['Score']):
-          idxs = [int(epIdx), int(epIdx) + len(epSeq)]
-          roiName = '{}_ROI_{}-{}'.format(selKey, *idxs)
-          roiSeq = Sequence(sequence=epSeq, name=roiName, id=roiName,
-                            description=f'{selKey} epitope')
-          seqROI = SequenceROI(sequence=inpSeq, seqROI=roiSeq, roiIdx=idxs[0], roiIdx2=idxs[1])
-          seqROI._epitopeType = params.String('B')
-          seqROI._source = params.String(softName)
-          setattr(seqROI, softName, params.Float(epSc))
-          outROIs.append(seqROI)
-
-    if len(outROIs) > 0:
-      self._defineOutputs(**{f'outputROIs': outROIs})
+    return inpSeq.getId() or inpSeq.getSeqName()
+
+  def getParentReference(self):
+    '''Returns the light sequence attached to the ROIs in compact mode, with only the id of the protein stored in
+    the parent sequences file'''
+    parentId = self.getParentId()
+    return Sequence(id=parentId, name=parentId)
+
+  def writeParentSequences(self):
+    '''Writes the input protein once, referenced by its id from the ROIs stored in compact mode'''
+    with open(self.getParentSequencesFile(), 'w') as f:
+      f.write(f'>{self.getParentId()}\n{self.inputSequence.get().getSequence()}\n')
 
-  ##################### UTILS #####################
   def addInputSequences(self, sDics):
     faFile = self._getExtraPath('inputSequence.fa')
     self.inputSequence.get().exportToFile(faFile)
@@ -147,12 +237,7 @@ class ProtIIITDEpitopeSelection(EMProtocol):
     ''' Parse the selector dictionaries included in the input list
     :return: dic, {selName: {software: softName, paramName: paramValue}} with the chosen Scipion parameters
     '''
-    sDic = {}
-    for line in self.inSels.get().split('\n'):
-      if line.strip():
-        sd = f'{{{line.split(")")[1]}}}'
-        sDic.update(eval(sd))
-    return sDic
+    return self.parseSummary(self.inSels.get())
 
   def getWebSelectorDics(self):
     ''' Returns the selector dictionary with the parameter names expected by the web server
@@ -169,25 +254,30 @@ class ProtIIITDEpitopeSelection(EMProtocol):
     return wsDic
 
 
-  def getParamValue(self, paramName):
-    if isinstance(self.getParam(paramName), params.EnumParam):
-      value = self.getEnumText(paramName)
-    else:
-      value = getattr(self, paramName).get()
-    return value
+  def parseEvaluatorsDic(self):
+    ''' Parse the evaluator dictionaries included in the pipeline evaluators list
+    :return: dic, {evalName: {software: softName, paramName: paramValue}} with the chosen Scipion parameters
+    '''
+    return self.parseSummary(self.inEvals.get())
 
-  def getDefSName(self, soft):
-    sDic, i = self.parseElementsDic(), 1
-    sName = f'{soft}-{i}'
-    while sName in sDic:
-      i += 1
-      sName = f'{soft}-{i}'
-    return sName
+  def getWebEvaluatorDics(self):
+    ''' Returns the pipeline evaluators dictionary with the parameter names expected by the web server
+    :return: dic, {evalName: {software: softName, paramName: paramValue}} with the webserver chosen parameters
+    '''
+    return mapEvalParamNames(self.parseEvaluatorsDic())
 
   def _validate(self):
     vs = []
     if len(self.getWebSelectorDics()) < 1:
       vs.append('You need to add at least one selector to run the protocol')
+    for sName, selDic in self.getWebSelectorDics().items():
+      if selDic['software'] == 'Windows':
+        lengths = [length.strip() for length in str(selDic['winLengths']).split(',') if length.strip()]
+        if not lengths or not all([length.isdigit() and int(length) > 0 for length in lengths]) or \
+                int(selDic['winStride']) < 1:
+          vs.append(f'{sName}: window lengths must be positive integers separated by commas and stride at least 1')
+    if self.pipeEvaluations.get() and len(self.getWebEvaluatorDics()) < 1:
+      vs.append('You need to add at least one evaluator to pipeline the evaluations')
     return vs
 
   def _summary(self):
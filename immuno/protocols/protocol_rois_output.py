@@ -0,0 +1,81 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+from pyworkflow.protocol import params
+from pyworkflow.object import Set
+
+from pwchem.objects import SetOfSequenceROIs
+
+from ..utils import writeScoreArrays
+
+class ROIsOutputMixin:
+  '''Output files and streaming set of ROIs shared by the protocols that publish a SetOfSequenceROIs.
+  The protocols define getScoreKeys, with the ROI attributes exported in the score arrays, and
+  getParentSequencesPath, with the parent sequences file of the ROIs stored in compact mode (or None)'''
+
+  def getScoreKeys(self):
+    return []
+
+  def getParentSequencesPath(self):
+    return None
+
+  def getOutputFile(self):
+    return self._getPath('sequenceROIs.sqlite')
+
+  def getMetricsFile(self):
+    return self._getExtraPath('runMetrics.jsonl')
+
+  def getScoreArraysFiles(self):
+    '''Returns the score matrix (.npy) and index (.npz) files exported next to the output set'''
+    return self._getPath('outputScores.npy'), self._getPath('outputScores_index.npz')
+
+  def loadOutputROIs(self):
+    '''Returns the output set of ROIs, opened to append new elements in streaming'''
+    outFile = self.getOutputFile()
+    outROIs = SetOfSequenceROIs(filename=outFile)
+    if os.path.exists(outFile):
+      outROIs.loadAllProperties()
+      outROIs.enableAppend()
+    else:
+      outROIs.setStreamState(Set.STREAM_OPEN)
+      parentFile = self.getParentSequencesPath()
+      if parentFile is not None:
+        outROIs._parentSequencesFile = params.String(parentFile)
+    return outROIs
+
+  def exportScoreArrays(self):
+    '''Writes the output ROIs scores as a memory-mappable matrix next to the output set (see writeScoreArrays)'''
+    scoreKeys = self.getScoreKeys()
+    roiIds, positions, scoreColumns = [], [], {scoreKey: [] for scoreKey in scoreKeys}
+    for roi in self.outputROIs:
+      roiIds.append(roi.getObjId())
+      positions.append((roi.getROIIdx(), roi.getROIIdx2()))
+      for scoreKey in scoreKeys:
+        score = getattr(roi, scoreKey, None)
+        scoreColumns[scoreKey].append(score.get() if score is not None else None)
+    writeScoreArrays(*self.getScoreArraysFiles(), roiIds, positions, scoreColumns)
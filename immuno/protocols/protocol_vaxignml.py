@@ -0,0 +1,142 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, glob
+
+from pwem.protocols import EMProtocol
+from pwem.objects import SetOfSequences
+from pyworkflow.protocol import params, STEPS_PARALLEL
+
+from .. import Plugin as immunoPlugin
+from ..utils import divide_chunks, parseVaxignMLResults
+
+class ProtVaxignML(EMProtocol):
+  """Run Vaxign-ML protective antigen prediction on a set of protein sequences (SetOfSequences).
+  The proteins are evaluated in batches, running several Vaxign-ML containers in parallel."""
+  _label = 'Vaxign-ML antigen prediction'
+
+  _organisms = ['Gram+', 'Gram-', 'Virus']
+
+  def __init__(self, **kwargs):
+    EMProtocol.__init__(self, **kwargs)
+    self.stepsExecutionMode = STEPS_PARALLEL
+
+  def _defineParams(self, form):
+    form.addSection(label='Input')
+    iGroup = form.addGroup('Input')
+    iGroup.addParam('inputSequences', params.PointerParam, pointerClass="SetOfSequences, Sequence",
+                    label='Input sequences: ',
+                    help="Input protein sequences to evaluate with Vaxign-ML")
+    iGroup.addParam('organism', params.EnumParam, choices=self._organisms, default=1,
+                    label='Organism type: ', display=params.EnumParam.DISPLAY_HLIST,
+                    help='Type of organism the query proteins come from')
+
+    bGroup = form.addGroup('Execution')
+    bGroup.addParam('batchSize', params.IntParam, label='Proteins per batch: ', default=100,
+                    help='Number of proteins evaluated on each Vaxign-ML run. Bigger batches amortize the container '
+                         'startup, smaller batches distribute better among the threads.')
+    bGroup.addParam('vaxignCommand', params.StringParam, label='Vaxign-ML command: ', default='',
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Command used to run Vaxign-ML. It is called as "<command> -i <inputFasta> -o <outputDir> '
+                         '-t <organism>". By default, the VaxignML.sh docker launcher installed with the plugin.')
+
+    form.addParallelSection(threads=4, mpi=1)
+
+
+  def _insertAllSteps(self):
+    cStep = self._insertFunctionStep(self.convertStep)
+    vSteps = []
+    for batchIdx in range(len(self.getBatches())):
+      vSteps.append(self._insertFunctionStep(self.vaxignStep, batchIdx, prerequisites=[cStep]))
+    self._insertFunctionStep(self.createOutputStep, prerequisites=vSteps)
+
+  def convertStep(self):
+    for batchIdx, batch in enumerate(self.getBatches()):
+      with open(self.getBatchFasta(batchIdx), 'w') as f:
+        for seqKey, seqStr in batch:
+          f.write(f'>{seqKey}\n{seqStr}\n')
+
+  def vaxignStep(self, batchIdx):
+    # Absolute paths, since the job runs in the extra directory and the docker launcher mounts them
+    outDir = os.path.abspath(self.getBatchOutDir(batchIdx))
+    os.makedirs(outDir, exist_ok=True)
+    args = f'-i {os.path.abspath(self.getBatchFasta(batchIdx))} -o {outDir} ' \
+           f'-t {self.getEnumText("organism").lower()}'
+    self.runJob(self.getVaxignCommand(), args, cwd=self._getExtraPath())
+
+  def createOutputStep(self):
+    resDic = {}
+    for batchIdx in range(len(self.getBatches())):
+      for resFile in glob.glob(os.path.join(self.getBatchOutDir(batchIdx), '*.tsv')):
+        resDic.update(parseVaxignMLResults(resFile))
+
+    outSeqs = SetOfSequences(filename=self._getPath('sequences.sqlite'))
+    for seq in self.getInputSequences():
+      seqKey = self.getSeqKey(seq)
+      if seqKey in resDic:
+        newSeq = seq.clone()
+        for attrName, value in resDic[seqKey].items():
+          setattr(newSeq, attrName, params.Float(value))
+        outSeqs.append(newSeq)
+
+    if len(outSeqs) > 0:
+      self._defineOutputs(outputSequences=outSeqs)
+      self._defineSourceRelation(self.inputSequences, outSeqs)
+
+  ##################### UTILS #####################
+  def getInputSequences(self):
+    inSeqs = self.inputSequences.get()
+    return inSeqs if isinstance(inSeqs, SetOfSequences) else [inSeqs]
+
+  def getSeqKey(self, seq):
+    '''Sequence name written in the Vaxign-ML fasta inputs. The object id is used to avoid problematic characters'''
+    return f'seq{seq.getObjId()}'
+
+  def getBatches(self):
+    seqs = [(self.getSeqKey(seq), seq.getSequence()) for seq in self.getInputSequences()]
+    return divide_chunks(seqs, max(1, self.batchSize.get()))
+
+  def getBatchFasta(self, batchIdx):
+    return self._getExtraPath(f'vaxignInput_{batchIdx}.fasta')
+
+  def getBatchOutDir(self, batchIdx):
+    return self._getExtraPath(f'vaxignOutput_{batchIdx}')
+
+  def getVaxignCommand(self):
+    command = self.vaxignCommand.get()
+    return command.strip() if command and command.strip() else immunoPlugin.getVaxignMLCommand()
+
+  def _validate(self):
+    vs = []
+    if self.batchSize.get() < 1:
+      vs.append('The number of proteins per batch must be at least 1')
+    return vs
+
+  def _summary(self):
+    sm = []
+    if hasattr(self, 'outputSequences'):
+      sm.append(f'{len(self.outputSequences)} proteins evaluated with Vaxign-ML')
+    return sm
@@ -30,18 +30,18 @@ from pwem.protocols import ProtImportSequence
 
 from pwchem.utils import assertHandle
 
-from .test_iiitd_selection import TestIIITDSelection
+from .test_iiitd_selection import TestImmunoBase
 from ..protocols import ProtIIITDEvaluations
 from ..constants import EVALSUM
 
-class TestIIITDEvaluation(TestIIITDSelection):
+class TestIIITDEvaluation(TestImmunoBase):
 	NAME = 'USER_SEQ'
 	DESCRIPTION = 'User description'
 	AMINOACIDSSEQ1 = 'MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHFDLSHGSAQVKGHG'
 
-	def _runIIITDEvaluation(self, protSel):
+	def _runIIITDEvaluation(self, protSel, **kwargs):
 		protEval = self.newProtocol(ProtIIITDEvaluations,
-															 inEvals=EVALSUM)
+															 inEvals=EVALSUM, **kwargs)
 
 		protEval.inputROIs.set(protSel)
 		protEval.inputROIs.setExtended('outputROIs')
@@ -55,3 +55,10 @@ class TestIIITDEvaluation(TestIIITDSelection):
 		protEval = self._runIIITDEvaluation(protSel)
 		self._waitOutput(protEval, 'outputROIs', sleepTime=10)
 		assertHandle(self.assertIsNotNone, getattr(protEval, 'outputROIs', None))
+
+	def testDistributed(self):
+		protSel = self._runIIITDSelection(wait=True)
+		protEval = self._runIIITDEvaluation(protSel, distributeUnits=True, chunkSize=10,
+																				numberOfThreads=3, numberOfMpi=3)
+		self._waitOutput(protEval, 'outputROIs', sleepTime=10)
+		assertHandle(self.assertIsNotNone, getattr(protEval, 'outputROIs', None))
@@ -31,9 +31,11 @@ from pwem.protocols import ProtImportSequence
 from pwchem.utils import assertHandle
 
 from ..protocols import ProtIIITDEpitopeSelection
-from ..constants import SELSUM
+from ..constants import SELSUM, WINSUM
 
-class TestIIITDSelection(BaseTest):
+class TestImmunoBase(BaseTest):
+	'''Common fixture of the immuno tests: imports the test sequence. It has no tests, so the suites subclassing it only
+	run their own'''
 	NAME = 'USER_SEQ'
 	DESCRIPTION = 'User description'
 	AMINOACIDSSEQ1 = 'MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHFDLSHGSAQVKGHG'
@@ -58,17 +60,24 @@ class TestIIITDSelection(BaseTest):
 			ProtImportSequence, **kwargs)
 		cls.proj.launchProtocol(cls.protImportSeq, wait=False)
 
-	def _runIIITDSelection(self):
+	def _runIIITDSelection(self, wait=False, inSels=SELSUM):
 		protSel = self.newProtocol(ProtIIITDEpitopeSelection,
-																		inSels=SELSUM)
+																		inSels=inSels)
 
 		protSel.inputSequence.set(self.protImportSeq)
 		protSel.inputSequence.setExtended('outputSequence')
 
-		self.proj.launchProtocol(protSel, wait=False)
+		self.proj.launchProtocol(protSel, wait=wait)
 		return protSel
 
+class TestIIITDSelection(TestImmunoBase):
 	def test(self):
 		protSel = self._runIIITDSelection()
 		self._waitOutput(protSel, 'outputROIs', sleepTime=10)
 		assertHandle(self.assertIsNotNone, getattr(protSel, 'outputROIs', None))
+
+	def testWindows(self):
+		# Windows are generated locally: 60 - 15 + 1 = 46 windows, all of them different
+		protSel = self._runIIITDSelection(wait=True, inSels=WINSUM)
+		assertHandle(self.assertIsNotNone, getattr(protSel, 'outputROIs', None))
+		assertHandle(self.assertEqual, protSel.outputROIs.getSize(), 46)
@@ -0,0 +1,329 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, math, time, tempfile, unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from pyworkflow.object import Integer
+
+from ..protocols import ProtIIITDEvaluations
+from ..protocols.protocol_elements import ElementsFormMixin
+from ..constants import STANDARD_AAS
+from ..utils import registry
+from ..utils.broker import RequestBroker
+from ..utils import pushTopK, buildEvaluationUnits, mergeUnitScores, evaluateSequences, CircuitBreaker, \
+	getBalancedChunkSize, sortUnitsLPT, splitSequences, getFragmentsMapper, updateFragmentsDic, fillInvalidScores, \
+	writeScoreArrays, parseVaxignMLResults, getAACFeatures, getDPCFeatures, registerWebEvaluator, closeWorkerPools, \
+	loadLatencyHistory, updateLatencyHistory
+
+STUB_SOFT = 'StubServer'
+
+def stubCallWebSoftware(softName, sequences, browserData={}, data={}, onBatch=None, metricsFile=None):
+	'''Scores the sequences of the stub web evaluator by their length, with no web server. The rest of the softwares
+	are requested normally'''
+	if softName != STUB_SOFT:
+		return _callWebSoftware(softName, sequences, browserData, data, onBatch=onBatch, metricsFile=metricsFile)
+	return {'Score': [len(seq) / 10 for seq in sequences.values()]}
+
+# Registered on import, so the pool workers also have the stub when they import this module (see ensureRegistered)
+registerWebEvaluator(STUB_SOFT)
+_callWebSoftware, registry.callWebSoftware = registry.callWebSoftware, stubCallWebSoftware
+
+class TestTopKRanking(unittest.TestCase):
+	'''Local tests of the top-k ranking of the evaluated ROIs, no web server needed'''
+	def _getRanker(self, topK, vetoes=[]):
+		'''Object with the attributes used by ProtIIITDEvaluations.rankEvaluatedROIs'''
+		return SimpleNamespace(topK=Integer(topK), inROIs={roiId: f'roi{roiId}' for roiId in range(1, 7)},
+													 parseRankWeights=lambda: {'tox': -1}, parseRankVetoes=lambda: vetoes)
+
+	def testPushTopK(self):
+		topHeap, outIds = [], []
+		for itemId, score in [(1, 0.5), (2, 0.9), (3, 0.1), (4, 0.9), (5, 0.7)]:
+			outIds.append(pushTopK(topHeap, 2, score, itemId))
+		self.assertEqual(outIds, [None, None, 3, 1, 5])
+		self.assertEqual(sorted([-negId for _, negId in topHeap]), [2, 4])
+
+	def testPushTopKTies(self):
+		# With equal scores, the lowest ids are kept
+		topHeap = []
+		outIds = [pushTopK(topHeap, 2, 1.0, itemId) for itemId in [3, 1, 2]]
+		self.assertEqual(outIds, [None, None, 3])
+
+	def testRankEvaluatedROIs(self):
+		ranker = self._getRanker(2, vetoes=[('tox', '>', 0.8)])
+		# Rank score: antigen - toxicity. ROI 2 has the best antigen score but is vetoed by its toxicity
+		scoresDic = {('antigen', 'LocalModel'): [0.5, 0.99, 0.7, 0.6, float('nan'), 0.2],
+								 ('tox', 'ToxinPred'): [0.1, 0.9, 0.1, 0.3, float('nan'), 0.5]}
+		ProtIIITDEvaluations.rankEvaluatedROIs(ranker, [1, 2, 3, 4], {k: v[:4] for k, v in scoresDic.items()})
+		ProtIIITDEvaluations.rankEvaluatedROIs(ranker, [5, 6], {k: v[4:] for k, v in scoresDic.items()})
+
+		self.assertEqual(sorted(ranker.topScores.keys()), [1, 3])
+		self.assertEqual(sorted([-negId for _, negId in ranker.topHeap]), [1, 3])
+		# The ROIs out of the ranking (vetoed, without scores or worse) are released
+		self.assertEqual(sorted(ranker.inROIs.keys()), [1, 3])
+
+
+class TestElementsSummary(unittest.TestCase):
+	'''Local test of the selectors and evaluators summary parsing shared by the protocols'''
+	def testParseSummary(self):
+		summary = '1) "ToxinPred-1": {\'software\': \'ToxinPred\', \'toxinSVMMethod\': \'SVM(Swiss-Prot) + Motif\'}\n\n' \
+							'2) "LBtope-1": {\'software\': \'LBtope\', \'lbThres\': 60}\n'
+		self.assertEqual(ElementsFormMixin().parseSummary(summary),
+										 {'ToxinPred-1': {'software': 'ToxinPred', 'toxinSVMMethod': 'SVM(Swiss-Prot) + Motif'},
+											'LBtope-1': {'software': 'LBtope', 'lbThres': 60}})
+
+
+class TestEvaluationScheduling(unittest.TestCase):
+	'''Local tests of the work units scheduling of the evaluations'''
+	evalDics = {'tox1': {'software': 'ToxinPred', 'method': '1'}, 'tox2': {'software': 'ToxinPred', 'method': '2'},
+							'alg': {'software': 'AlgPred2'}, 'unknown': {'software': 'NotRegistered'}}
+
+	def testBuildEvaluationUnits(self):
+		units = buildEvaluationUnits(list(range(5)), self.evalDics, chunkSize=2)
+		# 3 chunks x 3 registered evaluators, the unregistered ones are skipped
+		self.assertEqual(len(units), 9)
+		self.assertEqual([unit['seqKeys'] for unit in units if unit['evals'] == {'alg': {}}], [[0, 1], [2, 3], [4]])
+		self.assertEqual(units[0]['entry']['kind'], 'web')
+
+		sweepUnits = buildEvaluationUnits(list(range(5)), self.evalDics, chunkSize=None, sweep=True)
+		self.assertEqual([(unit['software'], list(unit['evals'])) for unit in sweepUnits],
+										 [('ToxinPred', ['tox1', 'tox2']), ('AlgPred2', ['alg'])])
+
+	def testMergeUnitScores(self):
+		units = buildEvaluationUnits(list(range(5)), {'alg': {'software': 'AlgPred2'}}, chunkSize=2)
+		# Units finished out of order are merged in chunk order
+		unitScores = {2: {'alg': [4]}, 0: {'alg': [0, 1]}, 1: {'alg': [2, 3]}}
+		self.assertEqual(mergeUnitScores(units, unitScores), {('alg', 'AlgPred2'): [0, 1, 2, 3, 4]})
+
+	def testEvaluateNoSequences(self):
+		# No units with an empty chunk
+		self.assertEqual(buildEvaluationUnits([], self.evalDics), [])
+		self.assertEqual(evaluateSequences({}, self.evalDics), {('tox1', 'ToxinPred'): [], ('tox2', 'ToxinPred'): [],
+																														('alg', 'AlgPred2'): []})
+
+	def testCircuitBreaker(self):
+		breaker = CircuitBreaker(maxFailures=2)
+		self.assertFalse(breaker.recordFailure('ToxinPred', 'error'))
+		breaker.recordSuccess('ToxinPred')
+		# Only the consecutive failures count
+		self.assertFalse(breaker.recordFailure('ToxinPred', 'error'))
+		self.assertTrue(breaker.recordFailure('ToxinPred', 'timeout'))
+		self.assertTrue(breaker.isTripped('ToxinPred'))
+		self.assertFalse(breaker.recordFailure('ToxinPred', 'error'))
+		self.assertFalse(breaker.isTripped('AlgPred2'))
+
+		noBreaker = CircuitBreaker(maxFailures=0)
+		self.assertFalse(any([noBreaker.recordFailure('ToxinPred', 'error') for _ in range(5)]))
+
+	def testBalancedChunkSize(self):
+		latencies = {'ToxinPred': 1, 'AlgPred2': 2}
+		self.assertEqual(getBalancedChunkSize(600, latencies, 4, 100), 75)
+		self.assertEqual(getBalancedChunkSize(600, latencies, 4, 50), 50)
+		# Kept over the minimum chunk size, unless the maximum is smaller
+		self.assertEqual(getBalancedChunkSize(30, latencies, 4, 100), 10)
+		self.assertEqual(getBalancedChunkSize(30, latencies, 4, 5), 5)
+
+	def testLatencyHistory(self):
+		historyFile = os.path.join(tempfile.mkdtemp(), 'cache', 'latencyHistory.json')
+		self.assertEqual(loadLatencyHistory(historyFile), {})
+		updateLatencyHistory(historyFile, {'ToxinPred': [1, 2]}, maxHistory=3)
+		updateLatencyHistory(historyFile, {'ToxinPred': [3, 4], 'AlgPred2': [5]}, maxHistory=3)
+		self.assertEqual(loadLatencyHistory(historyFile), {'ToxinPred': [2, 3, 4], 'AlgPred2': [5]})
+
+		# An unreadable history is ignored and replaced by the next update
+		with open(historyFile, 'w') as f:
+			f.write('{"ToxinPred": [2, ')
+		self.assertEqual(loadLatencyHistory(historyFile), {})
+		updateLatencyHistory(historyFile, {'ToxinPred': [6]})
+		self.assertEqual(loadLatencyHistory(historyFile), {'ToxinPred': [6]})
+		self.assertEqual(sorted(os.listdir(os.path.dirname(historyFile))),
+										 ['latencyHistory.json', 'latencyHistory.json.lock'])
+
+	def testSortUnitsLPT(self):
+		units = [{'software': 'ToxinPred', 'seqKeys': [0, 1, 2]}, {'software': 'AlgPred2', 'seqKeys': [0, 1]},
+						 {'software': 'ToxinPred', 'seqKeys': [3]}]
+		sortedUnits = sortUnitsLPT(units, {'ToxinPred': 1, 'AlgPred2': 2})
+		self.assertEqual([(unit['software'], len(unit['seqKeys'])) for unit in sortedUnits],
+										 [('AlgPred2', 2), ('ToxinPred', 3), ('ToxinPred', 1)])
+
+
+class TestPoolEvaluation(unittest.TestCase):
+	'''Evaluation of a stub web evaluator in the worker pool, whose scores are returned through shared memory'''
+	def tearDown(self):
+		closeWorkerPools()
+
+	def testEvaluateSequences(self):
+		sequences = {f'seq{i}': 'A' * (i + 1) for i in range(7)}
+		scoresDic = evaluateSequences(sequences, {'stub': {'software': STUB_SOFT}}, jobs=2, chunkSize=3, verbose=False,
+																	maxFailures=0)
+		self.assertEqual(scoresDic, {('stub', STUB_SOFT): [(i + 1) / 10 for i in range(7)]})
+
+
+class FakeRequest:
+	'''Request of the fake broker pool, scoring the sequences by their length once finished'''
+	def __init__(self, args):
+		self.sequences, self.deadline, self.finished = args[1], args[4], False
+
+	def ready(self):
+		return self.finished
+
+	def get(self):
+		return {'Score': [len(seq) for seq in self.sequences.values()]}
+
+
+class FakePool:
+	'''Pool of the request broker that keeps the requests until they are finished by the test'''
+	def __init__(self):
+		self.requests = []
+
+	def apply_async(self, func, args):
+		self.requests.append(FakeRequest(args))
+		return self.requests[-1]
+
+	def finishAll(self):
+		for request in self.requests:
+			request.finished = True
+
+
+class TestRequestBroker(unittest.TestCase):
+	'''Local tests of the coalescing, eviction and ticket expiry of the request broker, with no workers'''
+	def _getBroker(self, **kwargs):
+		self.pool = FakePool()
+		return RequestBroker(browserData={}, pool=self.pool, **kwargs)
+
+	def testCoalescing(self):
+		broker = self._getBroker()
+		ticket1, hits1 = broker.submit('ToxinPred', ['AA', 'CCC'])
+		ticket2, hits2 = broker.submit('ToxinPred', ['CCC', 'DDDD', 'DDDD'])
+		# Other parameters are a different request
+		_, hits3 = broker.submit('ToxinPred', ['AA'], {'method': 'SVM'})
+		# CCC is in flight and DDDD requested once
+		self.assertEqual((hits1, hits2, hits3), (0, 2, 0))
+		self.assertEqual([list(request.sequences.values()) for request in self.pool.requests],
+										 [['AA', 'CCC'], ['DDDD'], ['AA']])
+
+		self.assertEqual(broker.poll(ticket1), (False, None))
+		self.pool.finishAll()
+		self.assertEqual(broker.poll(ticket1), (True, [2, 3]))
+		self.assertEqual(broker.poll(ticket2), (True, [3, 4, 4]))
+		# Polled tickets and finished requests are released
+		self.assertEqual(broker.getStats()['inFlight'], 0)
+		self.assertRaises(KeyError, broker.poll, ticket1)
+		_, hits = broker.submit('ToxinPred', ['AA'])
+		self.assertEqual(hits, 0)
+
+	def testDeadlines(self):
+		broker, now = self._getBroker(requestTimeout=None), time.time()
+		broker.submit('ToxinPred', ['AA'], deadline=now + 10)
+		# Not joined by requesters waiting longer, which would get its timeout
+		_, hitsLonger = broker.submit('ToxinPred', ['AA'], deadline=now + 100)
+		_, hitsNone = broker.submit('ToxinPred', ['AA'])
+		_, hitsShorter = broker.submit('ToxinPred', ['AA'], deadline=now + 50)
+		self.assertEqual((hitsLonger, hitsNone, hitsShorter), (0, 0, 1))
+		self.assertEqual([request.deadline for request in self.pool.requests], [now + 10, now + 100, None])
+
+		cappedBroker = self._getBroker(requestTimeout=60)
+		cappedBroker.submit('ToxinPred', ['AA'])
+		self.assertAlmostEqual(self.pool.requests[0].deadline, time.time() + 60, delta=5)
+
+	def testTicketExpiry(self):
+		broker = self._getBroker(ticketTTL=0.01)
+		ticket, _ = broker.submit('ToxinPred', ['AA'])
+		cancelled, _ = broker.submit('ToxinPred', ['CCC'])
+		broker.cancel(cancelled)
+		self.assertRaises(KeyError, broker.poll, cancelled)
+
+		self.pool.finishAll()
+		broker.getStats()
+		time.sleep(0.05)
+		# Not polled in time after being ready
+		stats = broker.getStats()
+		self.assertEqual((stats['tickets'], stats['inFlight'], stats['expiredTickets']), (0, 0, 1))
+		self.assertRaises(KeyError, broker.poll, ticket)
+
+
+class TestSequenceHelpers(unittest.TestCase):
+	'''Local tests of the sequence constraints, fragments and features'''
+	def testFragments(self):
+		constraints = {'alphabet': STANDARD_AAS, 'minLength': 3, 'maxLength': None}
+		fragments = splitSequences({'p1': 'ACDXXEFGHIK', 'p2': 'AXC'}, constraints)
+		self.assertEqual(fragments, {'p1_0': ('p1', 0, 'ACD'), 'p1_5': ('p1', 5, 'EFGHIK')})
+
+		# One request per fragment, positions shifted by the fragment offset
+		mapBatch, outDic = getFragmentsMapper(fragments), {}
+		for batchDic in [{'seq1': {'Position': [1], 'Sequence': ['CD']}},
+										 {'seq1': {'Position': [0, 2], 'Sequence': ['EFG', 'GHI']}}]:
+			outDic = updateFragmentsDic(outDic, mapBatch(batchDic))
+		self.assertEqual(outDic, {'p1': {'Position': [1, 5, 7], 'Sequence': ['CD', 'EFG', 'GHI']}})
+
+	def testFillInvalidScores(self):
+		filled = fillInvalidScores({'Score': [0.1, 0.3]}, ['a', 'b', 'c'], ['a', 'c'])
+		self.assertEqual(filled['Score'][0], 0.1)
+		self.assertTrue(math.isnan(filled['Score'][1]))
+		self.assertEqual(filled['Score'][2], 0.3)
+		self.assertTrue(all([math.isnan(score) for score in fillInvalidScores({}, ['a', 'b'], [])['Score']]))
+
+	def testAACFeatures(self):
+		feats = getAACFeatures(['AAC', 'CD', 'AXA'])
+		self.assertEqual(feats.shape, (3, 20))
+		np.testing.assert_allclose(feats[:, :3], [[2 / 3, 1 / 3, 0], [0, 0.5, 0.5], [1, 0, 0]])
+		np.testing.assert_allclose(feats.sum(axis=1), 1)
+
+	def testDPCFeatures(self):
+		feats = getDPCFeatures(['AAC', 'CD', 'A', 'C'])
+		self.assertEqual(feats.shape, (4, 400))
+		# AA and AC, CD. No pairs in single residues, nor between consecutive sequences
+		self.assertEqual((feats[0, 0], feats[0, 1]), (0.5, 0.5))
+		self.assertEqual(feats[1, 1 * 20 + 2], 1)
+		self.assertEqual((feats[2].sum(), feats[3].sum()), (0, 0))
+
+
+class TestResultFiles(unittest.TestCase):
+	'''Local tests of the result files written and parsed by the protocols'''
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+
+	def testWriteScoreArrays(self):
+		matFile, idxFile = os.path.join(self.tmpDir, 'scores.npy'), os.path.join(self.tmpDir, 'scores_index.npz')
+		writeScoreArrays(matFile, idxFile, [3, 7], [(1, 16), (20, 35)], {'tox': [0.5, None], 'alg': ['0.2', 'nan']})
+		matrix, index = np.load(matFile, mmap_mode='r'), np.load(idxFile)
+		self.assertEqual(matrix.shape, (2, 2))
+		self.assertEqual((matrix[0, 0], matrix[0, 1]), (0.5, 0.2))
+		self.assertTrue(np.isnan(matrix[1]).all())
+		self.assertEqual(index['roiIds'].tolist(), [3, 7])
+		self.assertEqual(index['positions'].tolist(), [[1, 16], [20, 35]])
+		self.assertEqual(index['evaluators'].tolist(), ['tox', 'alg'])
+
+	def testParseVaxignMLResults(self):
+		resFile = os.path.join(self.tmpDir, 'vaxign.result.tsv')
+		with open(resFile, 'w') as f:
+			f.write('Protein_ID\tVaxign-ML_Score\tVaxign-ML_Percentile\tLabel\n')
+			f.write('seq1\t90.5\t95.0\tProtective\nseq2\t10.0\t5.0\tNon-protective\nincomplete\t1\n')
+		self.assertEqual(parseVaxignMLResults(resFile),
+										 {'seq1': {'_Vaxign_ML_Score': 90.5, '_Vaxign_ML_Percentile': 95.0},
+											'seq2': {'_Vaxign_ML_Score': 10.0, '_Vaxign_ML_Percentile': 5.0}})
@@ -0,0 +1,67 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+from pwchem.utils import assertHandle
+
+from .test_iiitd_selection import TestImmunoBase
+from ..protocols import ProtVaxignML
+
+# Replaces the Vaxign-ML docker launcher: writes a result table with fixed scores for each input protein
+STUB_SCRIPT = '''#!/bin/bash
+while getopts "i:o:t:" opt; do
+  case $opt in
+    i) INPUT=$OPTARG ;;
+    o) OUTPUT=$OPTARG ;;
+  esac
+done
+RESULT=$OUTPUT/$(basename $INPUT .fasta).result.tsv
+echo -e "Protein_ID\\tVaxign-ML_Score\\tVaxign-ML_Percentile" > $RESULT
+grep ">" $INPUT | sed "s/>//" | awk '{print $1"\\t90.0\\t95.0"}' >> $RESULT
+'''
+
+class TestVaxignML(TestImmunoBase):
+	def _writeStubScript(self):
+		stubFile = os.path.abspath(self.proj.getTmpPath('VaxignML_stub.sh'))
+		with open(stubFile, 'w') as f:
+			f.write(STUB_SCRIPT)
+		os.chmod(stubFile, 0o755)
+		return stubFile
+
+	def _runVaxignML(self):
+		protVax = self.newProtocol(ProtVaxignML, batchSize=1, vaxignCommand=self._writeStubScript())
+
+		protVax.inputSequences.set(self.protImportSeq)
+		protVax.inputSequences.setExtended('outputSequence')
+
+		self.proj.launchProtocol(protVax, wait=False)
+		return protVax
+
+	def test(self):
+		protVax = self._runVaxignML()
+		self._waitOutput(protVax, 'outputSequences', sleepTime=5)
+		assertHandle(self.assertIsNotNone, getattr(protVax, 'outputSequences', None))
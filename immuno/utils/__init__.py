@@ -1 +1,5 @@
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .scheduling import *
+from .metrics import *
+from .resources import *
+from .registry import *
\ No newline at end of file
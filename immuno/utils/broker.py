@@ -0,0 +1,257 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Local request broker, a daemon shared by all the protocols and batch jobs running in the host:
+    python -m immuno.utils.broker [--workers 4] [--cache-dir <dir>]
+The evaluations submit their requests to it instead of opening their own browsers (see callWebSoftware) when the
+broker is enabled (IIITD_BROKER variable or "--broker" in immuno-batch) and running on the same cache directory.
+The broker:
+  - dedupes the identical (software, parameters, sequence) requests in flight: each sequence is only requested once
+    and its score is returned to all the requesters
+  - limits the requests running in the host to its number of workers
+  - keeps the workers browser sessions warm between requests (see setWarmDrivers)
+  - runs each request under the deadline of its requester, and at most requestTimeout, so a stuck server page does
+    not hold a worker
+The tickets of the clients that gave up are cancelled or expire ticketTTL seconds after their results are ready.
+It listens on a unix socket in the cache directory, protected by a key file only readable by the user.
+"""
+
+import os, sys, json, time, secrets, argparse, threading
+from multiprocessing.managers import BaseManager
+
+from ..constants import IIITD_DIC, DEFAULT_CACHE_DIR
+from .utils import callWebSoftware, setWarmDrivers, checkRequestControl, setRequestControl, getRequestDeadline
+from .metrics import logCounter
+from .resources import getWorkerContext
+
+class BrokerManager(BaseManager):
+  '''Server side of the broker daemon'''
+  pass
+
+class BrokerClientManager(BaseManager):
+  '''Client side, connecting to a running broker'''
+  pass
+
+def getBrokerAddress(cacheDir):
+  return os.path.join(cacheDir, 'broker.sock')
+
+def getBrokerKey(cacheDir, create=False):
+  '''Returns the authentication key of the broker, stored in the cache directory. A new one is written if create'''
+  keyFile = os.path.join(cacheDir, 'broker.key')
+  if create:
+    os.makedirs(cacheDir, exist_ok=True)
+    with open(os.open(keyFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+      f.write(secrets.token_hex(32))
+  with open(keyFile) as f:
+    return f.read().strip().encode()
+
+
+def runBrokerRequest(softName, sequences, browserData, data, deadline=None):
+  '''Runs a request in a broker worker (see callWebSoftware), aborted with RequestTimeout after the deadline'''
+  setRequestControl(deadline=deadline)
+  try:
+    return callWebSoftware(softName, sequences, browserData, data)
+  finally:
+    setRequestControl()
+
+
+class RequestBroker:
+  '''Runs the requests of the clients in a pool of workers with warm browsers, coalescing the identical ones
+  - requestTimeout: float, maximum seconds of a request, even if its requester has no deadline. None for no limit
+  - ticketTTL: float, seconds a ticket is kept after its results are ready if the client does not poll it
+  - pool: pool of workers running the requests (see runBrokerRequest). A new one with warm browsers if None
+  '''
+  def __init__(self, workers=4, browserData={}, requestTimeout=1800, ticketTTL=600, pool=None):
+    self.browserData, self.requestTimeout, self.ticketTTL = browserData, requestTimeout, ticketTTL
+    self.pool = pool if pool is not None else getWorkerContext().Pool(processes=workers, initializer=setWarmDrivers)
+    self.lock = threading.Lock()
+    # {(softName, paramsKey, sequence): (AsyncResult, position in its batch, deadline of its requester)}
+    self.inFlight = {}
+    # {ticket: [(requestKey, AsyncResult, position)]} and {ticket: time its results were ready}
+    self.tickets, self.ticketsReady, self.nTickets = {}, {}, 0
+    self.stats = {'requests': 0, 'hits': 0, 'misses': 0, 'expiredTickets': 0}
+
+  def _evict(self):
+    '''Removes the finished requests (successful or failed) from the in flight ones, so the new submissions request
+    them again, and the tickets not polled ticketTTL seconds after being ready. Must be called with the lock'''
+    for reqKey, (res, _, _) in list(self.inFlight.items()):
+      if res.ready():
+        self.inFlight.pop(reqKey)
+
+    now = time.time()
+    for ticket, entries in list(self.tickets.items()):
+      if ticket not in self.ticketsReady and all([res.ready() for _, res, _ in entries]):
+        self.ticketsReady[ticket] = now
+      if ticket in self.ticketsReady and now - self.ticketsReady[ticket] > self.ticketTTL:
+        self._removeTicket(ticket)
+        self.stats['expiredTickets'] += 1
+
+  def _removeTicket(self, ticket):
+    self.tickets.pop(ticket, None)
+    self.ticketsReady.pop(ticket, None)
+
+  @staticmethod
+  def _lastsUntil(reqDeadline, deadline):
+    '''Whether a request whose requester gives up at reqDeadline runs until deadline (None for no deadline)'''
+    return reqDeadline is None or (deadline is not None and reqDeadline >= deadline)
+
+  def submit(self, softName, sequences, data={}, deadline=None):
+    '''Submits the evaluation of a list of sequences. The ones already in flight are not requested again, unless their
+    request would be aborted before the deadline of this requester. All of them are also limited by requestTimeout
+    - deadline: float, epoch time after which the requester gives up, also aborting the new request
+    Returns the ticket to poll for the results and the number of coalesced sequences'''
+    paramsKey, runDeadline = json.dumps(data, sort_keys=True), deadline
+    if self.requestTimeout:
+      runDeadline = min(deadline, time.time() + self.requestTimeout) if deadline else time.time() + self.requestTimeout
+    with self.lock:
+      self._evict()
+      newSeqs = []
+      for seq in sequences:
+        reqKey = (softName, paramsKey, seq)
+        inFlight = reqKey in self.inFlight and self._lastsUntil(self.inFlight[reqKey][2], deadline)
+        if not inFlight and seq not in newSeqs:
+          newSeqs.append(seq)
+
+      if newSeqs:
+        batchSeqs = {i: seq for i, seq in enumerate(newSeqs)}
+        res = self.pool.apply_async(runBrokerRequest, args=(softName, batchSeqs, self.browserData, data, runDeadline))
+        for i, seq in enumerate(newSeqs):
+          self.inFlight[(softName, paramsKey, seq)] = (res, i, deadline)
+
+      self.nTickets += 1
+      self.tickets[self.nTickets] = [((softName, paramsKey, seq), *self.inFlight[(softName, paramsKey, seq)][:2])
+                                     for seq in sequences]
+      hits = len(sequences) - len(newSeqs)
+      self.stats['requests'] += 1
+      self.stats['hits'] += hits
+      self.stats['misses'] += len(newSeqs)
+    return self.nTickets, hits
+
+  def poll(self, ticket):
+    '''Returns (done, [scores]) for a submitted ticket, the scores in the order of its sequences. The errors of the
+    requests are raised'''
+    with self.lock:
+      if ticket not in self.tickets:
+        raise KeyError(f'Ticket {ticket} expired or cancelled')
+      entries = self.tickets[ticket]
+    if not all([res.ready() for _, res, _ in entries]):
+      return False, None
+
+    with self.lock:
+      self._removeTicket(ticket)
+      self._evict()
+    return True, [res.get()['Score'][i] for _, res, i in entries]
+
+  def cancel(self, ticket):
+    '''Removes the ticket of a client that gave up. Its requests finish for the rest of their requesters'''
+    with self.lock:
+      self._removeTicket(ticket)
+      self._evict()
+
+  def getStats(self):
+    with self.lock:
+      self._evict()
+      return {**self.stats, 'inFlight': len(self.inFlight), 'tickets': len(self.tickets)}
+
+
+def runBroker(cacheDir=DEFAULT_CACHE_DIR, workers=4, browserData={}, requestTimeout=1800):
+  '''Runs the broker daemon until it is interrupted'''
+  broker = RequestBroker(workers, {**browserData, 'cacheDir': cacheDir}, requestTimeout=requestTimeout)
+  BrokerManager.register('getBroker', callable=lambda: broker)
+  address = getBrokerAddress(cacheDir)
+  if os.path.exists(address):
+    os.remove(address)
+  manager = BrokerManager(address=address, authkey=getBrokerKey(cacheDir, create=True))
+  print(f'Request broker listening on {address} with {workers} workers')
+  try:
+    manager.get_server().serve_forever()
+  finally:
+    broker.pool.close()
+    broker.pool.join()
+
+
+def getBrokerClient(cacheDir):
+  '''Returns a proxy to the broker running on the cache directory, None if there is none'''
+  address = getBrokerAddress(cacheDir)
+  if not os.path.exists(address):
+    return None
+  BrokerClientManager.register('getBroker')
+  manager = BrokerClientManager(address=address, authkey=getBrokerKey(cacheDir))
+  try:
+    manager.connect()
+  except (ConnectionRefusedError, FileNotFoundError):
+    return None
+  return manager.getBroker()
+
+def brokerRequest(broker, softName, sequences, data={}, metricsFile=None, pollTime=1):
+  '''Evaluates the sequences {seqId: seqString} through the broker, checking the request control while waiting.
+  The coalesced sequences are registered as brokerHits in the metrics file, the requested ones as brokerMisses
+  Returns a dictionary of the form {'Score': [scores]}
+  '''
+  ticket, hits = broker.submit(softName, list(sequences.values()), data, getRequestDeadline())
+  logCounter(metricsFile, 'brokerHits', softName, hits)
+  logCounter(metricsFile, 'brokerMisses', softName, len(sequences) - hits)
+  try:
+    while True:
+      done, scores = broker.poll(ticket)
+      if done:
+        return {'Score': scores}
+      checkRequestControl()
+      time.sleep(pollTime)
+  except BaseException:
+    # The client gives up (deadline, cancellation or interruption): its ticket is released in the broker
+    try:
+      broker.cancel(ticket)
+    except (OSError, EOFError):
+      pass
+    raise
+
+
+def getParser():
+  parser = argparse.ArgumentParser(description='Local request broker for the IIITD servers')
+  parser.add_argument('-j', '--workers', type=int, default=4, help='Maximum number of requests running in the host')
+  parser.add_argument('--cache-dir', dest='cacheDir', default=os.environ.get(IIITD_DIC['cacheDir'], DEFAULT_CACHE_DIR),
+                      help='Cache directory of the browsers, where the broker socket is created')
+  parser.add_argument('--browser', default=os.environ.get(IIITD_DIC['browser'], 'Chrome'),
+                      help='Browser to use: Chrome or Firefox')
+  parser.add_argument('--browser-path', dest='browserPath', default=os.environ.get(IIITD_DIC['browserPath']),
+                      help='Path to the browser executable')
+  parser.add_argument('--no-sandbox', dest='noSandbox', action='store_true',
+                      default=os.environ.get(IIITD_DIC['noSandbox'], '').lower() in ['true', '1', 'yes'],
+                      help='Run Chrome without its sandbox, only for containers where it cannot start otherwise')
+  parser.add_argument('--request-timeout', dest='requestTimeout', type=float, default=30,
+                      help='Maximum minutes of a request, also for the requesters without deadline. 0 for no limit')
+  return parser
+
+def main(argv=None):
+  args = getParser().parse_args(argv)
+  runBroker(args.cacheDir, args.workers, {'name': args.browser, 'path': args.browserPath, 'noSandbox': args.noSandbox},
+            requestTimeout=args.requestTimeout * 60)
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,157 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Timing and counter metrics of the protocol runs, stored as json lines (one event per line) so they can be appended
+while the run goes on. The events are dictionaries with at least the keys:
+  - type: "task", for a timed piece of work, with the keys stage, software, start, end, nSeqs and status
+          "counter", for a counted event, with the keys name, software and value
+          "memory", for the peak memory (MB) used by a step, with the key peakMB
+  - time: epoch time when the event was registered
+"""
+
+import os, time, json
+
+def logMetric(metricsFile, eventType, **fields):
+  '''Appends an event to the metrics file. Nothing is done if metricsFile is None'''
+  if metricsFile:
+    with open(metricsFile, 'a') as f:
+      f.write(json.dumps({'type': eventType, 'time': time.time(), **fields}) + '\n')
+
+def logTask(metricsFile, stage, software, start, end, nSeqs=0, status='ok', **fields):
+  '''Registers a timed task (e.g. a selector run or an evaluation unit) in the metrics file'''
+  logMetric(metricsFile, 'task', stage=stage, software=software, start=start, end=end, nSeqs=nSeqs, status=status,
+            **fields)
+
+def logCounter(metricsFile, name, software='', value=1):
+  '''Registers a counted event (e.g. a hedged request, a cache hit) in the metrics file'''
+  logMetric(metricsFile, 'counter', name=name, software=software, value=value)
+
+def readMetrics(metricsFile):
+  '''Returns the list of events stored in the metrics file'''
+  events = []
+  if os.path.exists(metricsFile):
+    with open(metricsFile) as f:
+      for line in f:
+        if line.strip():
+          events.append(json.loads(line))
+  return events
+
+def getTaskEvents(events, stage=None):
+  return [ev for ev in events if ev['type'] == 'task' and (stage is None or ev['stage'] == stage)]
+
+def getLatencies(events):
+  '''Returns the latencies of the tasks in seconds per software as {(stage, software): [latencies]}'''
+  latDic = {}
+  for ev in getTaskEvents(events):
+    latDic.setdefault((ev['stage'], ev['software']), []).append(ev['end'] - ev['start'])
+  return latDic
+
+def getThroughput(events, binTime=60):
+  '''Returns the number of sequences processed by each stage in consecutive bins of binTime seconds since the
+  beginning of the run, as {stage: ([binStartTimes], [nSeqs])}'''
+  tasks = getTaskEvents(events)
+  if not tasks:
+    return {}
+  t0 = min([ev['start'] for ev in tasks])
+  nBins = int((max([ev['end'] for ev in tasks]) - t0) // binTime) + 1
+
+  thDic = {}
+  for ev in tasks:
+    counts = thDic.setdefault(ev['stage'], [0] * nBins)
+    counts[int((ev['end'] - t0) // binTime)] += ev['nSeqs']
+  binTimes = [i * binTime for i in range(nBins)]
+  return {stage: (binTimes, counts) for stage, counts in thDic.items()}
+
+def getConcurrency(events):
+  '''Returns the number of tasks running along the run, as ([times], [nRunning]), times since the run beginning'''
+  changes = []
+  for ev in getTaskEvents(events):
+    changes += [(ev['start'], 1), (ev['end'], -1)]
+  if not changes:
+    return [], []
+
+  changes.sort()
+  t0, times, nRunning, curRunning = changes[0][0], [], [], 0
+  for t, change in changes:
+    curRunning += change
+    times.append(t - t0)
+    nRunning.append(curRunning)
+  return times, nRunning
+
+def getCounters(events):
+  '''Returns the total value of each counter as {counterName: {software: value}}'''
+  counters = {}
+  for ev in events:
+    if ev['type'] == 'counter':
+      softCounts = counters.setdefault(ev['name'], {})
+      softCounts[ev['software']] = softCounts.get(ev['software'], 0) + ev['value']
+  return counters
+
+def getHitRates(events):
+  '''Returns the hit rates of the counters registered as pairs "<name>Hits" and "<name>Misses", as {name: rate}'''
+  counters, rates = getCounters(events), {}
+  for cName in counters:
+    if cName.endswith('Hits'):
+      name = cName[:-len('Hits')]
+      hits, misses = sum(counters[cName].values()), sum(counters.get(f'{name}Misses', {}).values())
+      rates[name] = hits / (hits + misses) if hits + misses else 0
+  return rates
+
+def getSlowestStage(events):
+  '''Returns the (stage, software) with the largest accumulated task time and that time in seconds'''
+  busyDic = {key: sum(lats) for key, lats in getLatencies(events).items()}
+  if not busyDic:
+    return None, 0
+  slowest = max(busyDic, key=busyDic.get)
+  return slowest, busyDic[slowest]
+
+def buildMetricsReport(events):
+  '''Returns a text report summarizing the metrics of a run'''
+  lines = []
+  for (stage, software), lats in sorted(getLatencies(events).items()):
+    nSeqs = sum([ev['nSeqs'] for ev in getTaskEvents(events, stage) if ev['software'] == software])
+    sLats = sorted(lats)
+    lines.append(f'{stage} - {software}: {len(lats)} tasks, {nSeqs} sequences, '
+                 f'median latency {round(sLats[len(sLats) // 2], 1)}s, max latency {round(sLats[-1], 1)}s, '
+                 f'total {round(sum(lats), 1)}s')
+
+  for cName, softCounts in sorted(getCounters(events).items()):
+    lines.append(f'{cName}: ' + ', '.join([f'{soft if soft else "all"} {value}' for soft, value in softCounts.items()]))
+  for name, rate in getHitRates(events).items():
+    lines.append(f'{name} hit rate: {round(100 * rate, 1)}%')
+
+  times, nRunning = getConcurrency(events)
+  if nRunning:
+    lines.append(f'Maximum concurrency: {max(nRunning)} tasks')
+  peaks = [ev['peakMB'] for ev in events if ev['type'] == 'memory']
+  if peaks:
+    lines.append(f'Peak memory: {round(max(peaks))} MB')
+
+  slowest, busyTime = getSlowestStage(events)
+  if slowest:
+    lines.append(f'\nSlowest stage: {slowest[0]} - {slowest[1]} ({round(busyTime, 1)}s of accumulated task time)')
+  return '\n'.join(lines)
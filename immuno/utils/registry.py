@@ -0,0 +1,221 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Registry of the evaluators that can be used in the epitope evaluations. Each entry is either:
+  - web: an IIITD web server requested through Selenium, defined in WEB_SOFT_DATA
+  - local: a batch predictor run in this host, which scores the feature matrix of a whole batch of sequences in a
+    single call. It can be any object with a predict_proba, decision_function or predict method (e.g. a pickled
+    scikit-learn model) or a function taking the feature matrix and returning the scores.
+Protocols and other plugins can extend it on import, e.g.:
+    from immuno.utils import registerLocalEvaluator
+    registerLocalEvaluator('MyToxicityModel', modelFile='/path/to/model.pkl', features='aac')
+The "LocalModel" evaluator takes the model file and features from its parameters ("modelFile" and
+"modelFeatures").
+The registrations only exist in the processes that run them, so the work units carry the entry of their evaluator
+(see getRegistryEntry) and the workers register it again (see ensureRegistered), importing the module that
+registered it in the parent.
+"""
+
+import sys, time, importlib
+
+from ..constants import STANDARD_AAS
+from .utils import WEB_SOFT_DATA, callWebSoftware, getSoftConstraints, filterSequences, fillInvalidScores
+from .metrics import logTask
+
+# {softwareName: {'kind': 'web' | 'local', ...}}
+EVALUATOR_REGISTRY = {}
+
+# Local models loaded from files, cached per process as {modelFile: model}
+_loadedModels = {}
+
+def _getCallerModule(depth=2):
+  '''Returns the name of the module calling the function that calls this one'''
+  return sys._getframe(depth).f_globals.get('__name__')
+
+def registerWebEvaluator(softName, softData=None):
+  '''Registers an evaluator run on a web server
+  - softData: dic, web characteristics of the software (see WEB_SOFT_DATA). Already defined if None
+  '''
+  if softData is not None:
+    WEB_SOFT_DATA[softName] = softData
+  EVALUATOR_REGISTRY[softName] = {'kind': 'web', 'module': _getCallerModule()}
+
+def registerLocalEvaluator(softName, predictor=None, modelFile=None, features='aac', minLength=None,
+                           maxLength=None):
+  '''Registers an evaluator run locally on batches of sequences
+  - predictor: object with a predict_proba, decision_function or predict method, or function returning the scores
+  of a feature matrix
+  - modelFile: str, pickled predictor, loaded when first used, if predictor is None
+  - features: str, features computed from the sequences for the predictor (see FEATURE_FUNCTIONS)
+  - minLength, maxLength: int, length limits of the sequences, the rest get NaN scores
+  '''
+  EVALUATOR_REGISTRY[softName] = {'kind': 'local', 'predictor': predictor, 'modelFile': modelFile,
+                                  'features': features, 'minLength': minLength, 'maxLength': maxLength,
+                                  'module': _getCallerModule()}
+
+def getEvaluatorKind(softName):
+  '''Returns the kind of a registered evaluator ("web" or "local"), None if it is not registered'''
+  return EVALUATOR_REGISTRY[softName]['kind'] if softName in EVALUATOR_REGISTRY else None
+
+def getEvaluatorNames(kind=None):
+  '''Returns the names of the registered evaluators, only those of a kind if not None'''
+  return [softName for softName, entry in EVALUATOR_REGISTRY.items() if kind is None or entry['kind'] == kind]
+
+def getRegistryEntry(softName):
+  '''Returns the registry entry of an evaluator that can be sent to other processes (json serializable, without the
+  predictor object), to register it there with ensureRegistered. None if it is not registered'''
+  if softName not in EVALUATOR_REGISTRY:
+    return None
+  return {key: value for key, value in EVALUATOR_REGISTRY[softName].items() if key != 'predictor'}
+
+def ensureRegistered(softName, entry=None):
+  '''Registers in this process an evaluator registered in another one (e.g. in the workers of the parent pool),
+  importing the module that registered it or, if it cannot be imported, from the entry values (only local
+  evaluators with a model file)
+  - entry: dic, registry entry of the evaluator in the other process (see getRegistryEntry)
+  '''
+  if softName in EVALUATOR_REGISTRY or not entry:
+    return
+  module = entry.get('module')
+  if module and module != '__main__':
+    try:
+      importlib.import_module(module)
+    except ImportError as e:
+      print(f'Module {module} registering the evaluator {softName} could not be imported: {e}')
+
+  if softName not in EVALUATOR_REGISTRY:
+    if entry['kind'] == 'local' and entry.get('modelFile'):
+      registerLocalEvaluator(softName, modelFile=entry['modelFile'], features=entry['features'],
+                             minLength=entry['minLength'], maxLength=entry['maxLength'])
+    else:
+      raise ValueError(f'Evaluator {softName} cannot be registered in this process: it must be registered on import '
+                       f'of a module that the workers can import')
+
+
+########## FEATURES ##########
+
+def _getResidueIndexes(sequences):
+  '''Returns the residues of the sequences concatenated as indexes in STANDARD_AAS (-1 if not standard) and the index
+  of the sequence each of them belongs to'''
+  import numpy as np
+  lookup = np.full(256, -1, dtype=np.int64)
+  for i, res in enumerate(STANDARD_AAS):
+    lookup[ord(res)] = i
+  resIdxs = lookup[np.frombuffer(''.join(sequences).upper().encode(), dtype=np.uint8)]
+  seqIdxs = np.repeat(np.arange(len(sequences)), [len(seq) for seq in sequences])
+  return resIdxs, seqIdxs
+
+def getAACFeatures(sequences):
+  '''Returns the amino acid composition of the sequences as a (nSequences, 20) matrix of residue frequencies'''
+  import numpy as np
+  nAAs = len(STANDARD_AAS)
+  resIdxs, seqIdxs = _getResidueIndexes(sequences)
+  valid = resIdxs >= 0
+  counts = np.bincount(seqIdxs[valid] * nAAs + resIdxs[valid], minlength=len(sequences) * nAAs)
+  counts = counts.reshape(len(sequences), nAAs).astype(np.float64)
+  return counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+def getDPCFeatures(sequences):
+  '''Returns the dipeptide composition of the sequences as a (nSequences, 400) matrix of dipeptide frequencies'''
+  import numpy as np
+  nPairs = len(STANDARD_AAS) ** 2
+  resIdxs, seqIdxs = _getResidueIndexes(sequences)
+  # Consecutive residues of the same sequence
+  valid = (resIdxs[:-1] >= 0) & (resIdxs[1:] >= 0) & (seqIdxs[:-1] == seqIdxs[1:])
+  pairIdxs = resIdxs[:-1][valid] * len(STANDARD_AAS) + resIdxs[1:][valid]
+  counts = np.bincount(seqIdxs[:-1][valid] * nPairs + pairIdxs, minlength=len(sequences) * nPairs)
+  counts = counts.reshape(len(sequences), nPairs).astype(np.float64)
+  return counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+def getAACDPCFeatures(sequences):
+  import numpy as np
+  return np.hstack([getAACFeatures(sequences), getDPCFeatures(sequences)])
+
+FEATURE_FUNCTIONS = {'aac': getAACFeatures, 'dpc': getDPCFeatures, 'aac+dpc': getAACDPCFeatures}
+
+
+########## LOCAL EVALUATORS ##########
+
+def loadLocalModel(modelFile):
+  '''Loads a pickled model (joblib or pickle), cached for the next calls of this process'''
+  if modelFile not in _loadedModels:
+    try:
+      import joblib
+      _loadedModels[modelFile] = joblib.load(modelFile)
+    except ImportError:
+      import pickle
+      with open(modelFile, 'rb') as f:
+        _loadedModels[modelFile] = pickle.load(f)
+  return _loadedModels[modelFile]
+
+def predictBatch(predictor, featMatrix):
+  '''Returns the scores of a feature matrix: the positive class probability if the predictor has predict_proba,
+  else its decision_function or predict, or the predictor output if it is a function'''
+  if hasattr(predictor, 'predict_proba'):
+    return predictor.predict_proba(featMatrix)[:, -1]
+  elif hasattr(predictor, 'decision_function'):
+    return predictor.decision_function(featMatrix)
+  elif hasattr(predictor, 'predict'):
+    return predictor.predict(featMatrix)
+  return predictor(featMatrix)
+
+def callLocalEvaluator(softName, sequences, data={}, metricsFile=None):
+  '''Scores the sequences with a local evaluator, computing the features of all of them and predicting in one batch
+  - sequences: dic, {seqId: seqString}
+  - data: dic, evaluator parameters. "modelFile" and "modelFeatures" override those of the registry entry
+  Returns a dictionary of the form {'Score': [scores]}, NaN for the sequences out of its constraints
+  '''
+  entry, startTime = EVALUATOR_REGISTRY[softName], time.time()
+  modelFile, features = data.get('modelFile', entry['modelFile']), data.get('modelFeatures', entry['features'])
+  predictor = entry['predictor'] if entry['predictor'] is not None else loadLocalModel(modelFile)
+
+  constraints = {'alphabet': STANDARD_AAS, 'minLength': entry['minLength'], 'maxLength': entry['maxLength']}
+  validSeqs = filterSequences(sequences, constraints)
+  outDic = {}
+  if validSeqs:
+    featMatrix = FEATURE_FUNCTIONS[features.lower()](list(validSeqs.values()))
+    outDic = {'Score': [float(score) for score in predictBatch(predictor, featMatrix)]}
+  outDic = fillInvalidScores(outDic, list(sequences.keys()), list(validSeqs.keys()))
+  logTask(metricsFile, 'evaluation', softName, startTime, time.time(), len(sequences))
+  return outDic
+
+def callEvaluator(softName, sequences, browserData={}, data={}, metricsFile=None, entry=None):
+  '''Scores the sequences with a registered evaluator, locally or on its web server (see callWebSoftware)
+  - entry: dic, registry entry of the evaluator, to register it if this is a worker process (see ensureRegistered)
+  Returns a dictionary of the form {'Score': [scores]}
+  '''
+  ensureRegistered(softName, entry)
+  if getEvaluatorKind(softName) == 'local':
+    return callLocalEvaluator(softName, sequences, data, metricsFile=metricsFile)
+  return callWebSoftware(softName, sequences, browserData, data, metricsFile=metricsFile)
+
+
+# Web servers used as evaluators (the rest of WEB_SOFT_DATA are selectors, which split the proteins)
+for _softName in WEB_SOFT_DATA:
+  if not getSoftConstraints(_softName).get('split'):
+    registerWebEvaluator(_softName)
+registerLocalEvaluator('LocalModel')
@@ -0,0 +1,272 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Resources of the runs:
+  - Worker pools: workers started from a forkserver, so they do not inherit the state of the protocol process
+    (project mapper, open databases, threads). The forkserver preloads the IIITD client code, which also imports the
+    plugin package (pwchem, pyworkflow), so those imports are paid once in the forkserver and not in every worker.
+    There is a pool per use (e.g. selection, evaluation), reused along the protocol step, or the call of the Plugin
+    entry points, until closeWorkerPools is called.
+  - Memory governor: the number of workers and live browsers is limited by a memory budget. While the run goes on,
+    the memory actually used by its process tree (workers and browsers included) is measured and no new browsers are
+    started while it exceeds the budget. The memory measured per browser sizes the next runs.
+  - Shared score matrices: the workers write their numeric results in a shared memory block allocated by the parent,
+    so only small metadata is pickled back and the parent reads the scores in place.
+"""
+
+import os, threading, multiprocessing
+from multiprocessing import shared_memory
+
+from .utils import setDriverSlots
+
+# Pools reused along the run as {name: (pool, processes, nSlots)}, see getWorkerPool
+_workerPools = {}
+# Pools replaced by others with a different size, closed but not joined yet
+_retiredPools = []
+# Browser slots reused along the run as {nSlots: semaphore}, see getDriverSlots
+_driverSlotSemaphores = {}
+
+# Estimated memory of a worker with its browser and of each extra tab of the browser (see seleniumRequest), used to
+# compute the number of them fitting in a budget until the memory per browser is measured (see MemoryGovernor)
+DRIVER_MEMORY_MB = 300
+TAB_MEMORY_MB = 100
+
+# Memory per live browser measured by the memory governors of this process, as {maxTabs: MB}
+_measuredDriverMemory = {}
+
+def getProcessRSS(pid):
+  '''Returns the resident memory of a process in MB, 0 if it cannot be read (e.g. it finished)'''
+  try:
+    with open(f'/proc/{pid}/status') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) / 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return 0
+
+def getChildrenPids(pid):
+  '''Returns the pids of all the descendants of a process, read from /proc'''
+  parents = {}
+  for procDir in os.listdir('/proc'):
+    if procDir.isdigit():
+      try:
+        with open(f'/proc/{procDir}/stat') as f:
+          # The process name, in parenthesis, may contain spaces
+          ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+      except (OSError, ValueError, IndexError):
+        continue
+      parents.setdefault(ppid, []).append(int(procDir))
+
+  children, toVisit = [], [pid]
+  while toVisit:
+    for childPid in parents.get(toVisit.pop(), []):
+      children.append(childPid)
+      toVisit.append(childPid)
+  return children
+
+def getProcessTreeRSS(pid=None):
+  '''Returns the resident memory in MB of a process (this one by default) and all its descendants'''
+  pid = os.getpid() if pid is None else pid
+  return sum([getProcessRSS(p) for p in [pid] + getChildrenPids(pid)])
+
+def getDriverMemory(maxTabs=1):
+  '''Returns the memory in MB of a worker with its browser using up to maxTabs tabs: the one measured in the previous
+  runs of this process (see MemoryGovernor) or, if none, the estimation from DRIVER_MEMORY_MB and TAB_MEMORY_MB'''
+  if _measuredDriverMemory.get(maxTabs):
+    return _measuredDriverMemory[maxTabs]
+  return DRIVER_MEMORY_MB + (maxTabs - 1) * TAB_MEMORY_MB
+
+def getBudgetSlots(jobs, memoryBudget=None, maxTabs=1):
+  '''Returns the number of workers with a live browser that fit in the memory budget, at most jobs
+  - memoryBudget: float, memory budget in MB. No limit if None or 0
+  - maxTabs: int, maximum number of tabs of each browser (see WEB_SOFT_DATA)
+  '''
+  if not memoryBudget:
+    return jobs
+  return max(1, min(jobs, int(memoryBudget // getDriverMemory(maxTabs))))
+
+
+def getWorkerContext():
+  '''Returns the multiprocessing context of the workers: a forkserver which preloads the IIITD client code'''
+  ctx = multiprocessing.get_context('forkserver')
+  ctx.set_forkserver_preload(['immuno.utils'])
+  return ctx
+
+def getDriverSlots(nSlots):
+  '''Returns the semaphore limiting to nSlots the live browsers of the workers (see setDriverSlots), reused along
+  the run'''
+  if nSlots not in _driverSlotSemaphores:
+    _driverSlotSemaphores[nSlots] = getWorkerContext().Semaphore(nSlots)
+  return _driverSlotSemaphores[nSlots]
+
+def getWorkerPool(name, processes, nSlots=None):
+  '''Returns the pool of workers (see getWorkerContext) of a use, reused by the next calls. If they ask for a
+  different number of workers or browser slots, the pool is replaced by a new one, the old one being closed
+  - name: str, name of the pool, so different uses (e.g. selectors and evaluators) get different pools
+  - processes: int, number of workers
+  - nSlots: int, if not None, maximum number of live browsers among the pools with the same nSlots
+  '''
+  if name in _workerPools:
+    pool, poolProcesses, poolSlots = _workerPools[name]
+    if (poolProcesses, poolSlots) == (processes, nSlots):
+      return pool
+    # Its workers exit once their tasks finish, being joined in closeWorkerPools
+    pool.close()
+    _retiredPools.append(pool)
+
+  driverSlots = getDriverSlots(nSlots) if nSlots else None
+  pool = getWorkerContext().Pool(processes=processes, initializer=setDriverSlots, initargs=(driverSlots,))
+  _workerPools[name] = (pool, processes, nSlots)
+  return pool
+
+def closeWorkerPools():
+  '''Closes the reused worker pools, waiting for their workers to finish'''
+  for pool in [pool for pool, *_ in _workerPools.values()] + _retiredPools:
+    pool.close()
+    pool.join()
+  _workerPools.clear()
+  _retiredPools.clear()
+  _driverSlotSemaphores.clear()
+
+
+def createSharedMatrix(shape, fillValue=float('nan')):
+  '''Allocates a float64 matrix in shared memory, to be filled by the workers (see attachSharedMatrix)
+  Returns the SharedMemory block, whose name identifies it for the workers, and the matrix. The block must be
+  released with releaseSharedMatrix when no longer needed
+  '''
+  import numpy as np
+  shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+  matrix = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+  matrix[:] = fillValue
+  return shm, matrix
+
+def attachSharedMatrix(name, shape):
+  '''Attaches to a shared matrix created by the parent (see createSharedMatrix). Returns the block and the matrix'''
+  import numpy as np
+  # The workers share the resource tracker of the parent, so the block is only unlinked by releaseSharedMatrix
+  shm = shared_memory.SharedMemory(name=name)
+  return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+def writeSharedRows(name, shape, rowStart, colValues):
+  '''Writes values in a shared matrix, from row rowStart
+  - colValues: dic, {columnIdx: [values]}
+  '''
+  shm, matrix = attachSharedMatrix(name, shape)
+  try:
+    for colIdx, values in colValues.items():
+      matrix[rowStart:rowStart + len(values), colIdx] = values
+  finally:
+    del matrix
+    shm.close()
+
+def readSharedRows(matrix, rowStart, nRows, colIdxs):
+  '''Returns copies of nRows values of a shared matrix from row rowStart, as {key: [values]}, so that no views of the
+  shared block are kept
+  - colIdxs: dic, {key: columnIdx}
+  '''
+  return {key: matrix[rowStart:rowStart + nRows, colIdx].tolist() for key, colIdx in colIdxs.items()}
+
+def releaseSharedMatrix(shm):
+  '''Frees a shared matrix block created by createSharedMatrix. Its matrices must not be used afterwards'''
+  shm.close()
+  shm.unlink()
+
+
+class MemoryMonitor(threading.Thread):
+  '''Samples in the background the memory used by this process and its descendants, keeping the peak (MB)'''
+  def __init__(self, interval=1):
+    super().__init__(daemon=True)
+    self.interval, self.peak = interval, 0
+    self._stopEvent = threading.Event()
+
+  def run(self):
+    while not self._stopEvent.is_set():
+      self.sample(getProcessTreeRSS())
+      self._stopEvent.wait(self.interval)
+
+  def sample(self, usedMB):
+    self.peak = max(self.peak, usedMB)
+
+  def stop(self):
+    '''Stops the sampling and returns the peak memory'''
+    self._stopEvent.set()
+    self.join()
+    return self.peak
+
+
+class MemoryGovernor(MemoryMonitor):
+  '''Enforces a memory budget on the browsers of the workers sharing a slots semaphore (see getDriverSlots). While
+  the memory used by this process tree exceeds the budget, it withholds free slots so no new browsers are started,
+  giving them back when the memory left fits another browser. The memory per live browser measured is used by
+  getDriverMemory to size the next runs
+  - memoryBudget: float, memory budget in MB
+  - nSlots: int, number of browser slots of the semaphore
+  - maxTabs: int, maximum number of tabs of each browser
+  '''
+  def __init__(self, memoryBudget, semaphore, nSlots, maxTabs=1, interval=1):
+    super().__init__(interval)
+    self.budget, self.semaphore, self.nSlots, self.maxTabs = memoryBudget, semaphore, nSlots, maxTabs
+    # Memory of the run before the browsers are started, the idle workers included
+    self.baseMB, self.held = getProcessTreeRSS(), 0
+
+  def getLiveDrivers(self):
+    '''Returns the number of browsers holding a slot, None if the semaphore value cannot be read (e.g. macOS)'''
+    try:
+      return self.nSlots - self.held - self.semaphore.get_value()
+    except NotImplementedError:
+      return None
+
+  def sample(self, usedMB):
+    super().sample(usedMB)
+    nLive = self.getLiveDrivers()
+    if nLive and usedMB > self.baseMB:
+      _measuredDriverMemory[self.maxTabs] = (usedMB - self.baseMB) / nLive
+
+    # At least one browser is always allowed
+    if usedMB > self.budget and self.held < self.nSlots - 1:
+      if self.semaphore.acquire(False):
+        self.held += 1
+    elif self.held and usedMB + getDriverMemory(self.maxTabs) <= self.budget:
+      self.semaphore.release()
+      self.held -= 1
+
+  def stop(self):
+    peak = super().stop()
+    for _ in range(self.held):
+      self.semaphore.release()
+    self.held = 0
+    return peak
+
+def startMemoryGovernor(memoryBudget, nSlots, maxTabs=1):
+  '''Returns a started MemoryGovernor on the browser slots of nSlots (see getDriverSlots), None if no memoryBudget.
+  It must be stopped when the run finishes'''
+  if not memoryBudget:
+    return None
+  governor = MemoryGovernor(memoryBudget, getDriverSlots(nSlots), nSlots, maxTabs)
+  governor.start()
+  return governor
@@ -0,0 +1,493 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, time, json
+
+from .utils import RequestTimeout, runEvaluationSweep, divide_chunks, setRequestControl, checkRequestControl, \
+  probeSoftwares, getSoftMaxTabs
+from .registry import getEvaluatorKind, callEvaluator, callLocalEvaluator, getRegistryEntry, ensureRegistered
+from .metrics import logTask, logCounter
+from .resources import getBudgetSlots, getWorkerPool, getWorkerContext, createSharedMatrix, writeSharedRows, \
+  readSharedRows, releaseSharedMatrix, startMemoryGovernor
+
+def buildEvaluationUnits(seqKeys, evalDics, chunkSize=None, sweep=False):
+  '''Splits the evaluation of a set of sequences into (evaluator, chunk) work units
+  - seqKeys: list, keys of the sequences to evaluate
+  - evalDics: dic, evaluators as {evalKey: {"software": softwareName, parameterName: parameterValue}}
+  - chunkSize: int, maximum number of sequences in each unit. All of them in a single chunk if None or 0
+  - sweep: bool, join the evaluators of the same software in a single unit (see runEvaluationSweep)
+  Returns a list of units as {'chunk': chunkIdx, 'software': softwareName, 'seqKeys': [seqKeys],
+  'evals': {evalKey: {parameterName: parameterValue}}, 'entry': softwareRegistryEntry}
+  '''
+  softEvals = []
+  for evalKey, evalDic in evalDics.items():
+    paramDic = evalDic.copy()
+    softName = paramDic.pop('software')
+    kind = getEvaluatorKind(softName)
+    if kind is None:
+      continue
+
+    # Only the web evaluators are swept, in a single browser session
+    sweepEvals = [evals for sName, evals in softEvals if sName == softName] if sweep and kind == 'web' else []
+    if sweepEvals:
+      sweepEvals[0][evalKey] = paramDic
+    else:
+      softEvals.append((softName, {evalKey: paramDic}))
+
+  # No units without sequences, instead of a unit with an empty chunk
+  chunks = divide_chunks(seqKeys, chunkSize) if chunkSize else [seqKeys] if seqKeys else []
+  units = []
+  for chunkIdx, chunkKeys in enumerate(chunks):
+    for softName, evals in softEvals:
+      units.append({'chunk': chunkIdx, 'software': softName, 'seqKeys': chunkKeys, 'evals': evals,
+                    'entry': getRegistryEntry(softName)})
+  return units
+
+
+def runEvaluationUnit(unit, sequences, browserData={}):
+  '''Evaluates the sequences of a work unit (see buildEvaluationUnits)
+  - unit: dic, work unit to run
+  - sequences: dic, {seqKey: sequence} containing at least the unit sequences
+  - browserData: dic, contains the information necessary to build the Selenium driver
+  Returns a dictionary as {evalKey: [scores]}, with the scores in the order of unit['seqKeys']
+  '''
+  # The evaluators registered by other plugins in the parent are registered again in the workers
+  ensureRegistered(unit['software'], unit.get('entry'))
+  unitSeqs = {seqKey: sequences[seqKey] for seqKey in unit['seqKeys']}
+  if getEvaluatorKind(unit['software']) == 'local':
+    outDics = {evalKey: callLocalEvaluator(unit['software'], unitSeqs, paramDic)
+               for evalKey, paramDic in unit['evals'].items()}
+  elif len(unit['evals']) > 1:
+    outDics = runEvaluationSweep(unit['software'], unitSeqs, unit['evals'], browserData)
+  else:
+    evalKey, paramDic = list(unit['evals'].items())[0]
+    outDics = {evalKey: callEvaluator(unit['software'], unitSeqs, browserData, paramDic)}
+  return {evalKey: outDic['Score'] for evalKey, outDic in outDics.items()}
+
+
+def mergeUnitScores(units, unitScores):
+  '''Joins the scores of the finished units, in chunk order, as {(evalKey, softwareName): [scores]}'''
+  scoresDic = {}
+  for unitIdx in sorted(unitScores, key=lambda uIdx: units[uIdx]['chunk']):
+    for evalKey, scores in unitScores[unitIdx].items():
+      scoresDic.setdefault((evalKey, units[unitIdx]['software']), []).extend(scores)
+  return scoresDic
+
+
+def runEvaluationAttempt(unit, sequences, browserData, attemptKey, control, timeout=None, sharedScores=None):
+  '''Runs an attempt of an evaluation work unit (see runEvaluationUnit) under the request control of the parent
+  - attemptKey: tuple, (unitIdx, attemptIdx) identifying the attempt
+  - control: dict shared with the parent process (Manager dict). The attempt start and end times are registered in it
+  as control[('start', attemptKey)] and control[('end', attemptKey)], and it is aborted when the parent sets
+  control[('cancel', attemptKey)] or trips the unit software as control[('tripped', softwareName)]
+  - timeout: float, seconds after which the attempt is aborted. No deadline if None or 0
+  - sharedScores: tuple, (name, shape, rowStart, {evalKey: columnIdx}) of a shared matrix (see createSharedMatrix)
+  where the scores are written instead of being returned, so that they are not pickled back to the parent
+  '''
+  startTime = time.time()
+  control[('start', attemptKey)] = startTime
+  setRequestControl(deadline=startTime + timeout if timeout else None,
+                    isCancelled=lambda: control.get(('cancel', attemptKey), False) or
+                                        control.get(('tripped', unit['software']), False))
+  try:
+    # The queued attempts of a tripped software fail fast, freeing the worker for the rest
+    checkRequestControl()
+    scores = runEvaluationUnit(unit, sequences, browserData)
+    if sharedScores is None:
+      return scores
+    name, shape, rowStart, evalCols = sharedScores
+    writeSharedRows(name, shape, rowStart, {evalCols[evalKey]: values for evalKey, values in scores.items()})
+  finally:
+    control[('end', attemptKey)] = time.time()
+
+
+def getPercentile(values, percentile):
+  '''Returns the percentile (0-100) of a list of values, using the nearest rank'''
+  sValues = sorted(values)
+  rank = int(round(percentile / 100 * (len(sValues) - 1)))
+  return sValues[min(max(rank, 0), len(sValues) - 1)]
+
+
+def getNaNScores(unit):
+  '''Returns the scores of a unit that could not be evaluated'''
+  return {evalKey: [float('nan')] * len(unit['seqKeys']) for evalKey in unit['evals']}
+
+
+class CircuitBreaker:
+  '''Tracks the consecutive failed units of each software, tripping the software when they reach maxFailures.
+  A tripped software is not requested anymore and its remaining units get NaN scores'''
+  def __init__(self, maxFailures=3):
+    self.maxFailures = maxFailures
+    self.failures, self.tripped = {}, {}
+
+  def isTripped(self, softName):
+    return softName in self.tripped
+
+  def trip(self, softName, reason):
+    self.tripped[softName] = reason
+
+  def recordSuccess(self, softName):
+    self.failures[softName] = 0
+
+  def recordFailure(self, softName, reason):
+    '''Registers a failed unit and returns True if the software is tripped by it'''
+    self.failures[softName] = self.failures.get(softName, 0) + 1
+    if self.maxFailures and self.failures[softName] >= self.maxFailures and not self.isTripped(softName):
+      self.trip(softName, f'{self.failures[softName]} consecutive failures, last: {reason}')
+      return True
+    return False
+
+
+def runLocalUnits(units, sequences, metricsFile=None):
+  '''Runs the work units of the local evaluators in this process, scoring all the sequences of each evaluator in a
+  single batch, and returns their scores as {unitIdx: {evalKey: [scores]}}'''
+  seqKeys, localScores = list(sequences.keys()), {}
+  for unitIdx, unit in enumerate(units):
+    if getEvaluatorKind(unit['software']) == 'local' and unitIdx not in localScores:
+      softUnits = [uIdx for uIdx, u in enumerate(units) if u['software'] == unit['software']]
+      for evalKey, paramDic in unit['evals'].items():
+        scores = callLocalEvaluator(unit['software'], sequences, paramDic, metricsFile=metricsFile)['Score']
+        # Scores split back into the chunks of the units
+        seqScores = dict(zip(seqKeys, scores))
+        for uIdx in softUnits:
+          if evalKey in units[uIdx]['evals']:
+            localScores.setdefault(uIdx, {})[evalKey] = [seqScores[seqKey] for seqKey in units[uIdx]['seqKeys']]
+  return localScores
+
+
+def _readLatencyHistory(historyFile):
+  '''Reads the latency history file, empty if it does not exist or cannot be read'''
+  if not os.path.exists(historyFile):
+    return {}
+  try:
+    with open(historyFile) as f:
+      return json.load(f)
+  except (OSError, ValueError) as e:
+    print(f'Latency history {historyFile} could not be read, it is ignored: {e}')
+    return {}
+
+
+def loadLatencyHistory(historyFile):
+  '''Returns the latency history stored in historyFile as {softwareName: [latencies per sequence]}. It is read under
+  the lock of updateLatencyHistory, and it is empty if the file does not exist or cannot be read'''
+  if not historyFile or not os.path.exists(historyFile):
+    return {}
+  import fcntl
+  with open(historyFile + '.lock', 'a') as lockFile:
+    fcntl.flock(lockFile, fcntl.LOCK_SH)
+    return _readLatencyHistory(historyFile)
+
+
+def updateLatencyHistory(historyFile, latencies, maxHistory=100):
+  '''Adds the latencies per sequence {softwareName: [latencies]} to the history in historyFile, keeping the last
+  maxHistory values of each software. The file is locked while updated since several runs may share it, and it is
+  replaced by a complete new file, so it is never read half written'''
+  import fcntl, tempfile
+  historyDir = os.path.dirname(os.path.abspath(historyFile))
+  os.makedirs(historyDir, exist_ok=True)
+  with open(historyFile + '.lock', 'a') as lockFile:
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    history = _readLatencyHistory(historyFile)
+    for softName, softLatencies in latencies.items():
+      history[softName] = (history.get(softName, []) + softLatencies)[-maxHistory:]
+    fd, tmpFile = tempfile.mkstemp(dir=historyDir, prefix='.latencyHistory', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(history, f)
+      os.replace(tmpFile, historyFile)
+    except BaseException:
+      os.remove(tmpFile)
+      raise
+
+
+def getSoftLatencies(softNames, history):
+  '''Returns the estimated latency per sequence of each software as {softwareName: latency}: the median of its
+  history or, if it has none, the median of the rest of estimations (1 if there is no history at all)'''
+  softLatencies = {softName: getPercentile(history[softName], 50) for softName in softNames if history.get(softName)}
+  default = getPercentile(list(softLatencies.values()), 50) if softLatencies else 1
+  return {softName: softLatencies.get(softName, default) for softName in softNames}
+
+
+def getBalancedChunkSize(nSeqs, softLatencies, jobs, maxChunkSize, minChunkSize=10, unitsPerJob=3):
+  '''Returns the chunk size so that the longest unit, the one of the slowest software, takes 1/unitsPerJob of the
+  ideal time per worker, so the workers can finish together. It is kept between minChunkSize and maxChunkSize
+  - softLatencies: dic, estimated latency per sequence of each software {softwareName: latency}
+  '''
+  jobTime = nSeqs * sum(softLatencies.values()) / (jobs * unitsPerJob)
+  chunkSize = int(jobTime / max(softLatencies.values()))
+  return max(min(chunkSize, maxChunkSize), min(minChunkSize, maxChunkSize))
+
+
+def sortUnitsLPT(units, softLatencies):
+  '''Returns the work units sorted by their estimated time, longest first (longest processing time scheduling)'''
+  return sorted(units, key=lambda unit: -softLatencies[unit['software']] * len(unit['seqKeys']))
+
+
+def evaluateSequences(sequences, evalDics, jobs=1, browserData={}, chunkSize=None, sweep=False, onChunk=None,
+                      verbose=True, timeout=None, hedgePercentile=None, minHedgeHistory=3, metricsFile=None,
+                      historyFile=None, memoryBudget=None, maxFailures=3, timeBudget=None, priorities=None):
+  '''Evaluates a set of sequences running the (evaluator, chunk) work units in a pool of workers.
+  - sequences: dic, sequences in the form: {seqKey: sequence}
+  - evalDics: dic, evaluators as {evalKey: {"software": softwareName, parameterName: parameterValue}}
+  - jobs: int, number of jobs for parallelization
+  - chunkSize: int, maximum number of sequences in each unit. All of them in a single chunk if None or 0
+  - sweep: bool, run the evaluators of the same software as a parameter sweep in a single browser session
+  - onChunk: func, if not None, called as onChunk(seqKeys, {(evalKey, softwareName): [scores]}) as soon as all the
+  evaluators finish a chunk of sequences. With timeBudget and priorities, the chunks follow the priority order
+  - timeout: float, deadline in seconds for each unit. The units exceeding it get NaN scores
+  - hedgePercentile: float, percentile (0-100) of the previous units latency of each software. If a running unit
+  exceeds it, a duplicate of the unit is submitted: the first one to finish is used and the other is cancelled.
+  No hedging if None or 0
+  - minHedgeHistory: int, number of finished units of a software before its units can be hedged
+  - metricsFile: str, if not None, file where the units timing and the hedged and timed out requests are registered
+  - historyFile: str, if not None, json file with the latency history of the software (see updateLatencyHistory).
+  It is used to run the longest units first and to reduce chunkSize so the workers finish together, and it is
+  updated with the latencies of this evaluation
+  - memoryBudget: float, memory in MB for the workers and their browsers. It limits the number of workers and of live
+  browsers (hedged requests included), the extra units waiting in queue, and no new browsers are started while the
+  memory measured exceeds it (see MemoryGovernor). No limit if None or 0
+  The local evaluators (see registerLocalEvaluator) score all the sequences in a single batch in this process.
+  The workers write the scores in a matrix in shared memory, read in place by this process, instead of pickling them.
+  - maxFailures: int, consecutive failed units (errors or timeouts) after which a software circuit breaker trips.
+  The web servers are also probed before dispatch, the unhealthy ones being tripped from the start. The units of a
+  tripped software fail fast with NaN scores, leaving the workers to the rest. If None or 0, there is no probe nor
+  breaker and the errors of the units are raised
+  - timeBudget: float, if not None, seconds available for the evaluation (best effort mode). The units are submitted
+  in chunk order as workers get free, while their estimated latency (observed or from the history) fits in the time
+  left, and the running ones are aborted when it runs out. The units not evaluated get NaN scores, and the ones
+  aborted by the end of the budget are not counted as failures by the circuit breaker
+  - priorities: dic, {seqKey: priority} used with timeBudget to place the sequences with higher priority in the first
+  chunks, which are evaluated first
+  Returns a dictionary of the form: {(evalKey, softwareName): [scores]}, in the order of sequences
+  '''
+  seqKeys, deadline = list(sequences.keys()), None
+  if not seqKeys:
+    return {(evalKey, evalDic['software']): [] for evalKey, evalDic in evalDics.items()
+            if getEvaluatorKind(evalDic['software'])}
+  if timeBudget is not None:
+    deadline = time.time() + timeBudget
+    if priorities:
+      sequences = {seqKey: sequences[seqKey] for seqKey in sorted(seqKeys, key=lambda k: -priorities.get(k, 0))}
+
+  units = buildEvaluationUnits(list(sequences.keys()), evalDics, chunkSize, sweep)
+  if not units:
+    return {}
+
+  if historyFile:
+    softLatencies = getSoftLatencies({unit['software'] for unit in units}, loadLatencyHistory(historyFile))
+    if chunkSize:
+      chunkSize = getBalancedChunkSize(len(sequences), softLatencies, jobs, chunkSize)
+      units = buildEvaluationUnits(list(sequences.keys()), evalDics, chunkSize, sweep)
+    units = sortUnitsLPT(units, softLatencies)
+  if deadline is not None:
+    # The most prioritary chunks go first, the longest units first within each chunk
+    units = sorted(units, key=lambda unit: unit['chunk'])
+  historyLatencies = softLatencies if historyFile else {}
+
+  maxTabs = getSoftMaxTabs({unit['software'] for unit in units})
+  # The pools keep the same size along the calls (e.g. streaming batches with different number of units) to be reused
+  nJobs = getBudgetSlots(jobs, memoryBudget, maxTabs)
+  # The hedged requests share the browser slots of the budget with the main workers
+  nSlots = nJobs if memoryBudget else None
+  pool = getWorkerPool('evaluation', nJobs, nSlots)
+  hedgePool = getWorkerPool('hedging', max(1, nJobs // 2), nSlots) if hedgePercentile else None
+  manager = getWorkerContext().Manager()
+  control = manager.dict()
+
+  breaker = CircuitBreaker(maxFailures)
+  def tripSoftware(softName, reason):
+    breaker.trip(softName, reason)
+    # Running and queued attempts of the software are aborted (see runEvaluationAttempt)
+    control[('tripped', softName)] = True
+    print(f'{softName} circuit breaker tripped ({reason}): NaN scores assigned to its remaining chunks')
+    logCounter(metricsFile, 'breakerTrips', softName)
+
+  localScores = runLocalUnits(units, sequences, metricsFile)
+  if maxFailures:
+    webSofts = {unit['software'] for unitIdx, unit in enumerate(units) if unitIdx not in localScores}
+    for softName, (isHealthy, message) in probeSoftwares(webSofts).items():
+      if not isHealthy:
+        tripSoftware(softName, f'health probe failed: {message}')
+
+  # Sequences x evaluators score matrix shared with the workers. The units cover consecutive sequences (rows)
+  seqRows = {seqKey: rowIdx for rowIdx, seqKey in enumerate(sequences)}
+  evalCols, evalSofts = {}, {}
+  for unit in units:
+    for evalKey in unit['evals']:
+      evalCols.setdefault(evalKey, len(evalCols))
+      evalSofts[evalKey] = unit['software']
+  # Only this frame references the matrix, so that no views of the block remain when it is released
+  shm, scoreMatrix = createSharedMatrix((len(sequences), len(evalCols)))
+  matrixShape = scoreMatrix.shape
+
+  def submitAttempt(unitIdx, attemptPool):
+    attemptKey, attemptTimeout = (unitIdx, len(attempts[unitIdx])), timeout
+    if deadline is not None:
+      timeLeft = max(deadline - time.time(), 1e-3)
+      attemptTimeout = min(timeout, timeLeft) if timeout else timeLeft
+      if not timeout or timeLeft < timeout:
+        # Its timeout is the end of the time budget, not a server failure
+        budgetAttempts.add(attemptKey)
+    unitSeqs = {seqKey: sequences[seqKey] for seqKey in units[unitIdx]['seqKeys']}
+    sharedScores = (shm.name, matrixShape, seqRows[units[unitIdx]['seqKeys'][0]], evalCols)
+    attempts[unitIdx][attemptKey] = attemptPool.apply_async(runEvaluationAttempt,
+                                                            args=(units[unitIdx], unitSeqs, browserData, attemptKey,
+                                                                  control, attemptTimeout, sharedScores))
+
+  def getUnitEstimate(unit):
+    '''Estimated seconds to run a unit: its sequences by the latency per sequence of its software observed in this
+    evaluation or, if none, in the history (0 if unknown)'''
+    softLatencies = latencies.get(unit['software'])
+    seqLatency = getPercentile(softLatencies, 50) if softLatencies else historyLatencies.get(unit['software'], 0)
+    return seqLatency * len(unit['seqKeys'])
+
+  def submitPendingUnits():
+    '''In best effort mode, submits the next pending units to the free workers while they fit in the time left'''
+    nRunning = len([uIdx for uIdx, uAttempts in attempts.items() if uAttempts and uIdx not in unitScores])
+    while pendingUnits and nRunning < nJobs:
+      unit = units[pendingUnits[0]]
+      if not breaker.isTripped(unit['software']) and time.time() + getUnitEstimate(unit) > deadline:
+        print(f'Time budget: {len(pendingUnits)} evaluation units would not finish in time, NaN scores assigned')
+        for uIdx in pendingUnits:
+          logCounter(metricsFile, 'skippedSequences', units[uIdx]['software'], len(units[uIdx]['seqKeys']))
+        skippedUnits.update(pendingUnits)
+        pendingUnits.clear()
+      elif not breaker.isTripped(unit['software']):
+        submitAttempt(pendingUnits.pop(0), pool)
+        nRunning += 1
+      else:
+        pendingUnits.pop(0)
+
+  attempts = {unitIdx: {} for unitIdx in range(len(units))}
+  pendingUnits = [unitIdx for unitIdx in attempts
+                  if unitIdx not in localScores and not breaker.isTripped(units[unitIdx]['software'])]
+  skippedUnits, unitScores, latencies, budgetAttempts = set(), {}, {}, set()
+  governor = startMemoryGovernor(memoryBudget, nSlots, maxTabs)
+  try:
+    if deadline is None:
+      for unitIdx in pendingUnits:
+        submitAttempt(unitIdx, pool)
+      pendingUnits.clear()
+
+    # latencies: latency per sequence of the finished units of each software
+    while len(unitScores) < len(units):
+      submitPendingUnits()
+      time.sleep(1)
+      for unitIdx, unitAttempts in attempts.items():
+        if unitIdx in unitScores:
+          continue
+        unit = units[unitIdx]
+        if unitIdx in localScores:
+          unitScores[unitIdx] = localScores[unitIdx]
+          unitAttempts = {}
+        elif breaker.isTripped(unit['software']) or unitIdx in skippedUnits:
+          unitScores[unitIdx] = getNaNScores(unit)
+          unitAttempts = {}
+        elif not unitAttempts:
+          # Pending in best effort mode
+          continue
+
+        for attemptKey, res in unitAttempts.items():
+          if res.ready() and res.successful():
+            res.get()
+            unitScores[unitIdx] = readSharedRows(scoreMatrix, seqRows[unit['seqKeys'][0]], len(unit['seqKeys']),
+                                                 {evalKey: evalCols[evalKey] for evalKey in unit['evals']})
+            logTask(metricsFile, 'evaluation', unit['software'], control[('start', attemptKey)],
+                    control[('end', attemptKey)], len(unit['seqKeys']), chunk=unit['chunk'], attempt=attemptKey[1])
+            uLatency = (control[('end', attemptKey)] - control[('start', attemptKey)]) / max(1, len(unit['seqKeys']))
+            latencies.setdefault(unit['software'], []).append(uLatency)
+            breaker.recordSuccess(unit['software'])
+            for otherKey in unitAttempts:
+              if otherKey != attemptKey:
+                control[('cancel', otherKey)] = True
+            break
+
+        if unitIdx not in unitScores and all([res.ready() for res in unitAttempts.values()]):
+          # All the attempts failed
+          attemptKey, status, isFailure = list(unitAttempts.keys())[-1], 'timeout', True
+          try:
+            unitAttempts[attemptKey].get()
+          except RequestTimeout as e:
+            reason = str(e)
+            if attemptKey in budgetAttempts:
+              # Stopped by the end of the time budget: its sequences are skipped, not counted by the breaker
+              reason, status, isFailure = 'time budget exhausted', 'skipped', False
+              logCounter(metricsFile, 'skippedSequences', unit['software'], len(unit['seqKeys']))
+            else:
+              logCounter(metricsFile, 'timeouts', unit['software'])
+          except Exception as e:
+            if not maxFailures:
+              raise
+            reason, status = f'{type(e).__name__}: {e}', 'failed'
+            logCounter(metricsFile, 'failedRequests', unit['software'])
+
+          print(f'{unit["software"]} evaluation of chunk {unit["chunk"]} aborted ({reason}): NaN scores assigned')
+          unitScores[unitIdx] = getNaNScores(unit)
+          logTask(metricsFile, 'evaluation', unit['software'], control[('start', attemptKey)],
+                  control[('end', attemptKey)], len(unit['seqKeys']), status=status, chunk=unit['chunk'],
+                  attempt=attemptKey[1])
+          if isFailure and breaker.recordFailure(unit['software'], reason):
+            tripSoftware(unit['software'], breaker.tripped[unit['software']])
+
+        elif unitIdx not in unitScores and hedgePool and len(unitAttempts) == 1 and \
+                len(latencies.get(unit['software'], [])) >= minHedgeHistory:
+          attemptKey = list(unitAttempts.keys())[0]
+          if ('start', attemptKey) in control:
+            threshold = getPercentile(latencies[unit['software']], hedgePercentile) * len(unit['seqKeys'])
+            if time.time() - control[('start', attemptKey)] > threshold:
+              if verbose:
+                print(f'{unit["software"]} evaluation of chunk {unit["chunk"]} exceeded {round(threshold, 1)}s: '
+                      f'submitting a hedged request')
+              submitAttempt(unitIdx, hedgePool)
+              logCounter(metricsFile, 'hedgedRequests', unit['software'])
+
+        if unitIdx in unitScores:
+          if verbose:
+            print(f'{unit["software"]} evaluation of chunk {unit["chunk"]} finished '
+                  f'({len(unitScores)} / {len(units)})')
+
+          chunkUnits = [uIdx for uIdx, u in enumerate(units) if u['chunk'] == unit['chunk']]
+          if onChunk and all([uIdx in unitScores for uIdx in chunkUnits]):
+            onChunk(unit['seqKeys'], mergeUnitScores(units, {uIdx: unitScores[uIdx] for uIdx in chunkUnits}))
+
+    if historyFile:
+      updateLatencyHistory(historyFile, latencies)
+
+    # The scores computed in this process (local, NaN) are also gathered in the matrix
+    for unitIdx, scores in unitScores.items():
+      rowStart = seqRows[units[unitIdx]['seqKeys'][0]]
+      for evalKey, values in scores.items():
+        scoreMatrix[rowStart:rowStart + len(values), evalCols[evalKey]] = values
+    rowOrder = [seqRows[seqKey] for seqKey in seqKeys]
+    return {(evalKey, evalSofts[evalKey]): scoreMatrix[rowOrder, colIdx].tolist()
+            for evalKey, colIdx in evalCols.items()}
+  finally:
+    if governor:
+      governor.stop()
+    manager.shutdown()
+    # The unit scores are copies, the matrix is the only export of the shared block
+    del scoreMatrix
+    releaseSharedMatrix(shm)
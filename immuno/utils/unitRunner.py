@@ -0,0 +1,91 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Runs an evaluation work unit stored in a json file (see writeUnitFile) and writes its scores to another json file.
+It allows to run the units as independent jobs, distributed by MPI or a queue system:
+    python -m immuno.utils.unitRunner <unitFile> <scoresFile> [<metricsFile>]
+"""
+
+import sys, time, json
+
+from .utils import RequestTimeout, setRequestControl, probeSoftware
+from .scheduling import runEvaluationUnit, getNaNScores
+from .registry import getEvaluatorKind, ensureRegistered
+from .metrics import logTask, logCounter, logMetric
+from .resources import MemoryMonitor
+
+def writeUnitFile(unitFile, unit, sequences, browserData={}, timeout=None, healthProbe=False):
+  '''Writes the information needed to run an evaluation work unit in a json file
+  - unit: dic, work unit (see buildEvaluationUnits)
+  - sequences: dic, {seqKey: sequence} containing at least the unit sequences
+  - timeout: float, deadline in seconds for the unit, which gets NaN scores if exceeded
+  - healthProbe: bool, probe the software web server before the unit, which gets NaN scores if it is not healthy
+  '''
+  # Sequences stored as a list since json would convert non string keys
+  unitDic = {'unit': unit, 'sequences': [sequences[seqKey] for seqKey in unit['seqKeys']],
+             'browserData': browserData, 'timeout': timeout, 'healthProbe': healthProbe}
+  with open(unitFile, 'w') as f:
+    json.dump(unitDic, f)
+
+def runUnitFile(unitFile, scoresFile, metricsFile=None):
+  '''Runs the evaluation work unit in unitFile and writes its scores as {evalKey: [scores]} in scoresFile.
+  If metricsFile is not None, the unit timing is registered in it'''
+  with open(unitFile) as f:
+    unitDic = json.load(f)
+  unit, timeout = unitDic['unit'], unitDic['timeout']
+  sequences = dict(zip(unit['seqKeys'], unitDic['sequences']))
+
+  startTime, status = time.time(), 'ok'
+  memMonitor = MemoryMonitor()
+  memMonitor.start()
+  setRequestControl(deadline=startTime + timeout if timeout else None)
+  isHealthy, message = (True, '')
+  ensureRegistered(unit['software'], unit.get('entry'))
+  if unitDic.get('healthProbe') and getEvaluatorKind(unit['software']) == 'web':
+    isHealthy, message = probeSoftware(unit['software'])
+  if not isHealthy:
+    print(f'{unit["software"]} evaluation of chunk {unit["chunk"]} skipped (health probe failed: {message}): '
+          f'NaN scores assigned')
+    scores, status = getNaNScores(unit), 'failed'
+    logCounter(metricsFile, 'failedRequests', unit['software'])
+  else:
+    try:
+      scores = runEvaluationUnit(unit, sequences, unitDic['browserData'])
+    except RequestTimeout as e:
+      print(f'{unit["software"]} evaluation of chunk {unit["chunk"]} aborted ({e}): NaN scores assigned')
+      scores, status = getNaNScores(unit), 'timeout'
+      logCounter(metricsFile, 'timeouts', unit['software'])
+  logTask(metricsFile, 'evaluation', unit['software'], startTime, time.time(), len(unit['seqKeys']), status=status,
+          chunk=unit['chunk'])
+  logMetric(metricsFile, 'memory', peakMB=memMonitor.stop())
+
+  with open(scoresFile, 'w') as f:
+    json.dump(scores, f)
+
+
+if __name__ == "__main__":
+  runUnitFile(*sys.argv[1:4])
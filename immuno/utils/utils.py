@@ -24,32 +24,81 @@
 # *
 # **************************************************************************
 
-import time, os, requests
+import time, os, queue, requests
 from Bio import SeqIO
 
-from ..constants import EVAL_PARAM_MAP
+from ..constants import EVAL_PARAM_MAP, STANDARD_AAS
+from .metrics import logTask
 
-def runEpitopeSelection(softwareName, argsDic, browserData={}):
+def runEpitopeSelection(softwareName, argsDic, browserData={}, outQueue=None, queueKey=None, metricsFile=None):
   ''' Run an epitope selector program with the specified arguments and parse the results
   :param softwareName: Selector software to call
   :param argsDic: dictionary containing the arguments for the selector. Keys must be the ones expected by the program
+  :param outQueue: if not None, queue where the results of each protein are put as soon as they are parsed,
+  as (queueKey, {seq_id: epitopesDic})
+  :param metricsFile: if not None, file where the selection timing is registered
   :return: {seq_id: {(position, epitopeString): meanScore}}
   '''
+  onBatch, startTime = None, time.time()
+  if outQueue is not None:
+    onBatch = lambda batchDic: outQueue.put((queueKey, batchDic))
+
   if softwareName.lower() == 'abcpred':
     protsDic = parseInputProteins(argsDic['i'])
     if browserData:
-      epiDic = callABCpredSelenium(protsDic, browserData, argsDic)
+      epiDic = callABCpredSelenium(protsDic, browserData, argsDic, onBatch=onBatch)
     else:
-      epiDic = callABCpred(protsDic, argsDic)
+      epiDic = callABCpred(protsDic, argsDic, onBatch=onBatch)
 
   elif softwareName.lower() == 'lbtope':
     protsDic = parseInputProteins(argsDic['i'])
-    epiDic = callLBtope(protsDic, browserData, argsDic)
+    epiDic = callLBtope(protsDic, browserData, argsDic, onBatch=onBatch)
+
+  elif softwareName.lower() == 'windows':
+    protsDic = parseInputProteins(argsDic['i'])
+    lengths = [int(length) for length in str(argsDic['winLengths']).split(',') if length.strip()]
+    epiDic = getSlidingWindows(protsDic, lengths, int(argsDic['winStride']), onBatch=onBatch)
 
+  logTask(metricsFile, 'selection', softwareName, startTime, time.time(), len(protsDic))
   return epiDic
 
 
 
+def getSlidingWindows(protsDic, lengths, stride=1, onBatch=None):
+  '''Generates locally the overlapping windows (k-mers) of the proteins, in the format of the epitope selectors.
+  The identical windows are only kept once, in their first protein and position
+  :param protsDic: {seqName: seqStr}
+  :param lengths: list of window lengths
+  :param stride: step between the beginning of consecutive windows
+  :param onBatch: if not None, called with {seqName: windowsDic} for each protein
+  :return: {seqName: {'Sequence': [windows], 'Position': [1-based positions], 'Score': [NaN]}}
+  '''
+  import numpy as np
+  from numpy.lib.stride_tricks import sliding_window_view
+  seen, epiDic = set(), {}
+  for seqName, seq in protsDic.items():
+    seqArr = np.frombuffer(str(seq).encode(), dtype=np.uint8)
+    winDic = {'Sequence': [], 'Position': [], 'Score': []}
+    for length in lengths:
+      if length > len(seqArr):
+        continue
+      windows = np.ascontiguousarray(sliding_window_view(seqArr, length)[::stride]).view(f'S{length}').ravel()
+      # First occurrence of each window in the protein
+      uniWindows, firstIdxs = np.unique(windows, return_index=True)
+      for winIdx in np.sort(firstIdxs):
+        window = windows[winIdx].decode()
+        if window not in seen:
+          seen.add(window)
+          winDic['Sequence'].append(window)
+          winDic['Position'].append(int(winIdx) * stride + 1)
+          winDic['Score'].append(float('nan'))
+
+    epiDic[seqName] = winDic
+    if onBatch:
+      onBatch({seqName: winDic})
+  return epiDic
+
+
 def parseInputProteins(faFile):
   '''Uses BioPython to parse a fasta file and return it as dictionary
   :param faFile: input fasta filename
@@ -61,6 +110,17 @@ def parseInputProteins(faFile):
         faDic[values[0]] = values[1]
   return faDic
 
+def getROIParentSequences(roiSet):
+  '''Returns the parent sequences of a set of ROIs stored in compact mode, where the ROIs only keep the id of their
+  parent sequence, stored once in a fasta file
+  :param roiSet: SetOfSequenceROIs
+  :return: {parentId: sequence}, empty if the ROIs were not stored in compact mode
+  '''
+  parentFile = getattr(roiSet, '_parentSequencesFile', None)
+  if parentFile is None or not parentFile.get() or not os.path.exists(parentFile.get()):
+    return {}
+  return parseInputProteins(parentFile.get())
+
 
 def reportPoolStatus(poolDic):
   '''Check the status of the AsynPool objects stored as values of the dictionary and reports when they finish
@@ -74,6 +134,27 @@ def reportPoolStatus(poolDic):
         print(f'{evalSoft} execution finished ({len(ready)} / {len(poolDic)})')
 
 
+def consumePoolQueue(outQueue, poolDic, callback):
+  '''Calls callback(key, item) with each (key, item) element put in the queue by the AsyncResult objects stored as
+  values of the dictionary, until all of them finish and the queue is empty. Reports when each of them finishes
+  '''
+  ready = []
+  while True:
+    allReady = all([po.ready() for po in poolDic.values()])
+    try:
+      callback(*outQueue.get(timeout=1))
+      continue
+    except queue.Empty:
+      pass
+
+    for key, po in poolDic.items():
+      if po.ready() and key not in ready:
+        ready.append(key)
+        print(f'{key} execution finished ({len(ready)} / {len(poolDic)})')
+    if allReady:
+      break
+
+
 
 def divide_chunks(iter, chunkSize):
   '''Divides an iterable into chunks of size chunkSize'''
@@ -98,15 +179,25 @@ def getFastaStrs(seqDic, maxChunk=1):
   return buildSeqFasta(seqLists)
 
 def getFastaFiles(seqDic, evalSoft, maxChunk=1):
-  '''Write a series of fasta files with maxChunk number of sequences from a set of sequences'''
+  '''Write a series of fasta files with maxChunk number of sequences from a set of sequences. The files get unique
+  temporary names, so concurrent workers do not overwrite each other, and must be removed by the caller'''
+  import tempfile
   fastaStrs = getFastaStrs(seqDic, maxChunk)
   faFiles = []
   for i, fStr in enumerate(fastaStrs):
-    faFiles.append(f'/tmp/{evalSoft}_input_{i}.fa')
-    with open(faFiles[-1], 'w') as f:
+    fd, faFile = tempfile.mkstemp(prefix=f'{evalSoft}_input_{i}_', suffix='.fa')
+    with os.fdopen(fd, 'w') as f:
       f.write(fStr)
+    faFiles.append(faFile)
   return faFiles
 
+def removeFastaFiles(seqData, softData):
+  '''Removes the temporary fasta files built by getSeqData for the file upload'''
+  if softData['multi'] and softData['seqFormat'] == 'fastaFile':
+    for faFile in seqData:
+      if os.path.exists(faFile):
+        os.remove(faFile)
+
 def setData(driver, paramDic):
   '''Sets the additional data parameters in the web of the software evaluation
   driver: selenium driver, with url set in the software web
@@ -121,16 +212,81 @@ def setData(driver, paramDic):
   return driver
 
 
+# Resources not needed to fill the forms and parse the results, blocked in the browser
+BLOCKED_RESOURCES = ['*.css', '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.ico', '*.woff', '*.woff2', '*.ttf',
+                     '*.otf', '*google-analytics.com*', '*googletagmanager.com*']
+
+def lockCacheDir(cacheDir, maxSlots=64):
+  '''Returns a subdirectory of cacheDir not being used by another browser and the open file that locks it (the lock
+  is released when the file is closed, also if the process dies). So the cache persists between runs while running
+  browsers do not share it. Returns (None, None) if no subdirectory is free'''
+  import fcntl
+  os.makedirs(cacheDir, exist_ok=True)
+  for slot in range(maxSlots):
+    lockFile = open(os.path.join(cacheDir, f'browser_{slot}.lock'), 'w')
+    try:
+      fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      lockFile.close()
+      continue
+    slotDir = os.path.join(cacheDir, f'browser_{slot}')
+    os.makedirs(slotDir, exist_ok=True)
+    return slotDir, lockFile
+  return None, None
+
+def unlockCacheDir(lockFile):
+  '''Releases a cache subdirectory locked by lockCacheDir. Nothing is done if lockFile is None'''
+  if lockFile is not None:
+    import fcntl
+    try:
+      fcntl.flock(lockFile, fcntl.LOCK_UN)
+    finally:
+      lockFile.close()
+
+# Drivers kept alive between requests when warm sessions are enabled (see setWarmDrivers), as {browserKey: driver}
+_warmDrivers = {'enabled': False, 'drivers': {}}
+
+def setWarmDrivers(enabled=True):
+  '''Enables the warm sessions in this process: getDriver reuses a live driver per browser configuration and
+  closeDriver keeps it open for the next request. The drivers are quit when the process finishes.
+  Meant to be used as initializer of long-lived workers (see the request broker)'''
+  from multiprocessing import util
+  _warmDrivers['enabled'] = enabled
+  if enabled:
+    util.Finalize(None, quitWarmDrivers, exitpriority=10)
+
+def quitWarmDrivers():
+  for driver in _warmDrivers['drivers'].values():
+    driver._warmKey = None
+    closeDriver(driver)
+  _warmDrivers['drivers'].clear()
+
 def getDriver(browserData):
+  '''Returns a driver for the requests (see createDriver), the warm one of this browser configuration if the warm
+  sessions are enabled. It must be closed with closeDriver'''
+  if _warmDrivers['enabled']:
+    browserKey = str(sorted(browserData.items()))
+    if browserKey not in _warmDrivers['drivers']:
+      _warmDrivers['drivers'][browserKey] = createDriver(browserData)
+      _warmDrivers['drivers'][browserKey]._warmKey = browserKey
+    return _warmDrivers['drivers'][browserKey]
+  return createDriver(browserData)
+
+def createDriver(browserData):
   from selenium import webdriver
   from selenium.webdriver.chrome.options import Options as ChromeOptions
   from selenium.webdriver.firefox.options import Options as FireOptions
-  '''Return a selenium WebDriver object, depending on the selected browser
+  '''Return a selenium WebDriver object, depending on the selected browser, with a lightweight profile: eager page
+  load, blocked images, styles, fonts and analytics, no extensions, GPU or background networking
   - browserData: dic, contains the information about the browser to be used
     - name: str, the name of the browser to use (either "Chrome" for Google-Chrome or Firefox)
     - path: str, path for the browser executable in case of non default
+    - cacheDir: str, if not None, directory where the browsers keep a persistent disk cache
+    - noSandbox: bool, run Chrome without its sandbox and /dev/shm, for containers where it cannot start otherwise
+  The driver takes a browser slot (see setDriverSlots), so it must be closed with closeDriver
   '''
-  if not 'name' in browserData or browserData['name'] != 'Firefox':
+  isFirefox = 'name' in browserData and browserData['name'] == 'Firefox'
+  if not isFirefox:
     options = ChromeOptions()
     driverObj = webdriver.Chrome
     browserPath = '/usr/bin/google-chrome' if (not 'path' in browserData or not browserData['path'])\
@@ -142,12 +298,62 @@ def getDriver(browserData):
       else browserData['path']
 
   options._binary_location = browserPath
+  # The forms are available once the DOM is parsed, no need to wait for the rest of resources
+  options.page_load_strategy = 'eager'
   options.add_argument('--headless')
-  options.add_argument('--remote-debugging-pipe')
-  driver = driverObj(options=options)
+  cacheDir, cacheLock = None, None
+  if browserData.get('cacheDir'):
+    cacheDir, cacheLock = lockCacheDir(browserData['cacheDir'])
+
+  if not isFirefox:
+    for arg in ['--remote-debugging-pipe', '--disable-extensions', '--disable-gpu', '--disable-background-networking',
+                '--blink-settings=imagesEnabled=false']:
+      options.add_argument(arg)
+    if browserData.get('noSandbox'):
+      options.add_argument('--no-sandbox')
+      options.add_argument('--disable-dev-shm-usage')
+    options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2,
+                                              'profile.managed_default_content_settings.fonts': 2})
+    if cacheDir:
+      options.add_argument(f'--disk-cache-dir={cacheDir}')
+  else:
+    for prefName, prefValue in [('permissions.default.image', 2), ('browser.display.use_document_fonts', 0),
+                                ('extensions.enabled', False), ('layers.acceleration.disabled', True),
+                                ('network.prefetch-next', False), ('app.update.enabled', False),
+                                ('datareporting.policy.dataSubmissionEnabled', False)]:
+      options.set_preference(prefName, prefValue)
+    if cacheDir:
+      options.set_preference('browser.cache.disk.parent_directory', cacheDir)
+
+  acquireDriverSlot()
+  driver = None
+  try:
+    driver = driverObj(options=options)
+    if not isFirefox:
+      driver.execute_cdp_cmd('Network.enable', {})
+      driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_RESOURCES})
+  except Exception:
+    if driver is not None:
+      driver.quit()
+    releaseDriverSlot()
+    unlockCacheDir(cacheLock)
+    raise
+  # Kept with the driver so the cache directory stays locked while it is alive, released by closeDriver
+  driver._cacheLock = cacheLock
   return driver
 
 
+def fillElement(driver, element, value):
+  '''Writes a value in a form element. File inputs get the path of the file to upload. The rest get the value set in
+  a single script call, firing the events the pages may listen to, instead of typing it key by key with send_keys,
+  so the time does not depend on the size of the batch'''
+  if element.get_attribute('type') == 'file':
+    element.send_keys(os.path.abspath(value))
+  else:
+    driver.execute_script("arguments[0].value = arguments[1];"
+                          "arguments[0].dispatchEvent(new Event('input', {bubbles: true}));"
+                          "arguments[0].dispatchEvent(new Event('change', {bubbles: true}));", element, value)
+
 def performRequest(seqKeys, driver, softData):
   from selenium.webdriver.common.by import By
   '''Performs a request in a evaluation software using selenium to emulate the browser.
@@ -160,14 +366,21 @@ def performRequest(seqKeys, driver, softData):
     - submitCSS: str, css selector to identify the submit button (e.g: "input[name='Submit']")
   - seqKeys: dic, if not None, specifies the web html name key and value to write the sequence name. e.g: {seqName: seq1}
   '''
-  driver.get(softData['url'])
-
-  for xKeyName, xKeyVal in seqKeys.items():
-    extraElem = driver.find_element(By.NAME, xKeyName)
-    extraElem.send_keys(xKeyVal)
-
-  driver = setData(driver, softData['params'])
-  driver.find_elements(By.CSS_SELECTOR, softData['submitCSS'])[0].click()
+  from selenium.common.exceptions import TimeoutException
+  try:
+    # The page loads (navigation and submission) cannot last beyond the request deadline
+    setPageLoadTimeout(driver)
+    driver.get(softData['url'])
+
+    for xKeyName, xKeyVal in seqKeys.items():
+      fillElement(driver, driver.find_element(By.NAME, xKeyName), xKeyVal)
+
+    driver = setData(driver, softData['params'])
+    setPageLoadTimeout(driver)
+    driver.find_elements(By.CSS_SELECTOR, softData['submitCSS'])[0].click()
+  except TimeoutException:
+    checkRequestControl()
+    raise
   return driver
 
 
@@ -177,7 +390,8 @@ def getSeqData(seqDic, softData):
   - seqDic: dic, sequences {seqId: seqString}
   - softData: dic, containing all the characteristics and info for the specific sofware web. Among others (key: value):
     - multi: whether the web admits multiple sequences at one time
-    - seqFormat: whether to return a fasta file ("fastaFile") or the fasta string ("fastaString")
+    - seqFormat: whether to return a fasta file ("fastaFile", uploaded through the file input named seqName, see
+    fillElement) or the fasta string ("fastaString")
     - softName: software name for the fasta file to be named
   '''
   if softData['multi']:
@@ -201,7 +415,94 @@ def updateBatchDic(outDic, batchDic):
   return outDic
 
 
-def seleniumRequest(seqDic, softData, browserData, parseFunction, seqNameKey=None):
+class RequestTimeout(Exception):
+  '''Raised when a request exceeds its deadline or is cancelled (see setRequestControl)'''
+  pass
+
+# Seconds a page can take to load in the requests without deadline (the Selenium default)
+PAGE_LOAD_TIMEOUT = 300
+
+# Deadline and cancellation check of the requests performed by this process
+_requestControl = {'deadline': None, 'isCancelled': None}
+
+def setRequestControl(deadline=None, isCancelled=None):
+  '''Sets the control of the requests performed by this process, checked while waiting for the results
+  - deadline: float, epoch time after which the requests are aborted. No deadline if None
+  - isCancelled: func, returns whether the requests must be aborted. Not checked if None
+  '''
+  _requestControl.update({'deadline': deadline, 'isCancelled': isCancelled})
+
+def getRequestDeadline():
+  '''Returns the deadline (epoch time) of the requests performed by this process, None if they have none'''
+  return _requestControl['deadline']
+
+def checkRequestControl():
+  '''Raises RequestTimeout if the requests of this process exceeded their deadline or were cancelled'''
+  deadline, isCancelled = _requestControl['deadline'], _requestControl['isCancelled']
+  if deadline and time.time() > deadline:
+    raise RequestTimeout('Request deadline exceeded')
+  if isCancelled and isCancelled():
+    raise RequestTimeout('Request cancelled')
+
+def setPageLoadTimeout(driver, defaultTimeout=PAGE_LOAD_TIMEOUT):
+  '''Limits the page loads of the driver to the time left until the deadline of the requests of this process, or to
+  defaultTimeout seconds if they have none. Raises RequestTimeout if they already exceeded it or were cancelled'''
+  checkRequestControl()
+  deadline = getRequestDeadline()
+  driver.set_page_load_timeout(max(1, deadline - time.time()) if deadline else defaultTimeout)
+
+# Slots limiting the number of live browsers among the workers of a run (see setDriverSlots)
+_driverSlots = {'semaphore': None}
+
+def setDriverSlots(semaphore=None):
+  '''Sets the semaphore shared by the workers of a run to limit the number of live browsers. No limit if None.
+  Meant to be used as initializer of the worker pools'''
+  _driverSlots['semaphore'] = semaphore
+
+def acquireDriverSlot(sleepTime=5):
+  '''Waits for a free browser slot, checking the request control while waiting'''
+  semaphore = _driverSlots['semaphore']
+  if semaphore is not None:
+    while not semaphore.acquire(timeout=sleepTime):
+      checkRequestControl()
+
+def releaseDriverSlot():
+  if _driverSlots['semaphore'] is not None:
+    _driverSlots['semaphore'].release()
+
+def closeDriver(driver):
+  '''Quits the driver browser and frees its slot and its cache directory. Warm drivers (see setWarmDrivers) are kept
+  open with a single tab, unless they are broken, being discarded then'''
+  warmKey = getattr(driver, '_warmKey', None)
+  if warmKey is not None:
+    try:
+      for tab in driver.window_handles[1:]:
+        driver.switch_to.window(tab)
+        driver.close()
+      driver.switch_to.window(driver.window_handles[0])
+      return
+    except Exception:
+      _warmDrivers['drivers'].pop(warmKey, None)
+
+  try:
+    driver.quit()
+  finally:
+    releaseDriverSlot()
+    unlockCacheDir(getattr(driver, '_cacheLock', None))
+    driver._cacheLock = None
+
+def waitElements(driver, by, value, sleepTime=5):
+  '''Waits until the driver finds some element matching the locator and returns them, checking the request control
+  while waiting'''
+  data = driver.find_elements(by, value)
+  while not data:
+    checkRequestControl()
+    time.sleep(sleepTime)
+    data = driver.find_elements(by, value)
+  return data
+
+
+def seleniumRequest(seqDic, softData, browserData, parseFunction, seqNameKey=None, onBatch=None, maxTabs=1):
   '''Perform a series of Selenium requests an operations to emulate the evaluation of a set of sequences by a software
   web server.
   - seqDic: dic, sequences {seqId: seqString}
@@ -209,25 +510,90 @@ def seleniumRequest(seqDic, softData, browserData, parseFunction, seqNameKey=Non
   - browserData: dic, contains the information necessary to build the Selenium driver
   - parseFunction: func, parses the driver data once the request is performed and returns a dic {'Score' [sc1, ...]}
   - seqNameKey: str, if not None, include the sequence name as a web element value to write in this key
+  - onBatch: func, if not None, called with the parsed results of each request as soon as they are available
+  - maxTabs: int, maximum number of requests submitted at the same time, each in its own browser tab. The next request
+  is submitted while the previous ones are computed in the server, and the results are collected in submission order
   '''
   # url, data, softName, seqFormat='fastaString', seqName='sequence', multi=True
   driver = getDriver(browserData)
   seqData = getSeqData(seqDic, softData)
 
-  # Performing one request for each chunk of admitted data (just once if fasta admitted)
-  outDic = {}
-  for i, seq in enumerate(seqData):
-    curSeqKeys = {softData['seqName']: seq}
-    if seqNameKey:
-      curSeqKeys.update({seqNameKey: f'seq{i + 1}'})
+  # Tabs without request and tabs waiting for the results of a request, in submission order
+  outDic, freeTabs, pendingTabs = {}, [driver.current_window_handle], []
 
-    driver = performRequest(curSeqKeys, driver, softData)
+  def collectOldest():
+    tab = pendingTabs.pop(0)
+    driver.switch_to.window(tab)
     # Parse the driver with the corresponding function for each software
     batchDic = parseFunction(driver)
-    outDic = updateBatchDic(outDic, batchDic)
+    if onBatch:
+      onBatch(batchDic)
+    freeTabs.append(tab)
+    return updateBatchDic(outDic, batchDic)
+
+  # Performing one request for each chunk of admitted data (just once if fasta admitted)
+  try:
+    for i, seq in enumerate(seqData):
+      if not freeTabs:
+        if len(pendingTabs) < maxTabs:
+          driver.switch_to.new_window('tab')
+          freeTabs.append(driver.current_window_handle)
+        else:
+          outDic = collectOldest()
+
+      tab = freeTabs.pop(0)
+      driver.switch_to.window(tab)
+      curSeqKeys = {softData['seqName']: seq}
+      if seqNameKey:
+        curSeqKeys.update({seqNameKey: f'seq{i + 1}'})
+      driver = performRequest(curSeqKeys, driver, softData)
+      pendingTabs.append(tab)
+
+    while pendingTabs:
+      outDic = collectOldest()
+  finally:
+    closeDriver(driver)
+    removeFastaFiles(seqData, softData)
   return outDic
 
 
+def seleniumSweepRequest(seqDic, softData, paramDics, browserData, parseFunction, seqNameKey=None):
+  '''Perform the Selenium requests of seleniumRequest for several sets of form parameters using a single driver.
+  For each chunk of sequences, the request for every parameter set is submitted in its own browser tab before
+  parsing any of them, so the server computes them concurrently.
+  - paramDics: dic, {sweepKey: {parameterName: parameterValue}}, form parameters for each request
+  Returns a dictionary of the form {sweepKey: outDic}, outDic being the output of parseFunction for all the chunks
+  '''
+  driver = getDriver(browserData)
+  seqData = getSeqData(seqDic, softData)
+  mainTab = driver.current_window_handle
+
+  outDics = {pKey: {} for pKey in paramDics}
+  try:
+    for i, seq in enumerate(seqData):
+      curSeqKeys = {softData['seqName']: seq}
+      if seqNameKey:
+        curSeqKeys.update({seqNameKey: f'seq{i + 1}'})
+
+      tabs = {}
+      for j, (pKey, pDic) in enumerate(paramDics.items()):
+        if j > 0:
+          driver.switch_to.new_window('tab')
+        tabs[pKey] = driver.current_window_handle
+        driver = performRequest(curSeqKeys, driver, {**softData, 'params': pDic})
+
+      for pKey, tab in tabs.items():
+        driver.switch_to.window(tab)
+        outDics[pKey] = updateBatchDic(outDics[pKey], parseFunction(driver))
+        if tab != mainTab:
+          driver.close()
+      driver.switch_to.window(mainTab)
+  finally:
+    closeDriver(driver)
+    removeFastaFiles(seqData, softData)
+  return outDics
+
+
 def innerSplit(text, preText, endText):
   results, splitted = [], text.split(preText)[1:]
   for text in splitted:
@@ -248,20 +614,193 @@ def makeRequest(url, action='post', data={}, headers={}):
     print(f"There was an error in request to {url}: {response.status_code}")
   return response
 
+def probeSoftware(softName, timeout=15):
+  '''Checks that the web server of a software answers, with a light request to its url (no browser involved)
+  :return: (isHealthy, message) with the reason if it is not healthy
+  '''
+  url = WEB_SOFT_DATA[softName]['url']
+  try:
+    response = requests.get(url, timeout=timeout, stream=True)
+    response.close()
+  except requests.RequestException as e:
+    return False, f'{url} not reachable ({type(e).__name__})'
+  if response.status_code >= 500:
+    return False, f'{url} answered with status {response.status_code}'
+  return True, ''
+
+def probeSoftwares(softNames, timeout=15):
+  '''Probes the web servers of several softwares concurrently (see probeSoftware)
+  :return: {softName: (isHealthy, message)}
+  '''
+  from concurrent.futures import ThreadPoolExecutor
+  softNames = list(softNames)
+  if not softNames:
+    return {}
+  with ThreadPoolExecutor(max_workers=len(softNames)) as executor:
+    results = executor.map(lambda softName: probeSoftware(softName, timeout), softNames)
+  return dict(zip(softNames, results))
+
 
 ########### SELENIUM CALLS ################
 
-def callABCpredSelenium(seqDic, browserData={}, data={}):
-  data = {"window": "16", "filter": 'on', 'Threshold': "0.51"} if not data else data
-
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/abcpred/ABC_submission.html",
-              'multi': False,
-              'seqName': 'SEQ', 'params': data, 'submitCSS': "input[value='Submit sequence']"}
+def getWebSoftData(softName, data={}):
+  '''Returns a copy of the web data of a software (see WEB_SOFT_DATA) with the form parameters to use: data if
+  specified, or the software defaults otherwise'''
+  softData = WEB_SOFT_DATA[softName].copy()
+  softData['softName'] = softName
+  softData['params'] = data if data else softData['defaults'].copy()
+  return softData
+
+def getSoftMaxTabs(softNames):
+  '''Returns the maximum number of tabs a browser uses for the softwares (see WEB_SOFT_DATA), 1 for the rest'''
+  return max([WEB_SOFT_DATA.get(softName, {}).get('maxTabs', 1) for softName in softNames] + [1])
+
+def getSoftConstraints(softName, data={}):
+  '''Returns the input constraints of a software (see WEB_SOFT_DATA) as a dictionary with the keys:
+  alphabet (accepted residues), minLength and maxLength (None if no limit) and split (whether the sequences are split
+  in valid fragments, for selectors, instead of being discarded). The window parameter, if any, sets the minLength
+  - data: dic, form parameters that will be used for the software
+  '''
+  constraints = {'alphabet': STANDARD_AAS, 'minLength': None, 'maxLength': None, 'split': False}
+  constraints.update(WEB_SOFT_DATA[softName].get('constraints', {}))
+  windowParam = constraints.pop('windowParam', None)
+  if windowParam:
+    params = data if data else WEB_SOFT_DATA[softName]['defaults']
+    constraints['minLength'] = int(params.get(windowParam, WEB_SOFT_DATA[softName]['defaults'][windowParam]))
+  return constraints
+
+def isValidSequence(seq, constraints):
+  '''Returns whether a sequence fulfills the software constraints (see getSoftConstraints)'''
+  minLength, maxLength = constraints['minLength'], constraints['maxLength']
+  return all([res in constraints['alphabet'] for res in seq.upper()]) and \
+         (not minLength or len(seq) >= minLength) and (not maxLength or len(seq) <= maxLength)
+
+def filterSequences(sequences, constraints):
+  '''Returns the sequences {seqId: seqString} that fulfill the software constraints, reporting the discarded ones'''
+  validSeqs = {seqId: seq for seqId, seq in sequences.items() if isValidSequence(seq, constraints)}
+  if len(validSeqs) < len(sequences):
+    print(f'{len(sequences) - len(validSeqs)} sequences do not fulfill the software input constraints '
+          f'and get NaN scores')
+  return validSeqs
+
+def splitSequences(sequences, constraints):
+  '''Splits the sequences at the residues out of the software alphabet, keeping the fragments that fulfill the
+  length constraints
+  - sequences: dic, {seqId: seqString}
+  Returns a dictionary as {fragmentKey: (seqId, offset, fragmentString)}, being offset the fragment position in the
+  original sequence
+  '''
+  fragments = {}
+  for seqId, seq in sequences.items():
+    start = 0
+    for i, res in enumerate(seq.upper() + '*'):
+      if res not in constraints['alphabet']:
+        if isValidSequence(seq[start:i], constraints):
+          fragments[f'{seqId}_{start}'] = (seqId, start, seq[start:i])
+        start = i + 1
+  return fragments
+
+def getFragmentsMapper(fragments, onBatch=None):
+  '''Returns a function that maps the selector results of each fragment request (performed one fragment per request
+  in the order of fragments) to its original sequence id, shifting the epitope positions by the fragment offset.
+  If onBatch is not None, it is called with each mapped batch'''
+  fragKeys, reqIdx = list(fragments.keys()), [0]
+
+  def mapBatch(batchDic):
+    mappedDic = {}
+    for epDic in batchDic.values():
+      seqId, offset, _ = fragments[fragKeys[reqIdx[0]]]
+      reqIdx[0] += 1
+      epDic = epDic.copy()
+      epDic['Position'] = [int(pos) + offset for pos in epDic.get('Position', [])]
+      mappedDic[seqId] = epDic
+    if onBatch:
+      onBatch(mappedDic)
+    return mappedDic
+  return mapBatch
+
+def updateFragmentsDic(outDic, mappedDic):
+  '''Joins the mapped selector results of a fragment to those of the rest of fragments of the same sequence'''
+  for seqId, epDic in mappedDic.items():
+    outDic[seqId] = updateBatchDic(outDic.get(seqId, {}), {key: list(values) for key, values in epDic.items()})
+  return outDic
 
-  outDic = seleniumRequest(seqDic, softData, browserData, parseABCpred, seqNameKey='SEQNAME')
+def fillInvalidScores(outDic, seqKeys, validKeys):
+  '''Returns the output of the valid sequences evaluation with NaN values in the positions of the invalid ones,
+  so that the values keep the order of seqKeys'''
+  if len(validKeys) == len(seqKeys):
+    return outDic
+  outDic = outDic if outDic else {'Score': []}
+  validIdxs = {seqKey: i for i, seqKey in enumerate(validKeys)}
+  filledDic = {}
+  for key, values in outDic.items():
+    filledDic[key] = [values[validIdxs[seqKey]] if seqKey in validIdxs else float('nan') for seqKey in seqKeys]
+  return filledDic
+
+def callWebSoftware(softName, sequences, browserData={}, data={}, onBatch=None, metricsFile=None):
+  '''Performs the selenium requests on the web of a software defined in WEB_SOFT_DATA and parses the results
+  - softName: str, name of the software
+  - sequences: dic, sequences {seqId: seqString}
+  - browserData: dic, contains the information necessary to build the Selenium driver. If its "broker" key is True,
+  the evaluators requests are submitted to the local broker running on its "cacheDir" (see immuno.utils.broker)
+  - data: dic, form parameters for the software web
+  - onBatch: func, if not None, called with the parsed results of each request (see seleniumRequest)
+  - metricsFile: str, if not None, file where the call timing is registered
+  '''
+  softData, startTime = getWebSoftData(softName, data), time.time()
+  constraints = getSoftConstraints(softName, softData['params'])
+  if constraints.get('split'):
+    # Selectors: the proteins are split into valid fragments, whose results are mapped back to the proteins
+    fragments = splitSequences(sequences, constraints)
+    outDic = {}
+    if fragments:
+      fragSeqs = {fragKey: fragSeq for fragKey, (protId, offset, fragSeq) in fragments.items()}
+      mapBatch = getFragmentsMapper(fragments, onBatch)
+      seleniumRequest(fragSeqs, softData, browserData, softData['parser'], seqNameKey=softData.get('seqNameKey'),
+                      onBatch=lambda batchDic: updateFragmentsDic(outDic, mapBatch(batchDic)),
+                      maxTabs=softData.get('maxTabs', 1))
+  else:
+    # Evaluators: only the valid sequences are submitted and the rest get NaN scores
+    validSeqs = filterSequences(sequences, constraints)
+    outDic, broker = {}, None
+    if validSeqs and browserData.get('broker'):
+      from .broker import getBrokerClient, brokerRequest
+      broker = getBrokerClient(browserData['cacheDir'])
+      if broker is None:
+        print(f'No request broker running on {browserData["cacheDir"]}: {softName} requested directly')
+
+    if validSeqs and broker is not None:
+      outDic = brokerRequest(broker, softName, validSeqs, data, metricsFile=metricsFile)
+    elif validSeqs:
+      outDic = seleniumRequest(validSeqs, softData, browserData, softData['parser'],
+                               seqNameKey=softData.get('seqNameKey'), onBatch=onBatch,
+                               maxTabs=softData.get('maxTabs', 1))
+    outDic = fillInvalidScores(outDic, list(sequences.keys()), list(validSeqs.keys()))
+  logTask(metricsFile, 'evaluation', softName, startTime, time.time(), len(sequences))
   return outDic
 
-def callABCpred(protsDic, data={}):
+def runEvaluationSweep(softName, sequences, paramDics, browserData={}):
+  '''Evaluates the sequences with several parameter combinations of the same software in a single browser session.
+  - softName: str, name of the software in WEB_SOFT_DATA
+  - sequences: dic, sequences {seqId: seqString}
+  - paramDics: dic, one element per parameter combination as {sweepKey: {parameterName: parameterValue}}
+  - browserData: dic, contains the information necessary to build the Selenium driver
+  Returns a dictionary of the form {sweepKey: {'Score': [scores]}}
+  '''
+  softData = getWebSoftData(softName)
+  paramDics = {pKey: pDic if pDic else softData['defaults'] for pKey, pDic in paramDics.items()}
+  validSeqs = filterSequences(sequences, getSoftConstraints(softName))
+  outDics = {pKey: {} for pKey in paramDics}
+  if validSeqs:
+    outDics = seleniumSweepRequest(validSeqs, softData, paramDics, browserData, softData['parser'],
+                                   seqNameKey=softData.get('seqNameKey'))
+  return {pKey: fillInvalidScores(outDic, list(sequences.keys()), list(validSeqs.keys()))
+          for pKey, outDic in outDics.items()}
+
+def callABCpredSelenium(seqDic, browserData={}, data={}, onBatch=None):
+  return callWebSoftware('ABCpred', seqDic, browserData, data, onBatch=onBatch)
+
+def callABCpred(protsDic, data={}, onBatch=None):
   'https://webs.iiitd.edu.in/raghava/abcpred/ABC_submission.html'
   oriUrl = "https://webs.iiitd.edu.in"
   data = {"window": "16", "filter": 'on', 'Threshold': "0.51"} if not data else data
@@ -274,83 +813,37 @@ def callABCpred(protsDic, data={}):
     submitUrl = os.path.join(oriUrl, "cgibin/abcpred/test1_main.pl")
     response = makeRequest(submitUrl, 'post', data, headers)
     outDic[seqId] = getABCpredScore(parseABCpredOutHTML(response))
+    if onBatch:
+      onBatch({seqId: outDic[seqId]})
   return outDic
 
-def callLBtope(sequences, browserData={}, data={}):
-  data = {"for": 'flx'} if not data else data
-
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/lbtope/protein.php",
-              'multi': True, 'seqFormat': 'fastaString',
-              'seqName': 'seq', 'params': data, 'submitCSS': "input[value='Submit antigen for prediction']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseLBtope)
-  return outDic
+def callLBtope(sequences, browserData={}, data={}, onBatch=None):
+  return callWebSoftware('LBtope', sequences, browserData, data, onBatch=onBatch)
 
 
 def callToxinPred(sequences, browserData={}, data={}):
-  data = {'method': '8', 'eval': '10', 'thval': '0.0'} if not data else data
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/toxinpred/multi_submit.php",
-              'multi': True, 'seqFormat': 'fastaString',
-              'seqName': 'seq', 'params': data, 'submitCSS': "input[value='Run Analysis!']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseToxinPred)
-  return outDic
+  return callWebSoftware('ToxinPred', sequences, browserData, data)
 
 
 def callToxinPred2(sequences, browserData={}, data={}):
-  data = {'terminus': '4', 'svm_th': '0.6'} if not data else data
-
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/toxinpred2/batch.html",
-              'multi': True, 'seqFormat': 'fastaString',
-              'seqName': 'seq', 'params': data, 'submitCSS': "input[value='Submit']"}
-
   # todo: check when sequences >=19
-  outDic = seleniumRequest(sequences, softData, browserData, parseToxinPred2)
-  return outDic
+  return callWebSoftware('ToxinPred2', sequences, browserData, data)
 
 
 def callIFNepitope(sequences, browserData={}, data={}):
-  data = {"method": 'svm'} if not data else data
-
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/ifnepitope/predict.php",
-              'multi': True, 'seqFormat': 'fastaString',
-              'seqName': 'sequence', 'params': data, 'submitCSS': "input[value='Submit Peptides for Prediction']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseIFNepitope)
-  return outDic
+  return callWebSoftware('IFNepitope', sequences, browserData, data)
 
 
 def callIL4pred(sequences, browserData={}, data={}):
-  data = {"method": '3'} if not data else data
-
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/il4pred/predict.php",
-              'multi': True, 'seqFormat': 'fastaString',
-              'seqName': 'seq', 'params': data, 'submitCSS': "input[value='Virtual Screening']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseToxinPred)
-  return outDic
+  return callWebSoftware('IL4pred', sequences, browserData, data)
 
 
 def callIL10pred(sequences, browserData={}, data={}):
-  data = {"method": '1'} if not data else data
-
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/il10pred/predict3.php",
-              'multi': True, 'seqFormat': 'fastaString',
-              'seqName': 'seq', 'params': data, 'submitCSS': "input[value='Run Analysis!']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseIL10pred)
-  return outDic
+  return callWebSoftware('IL10pred', sequences, browserData, data)
 
 
 def callAlgPred2(sequences, browserData={}, data={}):
-  data = {"terminus": '4', 'svm_th': "0.3"} if not data else data
-
-  softData = {'url': "https://webs.iiitd.edu.in/raghava/algpred2/batch.html",
-              'multi': True, 'seqFormat': 'fastaString',
-              'seqName': 'seq', 'params': data, 'submitCSS': "input[value='Submit']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseAlgPred2)
-  return outDic
+  return callWebSoftware('AlgPred2', sequences, browserData, data)
 
 
 ############## PARSING ##############
@@ -402,10 +895,7 @@ def filterBestEpitopes(resDic, minProb=78):
 
 def parseABCpred(driver):
   from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.CSS_SELECTOR, "table[width='60% bgcolor=']")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.CSS_SELECTOR, "table[width='60% bgcolor=']")
+  data = waitElements(driver, By.CSS_SELECTOR, "table[width='60% bgcolor=']")
   headerText = data[0].text
   seqName = innerSplit(headerText, 'Sequence name', '\n')[0]
 
@@ -430,10 +920,7 @@ def parseABCpred(driver):
 
 def parseLBtope(driver):
   from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.PARTIAL_LINK_TEXT, 'Download results as a text file')
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.PARTIAL_LINK_TEXT, 'Download results as a text file')
+  data = waitElements(driver, By.PARTIAL_LINK_TEXT, 'Download results as a text file')
   data[0].click()
 
   resTxt = driver.find_element(By.XPATH, "/html/body").text
@@ -453,10 +940,7 @@ def parseLBtope(driver):
 
 def parseToxinPred11(driver):
   from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.ID, "tableTwo")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.ID, "tableTwo")
+  data = waitElements(driver, By.ID, "tableTwo")
   resultWeb = data[0]
 
   resDic = {}
@@ -488,10 +972,7 @@ def parseToxinPred(driver):
         resDic[labels[i]].append(cell.text)
     return outDic
 
-  data = driver.find_elements(By.ID, "tableTwo")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.ID, "tableTwo")
+  data = waitElements(driver, By.ID, "tableTwo")
   resultWeb = data[0]
 
   outDic = {}
@@ -510,10 +991,7 @@ def parseToxinPred(driver):
 
 def parseToxinPred2(driver):
   from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.CSS_SELECTOR, "table[border='1']")
-  while not data:
-    time.sleep(5)
-    data = driver.driver.find_elements(By.CSS_SELECTOR, "table[border='1']")
+  data = waitElements(driver, By.CSS_SELECTOR, "table[border='1']")
   resultWeb = data[0]
 
   resDic = {}
@@ -537,10 +1015,7 @@ def parseIFNepitope(driver):
         outDic[labels[i]].append(cell.text)
     return outDic
 
-  data = driver.find_elements(By.ID, "example")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.ID, "example")
+  data = waitElements(driver, By.ID, "example")
   resultWeb = data[0]
 
   labels = ['N0', 'Name', 'Epitope', 'Method', 'Result', 'Score']
@@ -565,10 +1040,7 @@ def parseIL10pred(driver):
         resDic[labels[i]].append(cell.text)
     return resDic
 
-  data = driver.find_elements(By.CSS_SELECTOR, "table[class='table table-hover']")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.CSS_SELECTOR, "table[class='table table-hover']")
+  data = waitElements(driver, By.CSS_SELECTOR, "table[class='table table-hover']")
   resultWeb = data[0]
 
   resDic = {}
@@ -588,10 +1060,7 @@ def parseIL10pred(driver):
 
 def parseAlgPred2(driver):
   from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.CSS_SELECTOR, "table[border='1']")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.CSS_SELECTOR, "table[border='1']")
+  data = waitElements(driver, By.CSS_SELECTOR, "table[border='1']")
   resultWeb = data[0]
 
   resDic = {}
@@ -607,6 +1076,26 @@ def parseAlgPred2(driver):
   outDic = renameScore(resDic)
   return outDic
 
+def parseVaxignMLResults(resFile):
+  '''Parse a Vaxign-ML results tsv file, with the protein ids in the first column
+  :param resFile: Vaxign-ML output table
+  :return: {proteinId: {attributeName: value}}, with one attribute for each numeric column
+  '''
+  resDic = {}
+  with open(resFile) as f:
+    header = f.readline().strip().split('\t')
+    attrNames = ['_' + ''.join(c if c.isalnum() else '_' for c in colName) for colName in header]
+    for line in f:
+      sline = line.strip().split('\t')
+      if len(sline) == len(header):
+        resDic[sline[0]] = {}
+        for attrName, value in zip(attrNames[1:], sline[1:]):
+          try:
+            resDic[sline[0]][attrName] = float(value)
+          except ValueError:
+            pass
+  return resDic
+
 def renameScore(outDic, scoreKey=''):
   '''Rename the score key in a dict with just "Score"'''
   scoreK = None
@@ -616,6 +1105,63 @@ def renameScore(outDic, scoreKey=''):
   outDic['Score'] = outDic.pop(scoreK)
   return outDic
 
+def toFloat(value):
+  '''Returns the value as float, NaN if it cannot be converted'''
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return float('nan')
+
+VETO_OPERATORS = {'>': lambda x, y: x > y, '<': lambda x, y: x < y,
+                  '>=': lambda x, y: x >= y, '<=': lambda x, y: x <= y}
+
+def getRankScore(roiScores, weights, vetoes):
+  '''Returns the combined ranking score of a ROI: the weighted sum of its scores (weight 1 if not defined), skipping
+  the NaN ones. None if the ROI is vetoed or has no valid scores
+  :param roiScores: {evalKey: score}
+  :param weights: {evalKey: weight}
+  :param vetoes: [(evalKey, operator, value)], the ROI is vetoed if any "score operator value" is true
+  '''
+  roiScores = {evalKey: toFloat(score) for evalKey, score in roiScores.items()}
+  for evalKey, operator, value in vetoes:
+    score = roiScores.get(evalKey, float('nan'))
+    if score == score and VETO_OPERATORS[operator](score, value):
+      return None
+
+  validScores = [(evalKey, score) for evalKey, score in roiScores.items() if score == score]
+  if not validScores:
+    return None
+  return sum([weights.get(evalKey, 1) * score for evalKey, score in validScores])
+
+def pushTopK(topHeap, k, rankScore, itemId):
+  '''Pushes an item in a bounded min-heap which keeps the k items with the highest rankScore (the ties keep the lowest
+  itemIds). Returns the id of the item left out of the heap, None if no item was left out
+  :param topHeap: list, heap of (rankScore, -itemId) tuples, modified in place
+  :param itemId: int, id of the item (e.g. ROI object id)
+  '''
+  import heapq
+  heapq.heappush(topHeap, (rankScore, -itemId))
+  if len(topHeap) > k:
+    return -heapq.heappop(topHeap)[1]
+  return None
+
+def writeScoreArrays(matrixFile, indexFile, roiIds, positions, scoreColumns):
+  '''Writes a ROI x evaluator score matrix as a .npy file, which can be memory-mapped (numpy.load(matrixFile,
+  mmap_mode='r')), and its index as a .npz file with the arrays: roiIds, positions (ROI start and end) and
+  evaluators (names of the matrix columns)
+  - roiIds: list, ids of the ROIs (matrix rows)
+  - positions: list, (start, end) of each ROI
+  - scoreColumns: dic, {evalKey: [scores]} with the scores in the order of roiIds
+  '''
+  import numpy as np
+  evalKeys = list(scoreColumns.keys())
+  matrix = np.full((len(roiIds), len(evalKeys)), np.nan, dtype=np.float64)
+  for j, evalKey in enumerate(evalKeys):
+    matrix[:, j] = [toFloat(score) for score in scoreColumns[evalKey]]
+  np.save(matrixFile, matrix)
+  np.savez(indexFile, roiIds=np.array(roiIds, dtype=np.int64),
+           positions=np.array(positions, dtype=np.int64).reshape(-1, 2), evaluators=np.array(evalKeys, dtype=str))
+
 def mapEvalParamNames(sDic):
   wsDic = {}
   for sName, curSDic in sDic.items():
@@ -624,4 +1170,54 @@ def mapEvalParamNames(sDic):
       if paramName in EVAL_PARAM_MAP:
         paramName = EVAL_PARAM_MAP[paramName]
       wsDic[sName][paramName] = paramValue
-  return wsDic
\ No newline at end of file
+  return wsDic
+
+
+############## SOFTWARE WEB DATA ##############
+
+# Characteristics of the software webs to build the selenium requests (see performRequest and getSeqData)
+# and the functions parsing their results. "defaults" are the form parameters used when none are specified.
+# "constraints" are the input limits of each server (see getSoftConstraints): ABCpred needs proteins at least as long
+# as its window, IFNepitope works on 15-mers and ToxinPred on peptides up to 35 residues.
+# "maxTabs" is the number of requests submitted concurrently from the same browser (see seleniumRequest), 1 if missing
+# "seqFormat" fastaFile uploads the sequences as a file through the file input named "seqName", for the servers that
+# have one; fastaString writes them in the "seqName" textarea in a single script call (see fillElement)
+WEB_SOFT_DATA = {
+  'ABCpred': {'url': "https://webs.iiitd.edu.in/raghava/abcpred/ABC_submission.html",
+              'multi': False, 'seqName': 'SEQ', 'seqNameKey': 'SEQNAME',
+              'submitCSS': "input[value='Submit sequence']", 'parser': parseABCpred,
+              'defaults': {"window": "16", "filter": 'on', 'Threshold': "0.51"}, 'maxTabs': 4,
+              'constraints': {'windowParam': 'window', 'split': True}},
+  'LBtope': {'url': "https://webs.iiitd.edu.in/raghava/lbtope/protein.php",
+             'multi': True, 'seqFormat': 'fastaString', 'seqName': 'seq',
+             'submitCSS': "input[value='Submit antigen for prediction']", 'parser': parseLBtope,
+             'defaults': {"for": 'flx'},
+             'constraints': {'split': True}},
+
+  'ToxinPred': {'url': "https://webs.iiitd.edu.in/raghava/toxinpred/multi_submit.php",
+                'multi': True, 'seqFormat': 'fastaString', 'seqName': 'seq',
+                'submitCSS': "input[value='Run Analysis!']", 'parser': parseToxinPred,
+                'defaults': {'method': '8', 'eval': '10', 'thval': '0.0'},
+                'constraints': {'minLength': 2, 'maxLength': 35}},
+  'ToxinPred2': {'url': "https://webs.iiitd.edu.in/raghava/toxinpred2/batch.html",
+                 'multi': True, 'seqFormat': 'fastaString', 'seqName': 'seq',
+                 'submitCSS': "input[value='Submit']", 'parser': parseToxinPred2,
+                 'defaults': {'terminus': '4', 'svm_th': '0.6'}},
+  'IFNepitope': {'url': "https://webs.iiitd.edu.in/raghava/ifnepitope/predict.php",
+                 'multi': True, 'seqFormat': 'fastaString', 'seqName': 'sequence',
+                 'submitCSS': "input[value='Submit Peptides for Prediction']", 'parser': parseIFNepitope,
+                 'defaults': {"method": 'svm'},
+                 'constraints': {'minLength': 15, 'maxLength': 15}},
+  'IL4pred': {'url': "https://webs.iiitd.edu.in/raghava/il4pred/predict.php",
+              'multi': True, 'seqFormat': 'fastaString', 'seqName': 'seq',
+              'submitCSS': "input[value='Virtual Screening']", 'parser': parseToxinPred,
+              'defaults': {"method": '3'}},
+  'IL10pred': {'url': "https://webs.iiitd.edu.in/raghava/il10pred/predict3.php",
+               'multi': True, 'seqFormat': 'fastaString', 'seqName': 'seq',
+               'submitCSS': "input[value='Run Analysis!']", 'parser': parseIL10pred,
+               'defaults': {"method": '1'}},
+  'AlgPred2': {'url': "https://webs.iiitd.edu.in/raghava/algpred2/batch.html",
+               'multi': True, 'seqFormat': 'fastaString', 'seqName': 'seq',
+               'submitCSS': "input[value='Submit']", 'parser': parseAlgPred2,
+               'defaults': {"terminus": '4', 'svm_th': "0.3"}},
+}
@@ -0,0 +1,142 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from pyworkflow.protocol import params
+from pyworkflow.viewer import ProtocolViewer, DESKTOP_TKINTER
+from pwem.viewers import EmPlotter, TextView
+
+from ..protocols import ProtIIITDEvaluations, ProtIIITDEpitopeSelection
+from ..utils.metrics import readMetrics, getLatencies, getThroughput, getConcurrency, getCounters, getHitRates, \
+  getSlowestStage, buildMetricsReport
+
+class ImmunoPerformanceViewer(ProtocolViewer):
+  """Visualize the timing and counters registered during an epitope selection or evaluation run"""
+  _label = 'Performance viewer'
+  _targets = [ProtIIITDEvaluations, ProtIIITDEpitopeSelection]
+  _environments = [DESKTOP_TKINTER]
+
+  def _defineParams(self, form):
+    form.addSection(label='Performance')
+    form.addParam('displayLatency', params.LabelParam, label='Latency per software: ',
+                  help='Distribution of the time spent by each selector or evaluator on each of its tasks. '
+                       'The slowest stage, with the largest accumulated time, is highlighted')
+    form.addParam('binTime', params.IntParam, label='Throughput time bin (s): ', default=60,
+                  help='Time interval where the number of processed sequences is counted')
+    form.addParam('displayThroughput', params.LabelParam, label='Throughput over time: ',
+                  help='Number of sequences processed by each stage along the run')
+    form.addParam('displayConcurrency', params.LabelParam, label='Concurrency over time: ',
+                  help='Number of tasks (selectors or evaluation chunks) running at the same time along the run')
+    form.addParam('displayCounters', params.LabelParam, label='Retries and cache hits: ',
+                  help='Number of hedged and timed out requests per software and the cache hit rates')
+    form.addParam('displaySummary', params.LabelParam, label='Performance summary: ',
+                  help='Text summary of the run performance, including the slowest stage')
+
+  def _getVisualizeDict(self):
+    return {'displayLatency': self._showLatency,
+            'displayThroughput': self._showThroughput,
+            'displayConcurrency': self._showConcurrency,
+            'displayCounters': self._showCounters,
+            'displaySummary': self._showSummary}
+
+  def getEvents(self):
+    return readMetrics(self.protocol.getMetricsFile())
+
+  def _noMetricsMessage(self):
+    return [self.errorMessage('No performance metrics were registered for this run', title='Missing metrics')]
+
+  def _showLatency(self, paramName=None):
+    events = self.getEvents()
+    latDic = getLatencies(events)
+    if not latDic:
+      return self._noMetricsMessage()
+
+    slowest, _ = getSlowestStage(events)
+    keys = sorted(latDic)
+    plotter = EmPlotter(x=1, y=1, windowTitle='Latency per software')
+    ax = plotter.createSubPlot('Task latency (slowest stage in red)', 'Software', 'Latency (s)')
+    boxes = ax.boxplot([latDic[key] for key in keys], patch_artist=True)
+    for key, box in zip(keys, boxes['boxes']):
+      box.set_facecolor('tab:red' if key == slowest else 'tab:blue')
+    ax.set_xticklabels([f'{soft}\n({stage})' for stage, soft in keys])
+    return [plotter]
+
+  def _showThroughput(self, paramName=None):
+    thDic = getThroughput(self.getEvents(), self.binTime.get())
+    if not thDic:
+      return self._noMetricsMessage()
+
+    plotter = EmPlotter(x=1, y=1, windowTitle='Throughput')
+    ax = plotter.createSubPlot('Throughput over time', 'Time since start (s)',
+                               f'Sequences processed per {self.binTime.get()} s')
+    for stage, (binTimes, counts) in thDic.items():
+      ax.step(binTimes, counts, where='post', label=stage)
+    ax.legend()
+    return [plotter]
+
+  def _showConcurrency(self, paramName=None):
+    times, nRunning = getConcurrency(self.getEvents())
+    if not times:
+      return self._noMetricsMessage()
+
+    plotter = EmPlotter(x=1, y=1, windowTitle='Concurrency')
+    ax = plotter.createSubPlot('Concurrency over time', 'Time since start (s)', 'Running tasks')
+    ax.step(times, nRunning, where='post')
+    return [plotter]
+
+  def _showCounters(self, paramName=None):
+    events = self.getEvents()
+    counters, rates = getCounters(events), getHitRates(events)
+    if not counters:
+      return [self.errorMessage('No retries or cache accesses were registered for this run', title='No counters')]
+
+    plotter = EmPlotter(x=1, y=2 if rates else 1, windowTitle='Retries and cache hits')
+    ax = plotter.createSubPlot('Counters per software', 'Counter', 'Count')
+    cNames = sorted([cName for cName in counters if not cName.endswith('Hits') and not cName.endswith('Misses')])
+    softs = sorted({soft for cName in cNames for soft in counters[cName]})
+    width = 0.8 / max(1, len(softs))
+    for i, soft in enumerate(softs):
+      ax.bar([j + i * width for j in range(len(cNames))], [counters[cName].get(soft, 0) for cName in cNames],
+             width=width, label=soft if soft else 'all')
+    ax.set_xticks([j + width * (len(softs) - 1) / 2 for j in range(len(cNames))])
+    ax.set_xticklabels(cNames)
+    if softs:
+      ax.legend()
+
+    if rates:
+      ax = plotter.createSubPlot('Cache hit rates', 'Cache', 'Hit rate (%)')
+      ax.bar(list(rates.keys()), [100 * rate for rate in rates.values()])
+      ax.set_ylim(0, 100)
+    return [plotter]
+
+  def _showSummary(self, paramName=None):
+    events = self.getEvents()
+    if not events:
+      return self._noMetricsMessage()
+
+    reportFile = self.protocol._getExtraPath('performanceReport.txt')
+    with open(reportFile, 'w') as f:
+      f.write(buildMetricsReport(events))
+    return [TextView([reportFile], title='Performance summary')]
@@ -36,6 +36,7 @@ setup(
        'immuno': ['immuno_logo.png'],
     },
     entry_points={
-        'pyworkflow.plugin': 'immuno = immuno'
+        'pyworkflow.plugin': 'immuno = immuno',
+        'console_scripts': ['immuno-batch = immuno.cli:main']
     }
 )